@@ -0,0 +1,131 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+A content-addressed store for the files in boxes.
+
+Files are stored in the blobs directory in the boxes storage by their checksum (ie,
+`.blobs/sha256/ab/ab12...`), and the files in the boxes directories are hardlinks to these
+blobs. When a box with some content that is already present in the store is added, its files are
+replaced by links to the existing blobs, so identical content is stored only once.
+
+A blob that is not linked from any box (ie, it has only one link) can be safely removed.
+"""
+
+import os
+import re
+import errno
+from logging import getLogger
+
+from candelabra.errors import ImportException
+
+logger = getLogger(__name__)
+
+#: the algorithm used for checksums
+CHECKSUM_ALGORITHM = 'sha256'
+
+_CHECKSUM_RE = re.compile(r'^(?:(\w+):)?([0-9a-fA-F]+)$')
+
+
+def normalize_checksum(checksum):
+    """ Normalize a checksum to the `<algorithm>:<hex digest>` form
+
+    >>> normalize_checksum('AB12...')
+    'sha256:ab12...'
+
+    :raises ImportException: if the checksum is not valid or uses an unsupported algorithm
+    """
+    m = _CHECKSUM_RE.match(checksum.strip())
+    if not m:
+        raise ImportException('invalid checksum "%s"' % checksum)
+
+    algorithm, digest = (m.group(1) or CHECKSUM_ALGORITHM).lower(), m.group(2).lower()
+    if algorithm != CHECKSUM_ALGORITHM:
+        raise ImportException('unsupported checksum algorithm "%s"' % algorithm)
+    return '%s:%s' % (algorithm, digest)
+
+
+class BlobsStore(object):
+    """ A content-addressed store of files
+    """
+
+    def __init__(self, path=None):
+        """ Initialize the store
+        """
+        if not path:
+            from candelabra.boxes import BoxesStorage
+
+            path = BoxesStorage.get_blobs_root()
+        self.path = path
+
+    def get_blob_path(self, checksum):
+        """ Get the path for the blob with some :param:`checksum`
+        """
+        algorithm, digest = normalize_checksum(checksum).split(':')
+        return os.path.join(self.path, algorithm, digest[:2], digest)
+
+    def has(self, checksum):
+        """ Return True if the store has a blob with some :param:`checksum`
+        """
+        return os.path.exists(self.get_blob_path(checksum))
+
+    def add(self, filename, checksum):
+        """ Add a file to the store.
+
+        If there is a blob with the same checksum, the file is replaced by a hardlink to the blob.
+        Otherwise, the file is linked into the store.
+
+        :returns: True if the file has been deduplicated
+        """
+        blob_path = self.get_blob_path(checksum)
+        try:
+            if os.path.exists(blob_path):
+                if os.path.samefile(blob_path, filename):
+                    return False
+
+                logger.debug('... %s: found in the blobs store', os.path.basename(filename))
+                temp_filename = filename + '.link'
+                os.link(blob_path, temp_filename)
+                os.rename(temp_filename, filename)
+                return True
+            else:
+                blob_dir = os.path.dirname(blob_path)
+                if not os.path.exists(blob_dir):
+                    os.makedirs(blob_dir)
+                os.link(filename, blob_path)
+                return False
+        except OSError, e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                logger.debug('... cannot link %s: %s', filename, str(e))
+                return False
+            raise
+
+    def gc(self):
+        """ Remove the blobs that are not used by any box
+
+        :returns: the number of bytes released
+        """
+        released = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                blob_path = os.path.join(root, name)
+                st = os.stat(blob_path)
+                if st.st_nlink == 1:
+                    logger.debug('... removing unused blob %s', name)
+                    os.remove(blob_path)
+                    released += st.st_size
+        return released
+
+
+_blobs_store = None
+
+
+def blobs_store_factory():
+    global _blobs_store
+    from candelabra.boxes import BoxesStorage
+
+    if not _blobs_store or _blobs_store.path != BoxesStorage.get_blobs_root():
+        _blobs_store = BlobsStore()
+    return _blobs_store
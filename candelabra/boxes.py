@@ -6,12 +6,109 @@
 
 from logging import getLogger
 import os
+import atexit
+import re
+import json
+import time
+import shutil
+import threading
 
 from candelabra.config import config
-from candelabra.constants import CFG_BOXES_PATH
+from candelabra.constants import CFG_BOXES_PATH, CFG_BOXES_QUOTA, BOXES_DOWNLOADS_DIR, BOXES_BLOBS_DIR, BOXES_INDEX_DIR
+from candelabra.constants import BOXES_LOCKS_DIR
+from candelabra.files import atomic_write, FileLock
 
 logger = getLogger(__name__)
 
+#: the index file (in the index directory)
+INDEX_FILE = 'boxes.json'
+
+_SIZE_RE = re.compile(r'^(\d+)\s*([kmgt]?)b?$', re.IGNORECASE)
+_SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """ Parse a size, like '20G', '512m' or '1024', returning the number of bytes
+
+    >>> parse_size('2k')
+    2048
+    """
+    m = _SIZE_RE.match(str(size).strip())
+    if not m:
+        raise ValueError('invalid size "%s"' % size)
+    return int(m.group(1)) * _SIZE_UNITS[m.group(2).lower()]
+
+
+class BoxesIndex(object):
+    """ A persistent index of the boxes in the storage
+
+    The index keeps, for each box, the providers and appliances found, the checksums and the total
+    size, as well as the modification times of the directories they were obtained from. An entry is
+    valid as long as these directories have not been modified, so we can load the boxes without
+    scanning their directories.
+    """
+
+    def __init__(self, storage_path):
+        """ Initialize the index for the storage at :param:`storage_path`
+
+        The index is kept in its own directory, so updating it does not modify the storage directory.
+        """
+        self.storage_path = storage_path
+        self.path = os.path.join(storage_path, BOXES_INDEX_DIR, INDEX_FILE)
+        self.storage_mtime = None
+        self.entries = {}
+
+        index_dir = os.path.dirname(self.path)
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+    @property
+    def lock(self):
+        """ A lock for serializing updates from different processes
+        """
+        return FileLock(self.path + '.lock')
+
+    def load(self):
+        """ Load the index from disc
+        """
+        self.storage_mtime = None
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as index_file:
+                    index = json.load(index_file)
+                self.storage_mtime = index.get('storage_mtime')
+                self.entries = index.get('boxes', {})
+            except (IOError, ValueError), e:
+                logger.warning('invalid boxes index at %s: ignoring it (%s)', self.path, str(e))
+
+    def save(self):
+        """ Save the index to disc (the lock must be held)
+        """
+        index = {'storage_mtime': self.storage_mtime, 'boxes': self.entries}
+        atomic_write(self.path, json.dumps(index, indent=2, sort_keys=True))
+
+    def is_valid(self, name):
+        """ Return True if the entry for the box :param:`name` is still valid
+        """
+        entry = self.entries.get(name)
+        if not entry:
+            return False
+
+        box_path = os.path.join(self.storage_path, name)
+        try:
+            for directory, mtime in entry.get('mtimes', {}).iteritems():
+                if os.stat(os.path.join(box_path, directory)).st_mtime != mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def get_storage_mtime(self):
+        """ Get the modification time of the storage directory (it changes when boxes are added or removed)
+        """
+        return os.stat(self.storage_path).st_mtime
+
 
 class BoxesStorage(object):
     """ A storage where boxes are stored
@@ -23,12 +120,17 @@ class BoxesStorage(object):
         super(BoxesStorage, self).__init__()
 
         self.boxes = {}
+        self.touched = {}           # boxes used (and when) not recorded in the index yet
+        self.in_use = set()         # boxes needed by the current command (they are never evicted)
+        self._lock = threading.RLock()
 
         self.path = self.get_storage_root()
         if not os.path.exists(self.path):
             logger.debug('initializing boxes storage from %s', self.path)
             os.makedirs(self.path)
 
+        self.index = BoxesIndex(self.path)
+
         logger.debug('using boxes storage from %s', self.path)
         self.refresh()
 
@@ -39,6 +141,24 @@ class BoxesStorage(object):
         d = config.get_key(CFG_BOXES_PATH)
         return os.path.expandvars(d) if d else d
 
+    @staticmethod
+    def get_downloads_root():
+        """ Get the directory where downloads (and partial downloads) are kept
+        """
+        return os.path.join(BoxesStorage.get_storage_root(), BOXES_DOWNLOADS_DIR)
+
+    @staticmethod
+    def get_blobs_root():
+        """ Get the directory for the content-addressed store of box files
+        """
+        return os.path.join(BoxesStorage.get_storage_root(), BOXES_BLOBS_DIR)
+
+    @staticmethod
+    def get_box_lock(name):
+        """ Get the inter-process lock for downloading (or modifying) the box :param:`name`
+        """
+        return FileLock(os.path.join(BoxesStorage.get_storage_root(), BOXES_LOCKS_DIR, '%s.lock' % name))
+
     @staticmethod
     def get_relative_path(path):
         """ Return a path relative to the storage root
@@ -51,16 +171,46 @@ class BoxesStorage(object):
         common = os.path.commonprefix([path, BoxesStorage.get_storage_root()])
         return path[len(common):]
 
-    def get_box(self, name, url):
+    def get_box(self, name, url=None, checksum=None, version=None):
         """ Get a box instance or make it as missing
+
+        There is only one instance per box name (and version), so all the machines using a missing
+        box can share the same download task. The box is in use by the current command, so it will
+        not be evicted.
         """
         from candelabra.topology.box import BoxNode
 
-        if not name in self.boxes:
-            new_box = BoxNode(name=name, url=url)
-            new_box.missing = True
-            self.boxes[name] = new_box
-        return self.boxes[name]
+        with self._lock:
+            storage_name = BoxNode.get_storage_name(name, version)
+            if not storage_name in self.boxes:
+                new_box = BoxNode(name=name, url=url or '', checksum=checksum or '', version=version or '')
+                storage_name = new_box.storage_name     # the version could be resolved from a catalog
+                if not storage_name in self.boxes:
+                    new_box.missing = True
+                    self.boxes[storage_name] = new_box
+            else:
+                box = self.boxes[storage_name]
+                if box.missing:
+                    box.download_url = box.download_url or url or ''
+                    box.download_checksum = box.download_checksum or checksum or None
+            self.in_use.add(storage_name)
+            return self.boxes[storage_name]
+
+    def use_box(self, name):
+        """ Record that the box :param:`name` (the name in the storage) is needed by the current command,
+        so it is not evicted
+        """
+        with self._lock:
+            self.in_use.add(name)
+
+    def find_box_by_checksum(self, checksum):
+        """ Find a box with some checksum, or None if there is no box with this checksum
+        """
+        with self._lock:
+            for box in self.boxes.itervalues():
+                if box.checksum == checksum and not box.missing:
+                    return box
+        return None
 
     def has_box(self, name):
         """ Return True if the storage has a box with a given name
@@ -69,28 +219,241 @@ class BoxesStorage(object):
 
     def refresh(self):
         """ Refresh the list of boxes
+
+        Boxes are loaded from the index, and only the boxes that have been modified since they
+        were indexed are scanned again. Missing boxes (ie, being downloaded) are kept.
         """
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
         from candelabra.topology.box import BoxNode
 
-        self.boxes = {}
+        boxes = dict((name, box) for name, box in self.boxes.iteritems() if box.missing)
         logger.debug('refreshing list of boxes at the storage')
-        for entry in os.listdir(self.path):
-            fullpath = os.path.abspath(os.path.join(self.path, entry))
-            if os.path.isdir(fullpath):
+        with self.index.lock:
+            self.index.load()
+            modified = False
+
+            storage_mtime = self.index.get_storage_mtime()
+            if storage_mtime != self.index.storage_mtime:
+                logger.debug('... storage modified: listing boxes')
+                names = [entry for entry in os.listdir(self.path)
+                         if not entry.startswith('.') and os.path.isdir(os.path.join(self.path, entry))]
+                self.index.storage_mtime = storage_mtime
+                modified = True
+            else:
+                names = self.index.entries.keys()
+
+            for entry in names:
+                fullpath = os.path.abspath(os.path.join(self.path, entry))
+                if self.index.is_valid(entry):
+                    boxes[entry] = BoxNode(name=entry, path=fullpath, _index_entry=self.index.entries[entry])
+                    continue
+
                 logger.debug('... checking directory /%s', entry)
                 box = BoxNode(name=entry, path=fullpath)
-                if box.load():
+                if not box.missing and (box.loaded or box.load()):
                     logger.debug('...... box loaded from /%s', entry)
-                    self.boxes[entry] = box
+                    boxes[entry] = box
+                    self._set_index_entry(box)
+                    modified = True
+                elif entry in self.index.entries:
+                    del self.index.entries[entry]
+                    modified = True
 
+            for entry in set(self.index.entries) - set(names):
+                logger.debug('... box %s has been removed', entry)
+                del self.index.entries[entry]
+                modified = True
+
+            if modified:
+                self.index.save()
+
+        self.boxes = boxes
         logger.debug('... %d boxes loaded', len(self.boxes))
 
+    def _set_index_entry(self, box):
+        """ Set the index entry for a box, keeping the last time it was used (the index lock must be held)
+        """
+        entry = box.get_index_entry()
+        previous_entry = self.index.entries.get(box.storage_name, {})
+        entry['last_used'] = previous_entry.get('last_used', time.time())
+        self.index.entries[box.storage_name] = entry
+
+    def get_index_entry(self, name):
+        """ Get the entry in the index for the box :param:`name`, or None if there is no valid entry
+        """
+        self.index.load()
+        return self.index.entries[name] if self.index.is_valid(name) else None
+
+    def update_box(self, box):
+        """ Add (or update) a box in the storage, after it has been imported
+        """
+        if box.load():
+            with self._lock:
+                with self.index.lock:
+                    self.index.load()
+                    self._set_index_entry(box)
+                    self.index.save()
+                self.boxes[box.storage_name] = box
+
+    def touch_box(self, name):
+        """ Record that the box :param:`name` has been used now
+
+        The index is not updated for every use: boxes used are recorded with :meth:`save_touched`,
+        once per command (or before evicting boxes).
+        """
+        self.touched[name] = time.time()
+
+    def save_touched(self):
+        """ Record in the index the last time the boxes have been used
+        """
+        if not self.touched or not os.path.exists(self.index.path):
+            self.touched = {}
+            return
+
+        with self.index.lock:
+            self.index.load()
+            for name, last_used in self.touched.iteritems():
+                if name in self.index.entries:
+                    entry = self.index.entries[name]
+                    entry['last_used'] = max(last_used, entry.get('last_used', 0))
+            self.index.save()
+        self.touched = {}
+
+    def delete_box(self, name, gc_blobs=True):
+        """ Delete a box from the storage
+
+        :returns: False if the box could not be deleted because it is being used by another process
+        """
+        lock = BoxesStorage.get_box_lock(name)
+        if not lock.acquire(blocking=False):
+            logger.warning('box "%s" is being used by another process: not removed', name)
+            return False
+
+        try:
+            box_path = os.path.join(self.path, name)
+            logger.info('removing box "%s"', name)
+            with self.index.lock:
+                self.index.load()
+                self.index.entries.pop(name, None)
+                if os.path.exists(box_path):
+                    shutil.rmtree(box_path)
+                self.index.save()
+            with self._lock:
+                self.boxes.pop(name, None)
+        finally:
+            lock.release()
+
+        if gc_blobs:
+            self.gc_blobs()
+        return True
+
+    def gc_blobs(self):
+        """ Remove the blobs that are not used by any box
+        """
+        from candelabra.blobs import blobs_store_factory
+
+        released = blobs_store_factory().gc()
+        logger.debug('... %d bytes released from the blobs store', released)
+
+    #####################
+    # quota and garbage collection
+    #####################
+
+    @staticmethod
+    def get_quota():
+        """ Get the storage quota (in bytes), or 0 if there is no quota
+        """
+        return parse_size(config.get_key(CFG_BOXES_QUOTA))
+
+    def get_used_space(self, names=None):
+        """ Get the space used in the disc by the boxes in the storage (or by the boxes :param:`names`), in bytes
+
+        Files shared by several boxes (hardlinks to the same blob) are counted once.
+        """
+        inodes = {}
+        for name, entry in self.index.entries.iteritems():
+            if names is None or name in names:
+                # entries without inodes are from older versions
+                inodes.update(entry.get('inodes') or {name: entry.get('physical_size', entry.get('size', 0))})
+        return sum(inodes.itervalues())
+
+    def gc(self, target=None, dry_run=False, exclude=None):
+        """ Remove the least recently used boxes that are not used by any registered topology, until
+        the space used by the boxes is not greater than :param:`target` (or all the unused boxes if
+        no target is provided)
+
+        Boxes in :param:`exclude` and boxes in use by the current command are not removed.
+
+        :returns: the list of boxes removed
+        """
+        with self._lock:
+            return self._gc(target, dry_run, exclude)
+
+    def _gc(self, target, dry_run, exclude):
+        from candelabra.registry import registry_factory
+
+        self.save_touched()
+        self._refresh()
+        used_space = self.get_used_space()
+        registry = registry_factory()
+        registry.load()
+        referenced = registry.get_boxes() | self.in_use | set(exclude or [])
+
+        candidates = [(entry.get('last_used', 0), name) for name, entry in self.index.entries.iteritems()
+                      if name not in referenced]
+
+        removed = []
+        kept = set(self.index.entries)
+        for last_used, name in sorted(candidates):
+            if target is not None and used_space <= target:
+                break
+
+            # the space released: the files not shared with the boxes kept
+            size = used_space - self.get_used_space(kept - {name})
+            logger.info('... evicting box "%s" (%d Mb, last used %s)', name, size / (1024 * 1024),
+                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_used)))
+            if dry_run or self.delete_box(name, gc_blobs=False):
+                removed.append(name)
+                kept.discard(name)
+                used_space -= size
+
+        if removed and not dry_run:
+            self.gc_blobs()
+
+        if target is not None and used_space > target:
+            logger.warning('boxes use %d Mb (quota: %d Mb), but no more boxes can be removed',
+                           used_space / (1024 * 1024), target / (1024 * 1024))
+        return removed
+
+    def ensure_space(self, size, exclude=None):
+        """ Make sure there is space for :param:`size` more bytes in the storage, removing unused boxes
+        (but not the boxes in :param:`exclude`) if the quota would be exceeded
+        """
+        quota = self.get_quota()
+        with self._lock:
+            if quota > 0 and self.get_used_space() + size > quota:
+                logger.info('storage quota would be exceeded: removing unused boxes')
+                self._gc(max(quota - size, 0), False, exclude)
+
 
 _boxes_storage = None
 
 
 def boxes_storage_factory():
     global _boxes_storage
-    if not _boxes_storage:
+    if not _boxes_storage or _boxes_storage.path != BoxesStorage.get_storage_root():
+        if _boxes_storage:
+            _boxes_storage.save_touched()
         _boxes_storage = BoxesStorage()
-    return _boxes_storage
\ No newline at end of file
+    return _boxes_storage
+
+
+@atexit.register
+def save_touched_boxes():
+    """ Record the boxes used in the index (ie, at exit)
+    """
+    if _boxes_storage:
+        _boxes_storage.save_touched()
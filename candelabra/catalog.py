@@ -0,0 +1,191 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Vagrant-style catalogs of boxes.
+
+A catalog is a JSON document (usually at a `.json` URL) that describes all the versions of a box,
+and where the box can be downloaded from for each provider:
+
+.. code-block:: json
+
+    {
+        "name": "some/box",
+        "versions": [{
+            "version": "1.0.1",
+            "providers": [{
+                "name": "virtualbox",
+                "url": "http://some.server/box-1.0.1.box",
+                "checksum_type": "sha256",
+                "checksum": "5f1c..."
+            }]
+        }]
+    }
+
+Catalogs are cached in the boxes storage, and revalidated with conditional requests (with the
+`ETag` and `Last-Modified` received), so checking for new versions of a box is cheap.
+"""
+
+import os
+import json
+import time
+import hashlib
+from distutils.version import LooseVersion
+from logging import getLogger
+
+from candelabra.config import config
+from candelabra.constants import CFG_CONNECT_TIMEOUT, CFG_DOWNLOAD_TIMEOUT, CFG_CATALOG_TTL, BOXES_CATALOGS_DIR
+from candelabra.errors import ImportException
+from candelabra.files import atomic_write
+
+logger = getLogger(__name__)
+
+#: extension of the catalogs URLs
+CATALOG_EXTENSION = '.json'
+
+
+def is_catalog_url(url):
+    """ Return True if :param:`url` is the URL of a catalog (instead of the URL of a box file)
+    """
+    return bool(url) and url.split('?')[0].lower().endswith(CATALOG_EXTENSION)
+
+
+class BoxCatalog(object):
+    """ A catalog of versions of a box
+    """
+
+    def __init__(self, url):
+        """ Initialize the catalog at :param:`url`
+        """
+        self.url = url
+        self.metadata = {}
+        self.etag = None
+        self.last_modified = None
+        self.checked = 0
+
+    @property
+    def cache_filename(self):
+        """ The file where the catalog is cached
+        """
+        from candelabra.boxes import BoxesStorage
+
+        return os.path.join(BoxesStorage.get_storage_root(), BOXES_CATALOGS_DIR,
+                            '%s.json' % hashlib.sha1(self.url).hexdigest())
+
+    def load_cached(self):
+        """ Load the catalog from the cache, returning False if it is not cached
+        """
+        if not os.path.exists(self.cache_filename):
+            return False
+
+        try:
+            with open(self.cache_filename) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError), e:
+            logger.warning('invalid cached catalog for %s: %s', self.url, str(e))
+            return False
+
+        self.metadata = cached.get('metadata', {})
+        self.etag = cached.get('etag')
+        self.last_modified = cached.get('last_modified')
+        self.checked = cached.get('checked', 0)
+        return True
+
+    def save_cached(self):
+        """ Save the catalog in the cache
+        """
+        cached = {
+            'url': self.url,
+            'metadata': self.metadata,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'checked': self.checked,
+        }
+        atomic_write(self.cache_filename, json.dumps(cached, indent=2, sort_keys=True))
+
+    def refresh(self, ttl=None):
+        """ Load the catalog, revalidating the cached copy if it has not been checked in the last
+        :param:`ttl` seconds.
+
+        If the server cannot be reached, the cached copy is used.
+
+        :returns: True if the catalog has changed in the server
+        """
+        import requests
+
+        ttl = float(ttl if ttl is not None else config.get_key(CFG_CATALOG_TTL))
+        cached = self.load_cached()
+        if cached and time.time() - self.checked < ttl:
+            logger.debug('using cached catalog for %s', self.url)
+            return False
+
+        headers = {}
+        if cached and self.etag:
+            headers['If-None-Match'] = self.etag
+        if cached and self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        logger.debug('checking catalog at %s', self.url)
+        timeouts = (float(config.get_key(CFG_CONNECT_TIMEOUT)), float(config.get_key(CFG_DOWNLOAD_TIMEOUT)))
+        try:
+            r = requests.get(self.url, headers=headers, timeout=timeouts)
+        except requests.RequestException, e:
+            if cached:
+                logger.warning('could not check catalog at %s (%s): using cached copy', self.url, str(e))
+                return False
+            raise ImportException('could not get catalog at %s: %s' % (self.url, str(e)))
+
+        changed = False
+        if r.status_code == 304 and cached:
+            logger.debug('... catalog has not changed')
+        elif r.status_code == 200:
+            try:
+                self.metadata = r.json()
+            except ValueError, e:
+                raise ImportException('invalid catalog at %s: %s' % (self.url, str(e)))
+            self.etag = r.headers.get('etag')
+            self.last_modified = r.headers.get('last-modified')
+            changed = True
+        else:
+            raise ImportException('could not get catalog at %s: HTTP error %d' % (self.url, r.status_code))
+
+        self.checked = time.time()
+        self.save_cached()
+        return changed
+
+    def get_version(self, version=None, provider='virtualbox'):
+        """ Get a version of the box for a :param:`provider` (the latest one if no :param:`version` is provided)
+
+        :returns: a dictionary with the `version`, `url` and `checksum` (or None)
+        :raises ImportException: if the version is not found in the catalog
+        """
+        candidates = []
+        for version_entry in self.metadata.get('versions', []):
+            if version and str(version_entry.get('version')) != str(version):
+                continue
+            for provider_entry in version_entry.get('providers', []):
+                if provider_entry.get('name') == provider and provider_entry.get('url'):
+                    candidates.append((LooseVersion(str(version_entry.get('version'))), provider_entry))
+
+        if not candidates:
+            raise ImportException('no %s box%s found in catalog %s' % (provider,
+                                                                      ' with version %s' % version if version else '',
+                                                                      self.url))
+
+        box_version, provider_entry = max(candidates, key=lambda candidate: candidate[0])
+
+        checksum = None
+        if provider_entry.get('checksum'):
+            checksum_type = provider_entry.get('checksum_type', 'sha256').lower()
+            if checksum_type == 'sha256':
+                checksum = 'sha256:' + provider_entry['checksum'].lower()
+            else:
+                logger.warning('unsupported checksum type "%s" in catalog %s: ignored', checksum_type, self.url)
+
+        return {
+            'version': str(box_version),
+            'url': provider_entry['url'],
+            'checksum': checksum,
+        }
@@ -0,0 +1,5 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
@@ -0,0 +1,147 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+from logging import getLogger
+
+from candelabra.plugins import CommandPlugin
+from candelabra.errors import UnsupportedCommandException
+
+logger = getLogger(__name__)
+
+
+class BoxesCommandPlugin(CommandPlugin):
+    NAME = 'boxes'
+    DESCRIPTION = "manage the boxes storage."
+
+    def argparser(self, parser):
+        """ Parse arguments
+        """
+        subparsers = parser.add_subparsers(help='sub-commands available for boxes',
+                                           dest='boxes_command')
+
+        # gc
+        parser_gc = subparsers.add_parser('gc',
+                                          help='remove the least recently used boxes not used by any topology')
+        parser_gc.add_argument('--all',
+                               dest='all',
+                               default=False,
+                               action='store_true',
+                               help='remove all the unused boxes, even if the quota is not exceeded')
+        parser_gc.add_argument('--dry-run',
+                               dest='dry_run',
+                               default=False,
+                               action='store_true',
+                               help='only show the boxes that would be removed')
+
+        # pool
+        parser_pool = subparsers.add_parser('pool',
+                                            help='fill the pool of pre-created machines for a box')
+        parser_pool.add_argument('box',
+                                 help='the box name')
+        parser_pool.add_argument('--provider',
+                                 dest='provider',
+                                 default=None,
+                                 help='the provider of the machines')
+        parser_pool.add_argument('--size',
+                                 dest='size',
+                                 default=None,
+                                 type=int,
+                                 help='number of machines in the pool')
+        parser_pool.add_argument('--clone-mode',
+                                 dest='clone_mode',
+                                 default=None,
+                                 choices=['import', 'linked', 'reflink'],
+                                 help='how the machines in the pool are created')
+
+        # serve
+        parser_serve = subparsers.add_parser('serve',
+                                             help='serve the boxes in the storage to other hosts')
+        parser_serve.add_argument('--address',
+                                  dest='address',
+                                  default='0.0.0.0',
+                                  help='address where the server will listen')
+        parser_serve.add_argument('--port',
+                                  dest='port',
+                                  default=None,
+                                  type=int,
+                                  help='port where the server will listen')
+
+    def run(self, args, command):
+        """ Run the command
+        """
+        logger.info('running command "%s"', command)
+
+        if args.boxes_command == 'gc':
+            self.do_boxes_gc(args)
+        elif args.boxes_command == 'pool':
+            self.do_boxes_pool(args)
+        elif args.boxes_command == 'serve':
+            self.do_boxes_serve(args)
+        else:
+            raise UnsupportedCommandException('unknown subcommand "%s"' % args.boxes_command)
+
+    #####################
+    # tasks
+    #####################
+
+    def do_boxes_gc(self, args):
+        """ Remove unused boxes
+        """
+        from candelabra.boxes import boxes_storage_factory
+
+        boxes_storage = boxes_storage_factory()
+        quota = boxes_storage.get_quota()
+        target = quota if quota > 0 and not args.all else None
+
+        removed = boxes_storage.gc(target=target, dry_run=args.dry_run)
+        if not removed:
+            logger.info('no boxes removed')
+        elif args.dry_run:
+            logger.info('%d boxes would be removed: %s', len(removed), ', '.join(removed))
+        else:
+            logger.info('%d boxes removed: %s', len(removed), ', '.join(removed))
+        logger.info('boxes storage usage: %d Mb', boxes_storage.get_used_space() / (1024 * 1024))
+
+    def do_boxes_pool(self, args):
+        """ Fill the pool of pre-created machines for a box
+        """
+        from candelabra.boxes import boxes_storage_factory
+        from candelabra.config import config
+        from candelabra.constants import CFG_DEFAULT_PROVIDER, CFG_VIRTUALBOX_POOL_SIZE
+        from candelabra.errors import MissingBoxException
+
+        provider = args.provider if args.provider else config.get_key(CFG_DEFAULT_PROVIDER)
+        size = args.size if args.size is not None else int(config.get_key(CFG_VIRTUALBOX_POOL_SIZE))
+
+        box = boxes_storage_factory().boxes.get(args.box)
+        appliance = box.get_appliance(provider) if box else None
+        if not appliance:
+            raise MissingBoxException('box "%s" does not have a %s appliance' % (args.box, provider))
+        if not hasattr(appliance, 'get_pool'):
+            raise UnsupportedCommandException('the %s provider does not support pools' % provider)
+
+        created = appliance.get_pool(box, clone_mode=args.clone_mode).fill(size)
+        logger.info('%d machines added to the pool for box "%s"', created, args.box)
+
+    def do_boxes_serve(self, args):
+        """ Serve the boxes in the storage, so other hosts can use this host as a mirror
+        """
+        from candelabra.boxes import boxes_storage_factory
+        from candelabra.config import config
+        from candelabra.constants import CFG_MIRROR_PORT
+        from candelabra.mirror import MirrorServer
+
+        port = args.port if args.port else int(config.get_key(CFG_MIRROR_PORT))
+        server = MirrorServer(boxes_storage_factory(), address=args.address, port=port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('stopping server')
+        finally:
+            server.stop()
+
+
+command = BoxesCommandPlugin()
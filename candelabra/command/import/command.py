@@ -5,10 +5,17 @@
 #
 
 from logging import getLogger
+import Queue
+import threading
+import time
+
+import yaml
 
 from candelabra.plugins import CommandPlugin
-from candelabra.boxes import boxes_storage_factory
-from candelabra.errors import ImportException
+from candelabra.blobs import normalize_checksum
+from candelabra.boxes import boxes_storage_factory, parse_size
+from candelabra.downloader import BandwidthLimiter
+from candelabra.errors import ImportException, CandelabraException
 
 
 logger = getLogger(__name__)
@@ -37,12 +44,31 @@ class ImportCommandPlugin(CommandPlugin):
                             default=None,
                             type=str,
                             help='a URL where the input image/box is imported from')
+        parser.add_argument('--manifest',
+                            dest='manifest',
+                            default=None,
+                            type=str,
+                            help='a YAML file with a list of boxes (with "name", "url" and "checksum") to import')
+        parser.add_argument('-j',
+                            '--jobs',
+                            dest='jobs',
+                            default=4,
+                            type=int,
+                            help='number of boxes imported concurrently (with --manifest)')
+        parser.add_argument('--max-bandwidth',
+                            dest='max_bandwidth',
+                            default=None,
+                            type=str,
+                            help='maximum bandwidth used for all the downloads, in bytes per second (ie, 10M)')
 
     def run(self, args, command):
         """ Run the command
         """
         logger.info('running command "%s"', command)
 
+        if args.manifest:
+            return self.do_import_manifest(args)
+
         boxes_storage = boxes_storage_factory()
         if args.box_name is None:
             raise ImportException('no name provided for the box')
@@ -52,7 +78,118 @@ class ImportCommandPlugin(CommandPlugin):
             raise ImportException('no URL provided for importing the box "%s"', args.box_name)
 
         box = boxes_storage.get_box(name=args.box_name, url=args.box_url)
+        if args.max_bandwidth:
+            box.limiter = BandwidthLimiter(parse_size(args.max_bandwidth))
         box.do_download()
 
+    #####################
+    # manifests
+    #####################
+
+    @staticmethod
+    def load_manifest(manifest_file):
+        """ Load a manifest file, returning a list of boxes (as dictionaries with `name`, `url` and `checksum`)
+
+        The manifest must be a list of boxes, or a dictionary with a `boxes` list:
+
+        .. code-block:: yaml
+
+            boxes:
+                - name:         centos64
+                  url:          http://some.server/centos64.box
+                  checksum:     sha256:5f1c...
+        """
+        try:
+            with open(manifest_file) as manifest:
+                y = yaml.safe_load(manifest)
+        except (IOError, yaml.YAMLError), e:
+            raise ImportException('could not load manifest %s: %s' % (manifest_file, str(e)))
+
+        if isinstance(y, dict):
+            y = y.get('boxes', [])
+        if not isinstance(y, list):
+            raise ImportException('invalid manifest %s: no list of boxes found' % manifest_file)
+
+        boxes = []
+        for entry in y:
+            if not isinstance(entry, dict) or not entry.get('name') or not entry.get('url'):
+                raise ImportException('invalid entry in manifest %s: "%s"' % (manifest_file, entry))
+            checksum = entry.get('checksum')
+            boxes.append({
+                'name': str(entry['name']),
+                'url': str(entry['url']),
+                'checksum': normalize_checksum(str(checksum)) if checksum else None,
+            })
+        return boxes
+
+    def do_import_manifest(self, args):
+        """ Import all the boxes in a manifest, running several downloads concurrently
+
+        :returns: a dictionary with the results for each box
+        """
+        boxes = self.load_manifest(args.manifest)
+        boxes_storage = boxes_storage_factory()
+        limiter = BandwidthLimiter(parse_size(args.max_bandwidth)) if args.max_bandwidth else None
+
+        results = {}
+        pending = Queue.Queue()
+        for entry in boxes:
+            # the boxes in the manifest are not evicted for importing other boxes in the manifest
+            boxes_storage.use_box(entry['name'])
+
+            existing_box = boxes_storage.boxes.get(entry['name'])
+            if existing_box and not existing_box.missing:
+                if not entry['checksum'] or existing_box.checksum == entry['checksum']:
+                    logger.info('box "%s" is already present: skipping', entry['name'])
+                    continue
+                logger.error('box "%s" is already present with a different checksum (%s)',
+                             entry['name'], existing_box.checksum)
+                results[entry['name']] = {'error': 'already present with checksum %s, but %s was expected' %
+                                                   (existing_box.checksum, entry['checksum'])}
+                continue
+            pending.put(entry)
+
+        def worker():
+            while True:
+                try:
+                    entry = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                box = boxes_storage.get_box(name=entry['name'], url=entry['url'], checksum=entry['checksum'])
+                box.limiter = limiter
+                start = time.time()
+                try:
+                    box.do_download()
+                except CandelabraException, e:
+                    logger.error('could not import box "%s": %s', entry['name'], str(e))
+                    results[entry['name']] = {'error': str(e)}
+                else:
+                    elapsed = max(time.time() - start, 0.001)
+                    results[entry['name']] = {'bytes': box.transferred, 'time': elapsed}
+
+        num_jobs = max(1, min(args.jobs, pending.qsize()))
+        logger.info('importing %d boxes (%d concurrent downloads)', pending.qsize(), num_jobs)
+        threads = [threading.Thread(target=worker) for _ in xrange(num_jobs)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join with a timeout, so we can still get a KeyboardInterrupt
+            while thread.is_alive():
+                thread.join(0.5)
+
+        for name, result in sorted(results.iteritems()):
+            if 'error' in result:
+                logger.info('%s: failed (%s)', name, result['error'])
+            else:
+                logger.info('%s: %d Mb in %.1f secs (%.2f Mb/s)', name, result['bytes'] / (1024 * 1024),
+                            result['time'], result['bytes'] / result['time'] / (1024 * 1024))
+
+        failed = [name for name, result in results.iteritems() if 'error' in result]
+        if failed:
+            raise ImportException('could not import %d boxes: %s' % (len(failed), ', '.join(sorted(failed))))
+        return results
+
 
 command = ImportCommandPlugin()
@@ -5,6 +5,7 @@
 #
 
 from logging import getLogger
+import time
 
 from candelabra.plugins import CommandPlugin
 from candelabra.errors import UnsupportedCommandException
@@ -52,6 +53,11 @@ class ShowCommandPlugin(CommandPlugin):
                                    '--verbose',
                                    action='store_true',
                                    help='verbose display')
+        parser_status.add_argument('--fresh',
+                                   dest='fresh',
+                                   default=False,
+                                   action='store_true',
+                                   help='ignore any cached machines state and query the provider')
 
     def run(self, args, command):
         """ Run the command
@@ -60,6 +66,8 @@ class ShowCommandPlugin(CommandPlugin):
 
         if args.show_command == 'boxes':
             self.do_show_boxes(args)
+        elif args.show_command == 'topologies':
+            self.do_show_topologies(args)
         elif args.show_command == 'status':
             self.do_show_status(args)
         else:
@@ -72,11 +80,41 @@ class ShowCommandPlugin(CommandPlugin):
     def do_show_status(self, args):
         """ Show the status of the machines in the topology
         """
-        topology = self.run_with_topology(args, args.topology, save_state=False)
+        topology = self.run_with_topology(args, args.topology, save_state=False, fresh=args.fresh)
         for machine in topology.machines:
             if not machine.is_global:
+                facts = machine.get_facts(fresh=args.fresh)
                 logger.info('machine: %s', machine.cfg_name)
                 logger.info('... state: %d [%s]', int(machine.state), machine.state_str)
+                if args.verbose:
+                    for fact in sorted(facts):
+                        if fact != 'state':
+                            logger.info('... %s: %s', fact, facts[fact])
+
+        # keep the facts we have just queried in the state, so next time we do not have to query them
+        if topology.state.persisted and any(m.facts_changed for m in topology.machines):
+            topology.state.save()
+
+    def do_show_topologies(self, args):
+        """ Show all the topologies created in this host
+        """
+        from candelabra.registry import registry_factory
+
+        registry = registry_factory()
+        for path, entry in sorted(registry.topologies.iteritems()):
+            resources = entry.get('resources', {})
+            logger.info('topology: %s', path)
+            logger.info('... last command: %s (%s)', entry.get('last_command'),
+                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.get('updated', 0))))
+            logger.info('... machines:%d CPUs:%d memory:%d Mb',
+                        resources.get('machines', 0), resources.get('cpus', 0), resources.get('memory', 0))
+            if args.verbose:
+                for machine in entry.get('machines', []):
+                    logger.info('...... %s [UUID:%s box:%s]', machine['name'], machine['uuid'], machine['box'])
+
+        totals = registry.get_totals()
+        logger.info('total: %d topologies, %d machines, %d CPUs, %d Mb of memory',
+                    totals['topologies'], totals['machines'], totals['cpus'], totals['memory'])
 
     def do_show_boxes(self, args):
         """ Show all the boxes in the system
@@ -84,9 +122,14 @@ class ShowCommandPlugin(CommandPlugin):
         from candelabra.boxes import boxes_storage_factory
 
         boxes_storage = boxes_storage_factory()
-        for box_name, box in boxes_storage.boxes.iteritems():
-            logger.info('box info:')
-            logger.info('%s = %s', box_name, box)
+        for box_name, box in sorted(boxes_storage.boxes.iteritems()):
+            entry = boxes_storage.index.entries.get(box_name, {})
+            logger.info('box: %s', box_name)
+            logger.info('... providers:%s size:%d Mb (%d Mb in disc)', ','.join(sorted(box.appliances)),
+                        entry.get('size', 0) / (1024 * 1024), entry.get('physical_size', 0) / (1024 * 1024))
+            if args.verbose:
+                logger.info('... path: %s', box.path)
+                logger.info('... checksum: %s', box.checksum)
 
 
 command = ShowCommandPlugin()
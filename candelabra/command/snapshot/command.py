@@ -0,0 +1,64 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+from logging import getLogger
+
+from candelabra.plugins import CommandPlugin
+from candelabra.errors import UnsupportedCommandException
+
+logger = getLogger(__name__)
+
+
+class SnapshotCommandPlugin(CommandPlugin):
+    NAME = 'snapshot'
+    DESCRIPTION = "save live snapshots of the machines, so they can be restored with 'up --from-snapshot'."
+
+    def argparser(self, parser):
+        """ Parse arguments
+        """
+        subparsers = parser.add_subparsers(help='sub-commands available for snapshots',
+                                           dest='snapshot_command')
+
+        # save
+        parser_save = subparsers.add_parser('save',
+                                            help='take a snapshot of the running machines')
+        parser_save.add_argument('name',
+                                 help='the snapshot name')
+        parser_save.add_argument('-t',
+                                 '--topology',
+                                 metavar='TOPOLOGY',
+                                 dest='topology',
+                                 type=str,
+                                 default=None,
+                                 help='the machine(s) definition(s) file(s)')
+
+        # delete
+        parser_delete = subparsers.add_parser('delete',
+                                              help='delete a snapshot of the machines')
+        parser_delete.add_argument('name',
+                                   help='the snapshot name')
+        parser_delete.add_argument('-t',
+                                   '--topology',
+                                   metavar='TOPOLOGY',
+                                   dest='topology',
+                                   type=str,
+                                   default=None,
+                                   help='the machine(s) definition(s) file(s)')
+
+    def run(self, args, command):
+        """ Run the command
+        """
+        logger.info('running command "%s"', command)
+
+        if args.snapshot_command == 'save':
+            self.run_with_topology(args, args.topology, command='snapshot_save', command_args={'name': args.name})
+        elif args.snapshot_command == 'delete':
+            self.run_with_topology(args, args.topology, command='snapshot_delete', command_args={'name': args.name})
+        else:
+            raise UnsupportedCommandException('unknown subcommand "%s"' % args.snapshot_command)
+
+
+command = SnapshotCommandPlugin()
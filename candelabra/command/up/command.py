@@ -28,11 +28,18 @@ class UpCommandPlugin(CommandPlugin):
         parser.add_argument('--timeout',
                             type=int,
                             help='timeout for the provision')
+        parser.add_argument('--from-snapshot',
+                            metavar='NAME',
+                            dest='from_snapshot',
+                            type=str,
+                            default=None,
+                            help='create the machines from a snapshot (see the "snapshot" command)')
 
     def run(self, args, command):
         """ Run the command
         """
-        self.run_with_topology(args, args.topology, command)
+        command_args = {'from_snapshot': args.from_snapshot} if args.from_snapshot else None
+        self.run_with_topology(args, args.topology, command, command_args=command_args)
 
 
 command = UpCommandPlugin()
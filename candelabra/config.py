@@ -106,6 +106,14 @@ class CandelabraConfig(object):
         else:
             return self.get(k[0], fallback=default) if self.config else default
 
+    def get_boolean_key(self, k):
+        """ Get a boolean configuration key
+        """
+        v = self.get_key(k)
+        if isinstance(v, basestring):
+            return v.strip().lower() in ('1', 'yes', 'true', 'on')
+        return bool(v)
+
 
 config = CandelabraConfig()
 
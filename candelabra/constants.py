@@ -63,6 +63,24 @@ DEFAULT_BOXES_PATH = {
     'linux2': DEFAULT_BASE_PATH[sys.platform] + 'boxes/',
 }
 
+# directory (in the boxes path) where partial downloads are kept
+BOXES_DOWNLOADS_DIR = '.downloads'
+
+# directory (in the boxes path) for the content-addressed store of box files
+BOXES_BLOBS_DIR = '.blobs'
+
+# file (in each box directory) with the checksums of the box and its files
+BOX_MANIFEST_FILE = '.box.json'
+
+# directory (in the boxes path) for the index of boxes
+BOXES_INDEX_DIR = '.index'
+
+# directory (in the boxes path) for the locks used for downloading boxes
+BOXES_LOCKS_DIR = '.locks'
+
+# directory (in the boxes path) where boxes catalogs are cached
+BOXES_CATALOGS_DIR = '.catalogs'
+
 # default logs path
 DEFAULT_LOGS_PATH = {
     'darwin': '$HOME/Library/Logs/',
@@ -99,6 +117,12 @@ CFG_DEFAULT_PROVIDER = (DEFAULT_CFG_SECTION, "default_provider", DEFAULT_PROVIDE
 # boxes path
 CFG_BOXES_PATH = (DEFAULT_CFG_SECTION, "boxes_path", DEFAULT_BOXES_PATH[sys.platform])
 
+# time (in seconds) a cached box catalog is used before checking it again in the server
+CFG_CATALOG_TTL = (DEFAULT_CFG_SECTION, "catalog_ttl", 300)
+
+# maximum space used by the boxes in the storage (ie, '20G', '500M' or a number of bytes; 0 means no limit)
+CFG_BOXES_QUOTA = (DEFAULT_CFG_SECTION, "boxes_quota", 0)
+
 # log file
 CFG_LOG_FILE = (DEFAULT_CFG_SECTION_LOGGING_FILE, "file", DEFAULT_LOGS_PATH[sys.platform] + '/candelabra.log')
 
@@ -117,12 +141,65 @@ CFG_MACHINE_UPDOWN_TIMEOUT = (DEFAULT_CFG_SECTION, "updown_timeout", 30)
 # machine commands timeout (in seconds)
 CFG_MACHINE_COMMANDS_TIMEOUT = (DEFAULT_CFG_SECTION, "commands_timeout", 10)
 
+# time the runtime facts of a machine (state, IPs, etc) are cached (in seconds)
+CFG_FACTS_TTL = (DEFAULT_CFG_SECTION, "facts_ttl", 30)
+
 # download timeout
 CFG_DOWNLOAD_TIMEOUT = (DEFAULT_CFG_SECTION_DOWNLOADER, "download_timeout", 120)
 
 # download timeout
 CFG_CONNECT_TIMEOUT = (DEFAULT_CFG_SECTION_DOWNLOADER, "connect_timeout", 60)
 
+# number of times we retry a failed download (resuming it when possible)
+CFG_DOWNLOAD_RETRIES = (DEFAULT_CFG_SECTION_DOWNLOADER, "retries", 3)
+
+# maximum number of concurrent connections used for downloading a file
+CFG_DOWNLOAD_CONNECTIONS = (DEFAULT_CFG_SECTION_DOWNLOADER, "connections", 4)
+
+# size of the chunks we read from the network (in bytes)
+CFG_DOWNLOAD_CHUNK_SIZE = (DEFAULT_CFG_SECTION_DOWNLOADER, "chunk_size", 4 * 1024 * 1024)
+
+# files smaller than this (in bytes) are downloaded with a single connection
+CFG_DOWNLOAD_SEGMENT_MIN_SIZE = (DEFAULT_CFG_SECTION_DOWNLOADER, "segment_min_size", 64 * 1024 * 1024)
+
+# extract boxes while they are being downloaded, without storing them in the disc
+CFG_DOWNLOAD_STREAMING = (DEFAULT_CFG_SECTION_DOWNLOADER, "streaming", False)
+
+# mirrors (ie, other hosts running 'candelabra boxes serve') where boxes are looked for before downloading them
+CFG_DOWNLOAD_MIRRORS = (DEFAULT_CFG_SECTION_DOWNLOADER, "mirrors", '')
+
+# timeout (in seconds) for checking if mirrors are reachable
+CFG_MIRRORS_TIMEOUT = (DEFAULT_CFG_SECTION_DOWNLOADER, "mirrors_timeout", 2)
+
+# default port for serving boxes
+CFG_MIRROR_PORT = (DEFAULT_CFG_SECTION_DOWNLOADER, "mirror_port", 8472)
+
+# how VirtualBox machines are created from boxes: 'import' (a full import of the OVF for each machine),
+# 'linked' (linked clones of a master VM, imported once per box) or 'reflink' (an import where disks are
+# cloned from the box in copy-on-write filesystems)
+CFG_VIRTUALBOX_CLONE_MODE = (DEFAULT_CFG_SECTION_VIRTUALBOX, "clone_mode", 'import')
+
+# number of stopped VirtualBox machines kept ready for every box (0 disables the warm pools)
+CFG_VIRTUALBOX_POOL_SIZE = (DEFAULT_CFG_SECTION_VIRTUALBOX, "pool_size", 0)
+
+# what to do when the preflight checks find there are not enough resources for a command: 'fail', 'warn' or 'off'
+CFG_PREFLIGHT = (DEFAULT_CFG_SECTION, "preflight", 'fail')
+
+# number of changes recorded in the state journal before it is compacted into the state file
+CFG_STATE_COMPACT_EVERY = (DEFAULT_CFG_SECTION, "state_compact_every", 50)
+
+# state backend: 'yaml' (a state file next to the topology file) or 'sqlite' (a database shared by all topologies)
+CFG_STATE_BACKEND = (DEFAULT_CFG_SECTION, "state_backend", 'yaml')
+
+# the SQLite state database (for the 'sqlite' state backend)
+CFG_STATE_DB = (DEFAULT_CFG_SECTION, "state_db", DEFAULT_BASE_PATH[sys.platform] + 'state.db')
+
+# time we wait for other processes holding the state database lock (in seconds)
+CFG_STATE_DB_TIMEOUT = (DEFAULT_CFG_SECTION, "state_db_timeout", 30)
+
+# the registry of all the topologies in this host
+CFG_REGISTRY_PATH = (DEFAULT_CFG_SECTION, "registry", DEFAULT_BASE_PATH[sys.platform] + 'topologies.json')
+
 ################################################
 # virtualbox
 ################################################
@@ -139,6 +216,9 @@ VIRTUALBOX_EXTRA_PATHS = [
 # state file extension
 STATE_FILE_EXTENSION = 'state'
 
+# state journal extension (appended to the state file name)
+STATE_JOURNAL_EXTENSION = 'journal'
+
 ################################################
 # logging
 ################################################
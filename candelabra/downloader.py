@@ -0,0 +1,502 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Downloads of boxes.
+
+Downloads are resumable: while downloading, data is written to a `.part` file next to the destination,
+and a sidecar `.part.json` file keeps the URL, the validators sent by the server (`ETag` and
+`Last-Modified`) and the number of bytes received. If the download is interrupted (ie, the connection
+is dropped or the user presses Ctrl-C), the partial file is kept, and the next attempt will continue
+from where it was left with a HTTP `Range` request.
+
+Large files are downloaded in segments: the file is split in N byte ranges that are fetched
+concurrently (over a pool of connections) and written at their offsets in a preallocated file.
+The progress of each segment is kept in the sidecar file, so segmented downloads can be resumed
+too. When the server does not support ranges, we fall back to a single stream.
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from logging import getLogger
+
+from candelabra.config import config
+from candelabra.constants import CFG_CONNECT_TIMEOUT, CFG_DOWNLOAD_TIMEOUT, CFG_DOWNLOAD_RETRIES
+from candelabra.constants import CFG_DOWNLOAD_CONNECTIONS, CFG_DOWNLOAD_CHUNK_SIZE, CFG_DOWNLOAD_SEGMENT_MIN_SIZE
+from candelabra.errors import ImportException
+from candelabra.files import atomic_write
+
+logger = getLogger(__name__)
+
+#: a mbyte
+MBYTE = 1024 * 1024
+
+#: how often (in bytes) we update the sidecar file with the number of bytes received
+SIDECAR_UPDATE_BYTES = 16 * MBYTE
+
+#: extension for partial downloads
+PART_EXTENSION = 'part'
+
+#: extension for the sidecar file of partial downloads
+SIDECAR_EXTENSION = 'json'
+
+_CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+class IncompleteDownloadException(ImportException):
+    """ The download finished before receiving all the data
+    """
+    pass
+
+
+class BandwidthLimiter(object):
+    """ A token bucket for limiting the bandwidth used by one or more downloads
+
+    It can be shared between downloads running in different threads, so the limit is global.
+    """
+
+    def __init__(self, rate, burst=None):
+        """ Initialize a limiter of :param:`rate` bytes per second
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst if burst else rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """ Consume :param:`amount` bytes, waiting until they can be transferred without exceeding the limit
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Download(object):
+    """ A resumable download of a URL to a local file
+    """
+
+    def __init__(self, url, destination, chunk_size=None, retries=None, connections=None, segment_min_size=None,
+                 limiter=None):
+        """ Initialize a download of :param:`url` to the :param:`destination` file
+
+        Parameters not provided are obtained from the `candelabra:downloader` section in the config file.
+
+        :param connections: maximum number of concurrent connections (for segmented downloads)
+        :param segment_min_size: files smaller than this are downloaded with a single stream
+        :param limiter: a :class:`BandwidthLimiter` for limiting the bandwidth used
+        """
+        self.url = url
+        self.destination = destination
+        self.chunk_size = int(chunk_size if chunk_size else config.get_key(CFG_DOWNLOAD_CHUNK_SIZE))
+        self.retries = int(retries if retries is not None else config.get_key(CFG_DOWNLOAD_RETRIES))
+        self.connections = int(connections if connections else config.get_key(CFG_DOWNLOAD_CONNECTIONS))
+        self.segment_min_size = int(segment_min_size if segment_min_size else
+                                    config.get_key(CFG_DOWNLOAD_SEGMENT_MIN_SIZE))
+        self.timeouts = (float(config.get_key(CFG_CONNECT_TIMEOUT)), float(config.get_key(CFG_DOWNLOAD_TIMEOUT)))
+        self.limiter = limiter
+        self.total = None
+        self.received = 0
+        self.transferred = 0
+
+        self._session = None
+        self._lock = threading.Lock()
+        self._aborted = False
+
+    part_filename = property(lambda self: '%s.%s' % (self.destination, PART_EXTENSION),
+                             doc='the file where data is written while downloading')
+    sidecar_filename = property(lambda self: '%s.%s' % (self.part_filename, SIDECAR_EXTENSION),
+                                doc='the metadata file for the partial download')
+
+    #####################
+    # sidecar metadata
+    #####################
+
+    def load_sidecar(self):
+        """ Load the metadata for a previous partial download, or an empty dictionary if there is no
+        valid partial download for this URL
+        """
+        if not os.path.exists(self.sidecar_filename) or not os.path.exists(self.part_filename):
+            return {}
+
+        try:
+            with open(self.sidecar_filename) as sidecar_file:
+                sidecar = json.load(sidecar_file)
+        except (IOError, ValueError), e:
+            logger.warning('invalid metadata for partial download at %s: %s', self.part_filename, str(e))
+            return {}
+
+        if sidecar.get('url') != self.url:
+            logger.info('partial download at %s is for a different URL: discarding', self.part_filename)
+            return {}
+
+        return sidecar
+
+    def save_sidecar(self, sidecar):
+        """ Save the metadata for the partial download
+        """
+        sidecar['received'] = self.received
+        atomic_write(self.sidecar_filename, json.dumps(sidecar))
+
+    def discard(self):
+        """ Remove any partial download
+        """
+        for filename in [self.part_filename, self.sidecar_filename]:
+            if os.path.exists(filename):
+                logger.debug('... removing %s', filename)
+                os.remove(filename)
+
+    #####################
+    # download
+    #####################
+
+    def run(self):
+        """ Download the URL, resuming a previous partial download if possible.
+
+        :returns: the destination file
+        :raises ImportException: if the download cannot be completed. The partial download is kept,
+                                 so a new attempt can resume it.
+        """
+        directory = os.path.dirname(os.path.abspath(self.destination))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        attempt = 0
+        while True:
+            try:
+                self._download()
+                break
+            except KeyboardInterrupt:
+                logger.info('download interrupted: %d bytes kept at %s', self.received, self.part_filename)
+                raise ImportException('could not perform download: interrupted')
+            except ImportException, e:
+                attempt += 1
+                if attempt > self.retries:
+                    logger.info('download failed: %d bytes kept at %s', self.received, self.part_filename)
+                    raise
+                logger.warning('%s: retrying (attempt %d of %d)', str(e), attempt, self.retries)
+
+        self._verify()
+
+        os.rename(self.part_filename, self.destination)
+        os.remove(self.sidecar_filename)
+        logger.info('downloaded %d bytes!', self.received)
+        return self.destination
+
+    def get_remote_size(self):
+        """ Get the size of the file in the server, or None if it is not known
+        """
+        try:
+            r = self._request({'Range': 'bytes=0-0'})
+        except ImportException, e:
+            logger.debug('could not get the size of %s: %s', self.url, str(e))
+            return None
+
+        r.close()
+        if r.status_code == 206:
+            return self._parse_content_range(r.headers.get('content-range', ''))[1]
+        elif r.status_code == 200 and r.headers.get('content-length'):
+            return int(r.headers.get('content-length'))
+        return None
+
+    def stream(self):
+        """ Download the URL as a stream of chunks, without storing it in the disc.
+
+        Streamed downloads cannot be resumed: the caller is responsible for retrying them.
+
+        :returns: an iterator over the chunks of data received
+        :raises ImportException: if the download cannot be completed
+        """
+        import requests
+
+        logger.info('downloading "%s" (streaming)', self.url)
+        r = self._request({})
+        if r.status_code != 200:
+            raise ImportException('could not download %s: HTTP error %d' % (self.url, r.status_code))
+
+        content_length = r.headers.get('content-length')
+        self.total = int(content_length) if content_length else None
+        self.received = 0
+
+        last_downloaded_mbytes = 0
+        try:
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    self._transferred(len(chunk))
+                    self.received += len(chunk)
+                    downloaded_mbytes = self.received / MBYTE
+                    if downloaded_mbytes > last_downloaded_mbytes:
+                        logger.debug('downloaded=%d Mb', downloaded_mbytes)
+                        last_downloaded_mbytes = downloaded_mbytes
+                    yield chunk
+        except requests.RequestException, e:
+            raise ImportException('connection error while downloading: %s' % str(e))
+
+        if self.total is not None and self.received < self.total:
+            raise IncompleteDownloadException('download incomplete (%d of %d bytes)' % (self.received, self.total))
+
+    def _request(self, headers):
+        """ Perform the HTTP request, using a pool of connections to the server
+        """
+        import requests
+
+        if not self._session:
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(self.connections, 1))
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+
+        try:
+            return self._session.get(self.url, stream=True, headers=headers, timeout=self.timeouts)
+        except requests.RequestException, e:
+            raise ImportException('could not connect to %s: %s' % (self.url, str(e)))
+
+    def _probe(self):
+        """ Check if the server supports ranges for this URL, returning a new sidecar for a segmented
+        download, or None if the file must be downloaded with a single stream.
+        """
+        r = self._request({'Range': 'bytes=0-0'})
+        r.close()
+        if r.status_code != 206:
+            logger.debug('... server does not support ranges: using a single stream')
+            return None
+
+        start, total = self._parse_content_range(r.headers.get('content-range', ''))
+        if not total or total < self.segment_min_size:
+            return None
+
+        return {
+            'url': self.url,
+            'etag': r.headers.get('etag'),
+            'last_modified': r.headers.get('last-modified'),
+            'total': total,
+        }
+
+    def _download(self):
+        """ Perform one download attempt, resuming the partial download if there is any
+        """
+        import requests
+
+        sidecar = self.load_sidecar()
+        if sidecar.get('segments'):
+            return self._download_segmented(sidecar)
+        elif not sidecar and self.connections > 1:
+            sidecar = self._probe()
+            if sidecar:
+                return self._download_segmented(sidecar)
+
+        self.received = os.path.getsize(self.part_filename) if sidecar else 0
+
+        headers = {}
+        if self.received > 0:
+            logger.info('resuming download of "%s" at %d Mb', self.url, self.received / MBYTE)
+            headers['Range'] = 'bytes=%d-' % self.received
+            validator = sidecar.get('etag') or sidecar.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+        else:
+            logger.info('downloading "%s"', self.url)
+
+        r = self._request(headers)
+        if r.status_code == 206:
+            start, total = self._parse_content_range(r.headers.get('content-range', ''))
+            if start != self.received:
+                raise ImportException('unexpected range received from server (%s)' % r.headers.get('content-range'))
+            mode = 'ab'
+        elif r.status_code == 200:
+            if self.received > 0:
+                logger.info('... server cannot resume the download: starting from the beginning')
+            self.received = 0
+            content_length = r.headers.get('content-length')
+            total = int(content_length) if content_length else None
+            mode = 'wb'
+        elif r.status_code == 416:
+            if sidecar and sidecar.get('total') == self.received:
+                logger.debug('... the partial download was already complete')
+                self.total = self.received
+                return
+            self.discard()
+            raise ImportException('server cannot resume the partial download')
+        else:
+            raise ImportException('could not download %s: HTTP error %d' % (self.url, r.status_code))
+
+        self.total = total
+        sidecar = {
+            'url': self.url,
+            'etag': r.headers.get('etag'),
+            'last_modified': r.headers.get('last-modified'),
+            'total': total,
+        }
+        self.save_sidecar(sidecar)
+
+        last_sidecar_update = self.received
+        last_downloaded_mbytes = self.received / MBYTE
+        try:
+            with open(self.part_filename, mode) as part_file:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    if chunk:                           # filter out keep-alive new chunks
+                        self._transferred(len(chunk))
+                        part_file.write(chunk)
+                        self.received += len(chunk)
+
+                        downloaded_mbytes = self.received / MBYTE
+                        if downloaded_mbytes > last_downloaded_mbytes:
+                            logger.debug('downloaded=%d Mb', downloaded_mbytes)
+                            last_downloaded_mbytes = downloaded_mbytes
+
+                        if self.received - last_sidecar_update >= SIDECAR_UPDATE_BYTES:
+                            part_file.flush()
+                            self.save_sidecar(sidecar)
+                            last_sidecar_update = self.received
+        except requests.RequestException, e:
+            raise ImportException('connection error while downloading: %s' % str(e))
+        except IOError, e:
+            raise ImportException('could not write downloaded data to %s: %s' % (self.part_filename, str(e)))
+        finally:
+            self.save_sidecar(sidecar)
+
+        if self.total is not None and self.received < self.total:
+            raise IncompleteDownloadException('download incomplete (%d of %d bytes)' % (self.received, self.total))
+
+    def _download_segmented(self, sidecar):
+        """ Download the file in segments, with one connection per segment
+        """
+        self.total = sidecar['total']
+        if not sidecar.get('segments'):
+            segment_size = (self.total + self.connections - 1) / self.connections
+            sidecar['segments'] = [[start, min(start + segment_size, self.total) - 1, 0]
+                                   for start in xrange(0, self.total, segment_size)]
+
+            logger.debug('... preallocating %d bytes', self.total)
+            with open(self.part_filename, 'wb') as part_file:
+                part_file.truncate(self.total)
+
+        segments = sidecar['segments']
+        self.received = sum(received for start, end, received in segments)
+        self.save_sidecar(sidecar)
+
+        pending = [segment for segment in segments if segment[0] + segment[2] <= segment[1]]
+        if self.received > 0:
+            logger.info('resuming download of "%s" at %d Mb', self.url, self.received / MBYTE)
+        else:
+            logger.info('downloading "%s" (%d Mb)', self.url, self.total / MBYTE)
+        logger.debug('... %d segments pending', len(pending))
+
+        errors = []
+        self._aborted = False
+        threads = [threading.Thread(target=self._download_segment, args=(segment, sidecar, errors))
+                   for segment in pending]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for thread in threads:
+                # join with a timeout, so we can still get a KeyboardInterrupt
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self._aborted = True
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            with self._lock:
+                self.save_sidecar(sidecar)
+
+        if errors:
+            if self._aborted:
+                self.discard()
+            raise errors[0]
+
+    def _download_segment(self, segment, sidecar, errors):
+        """ Download a segment `[start, end, received]`, writing it at its offset in the file
+        """
+        import requests
+
+        start, end, received = segment
+        headers = {'Range': 'bytes=%d-%d' % (start + received, end)}
+        validator = sidecar.get('etag') or sidecar.get('last_modified')
+        if validator:
+            headers['If-Range'] = validator
+
+        try:
+            r = self._request(headers)
+            if r.status_code == 200:
+                # the file has changed in the server: the whole download must be restarted
+                self._aborted = True
+                r.close()
+                raise ImportException('file has changed in the server')
+            elif r.status_code != 206:
+                raise ImportException('server did not honour the range request (HTTP %d)' % r.status_code)
+
+            with open(self.part_filename, 'r+b') as part_file:
+                part_file.seek(start + received)
+                unsaved = 0
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    if self._aborted:
+                        break
+                    if chunk:
+                        self._transferred(len(chunk))
+                        chunk = chunk[:end + 1 - (start + received)]
+                        part_file.write(chunk)
+                        received += len(chunk)
+                        unsaved += len(chunk)
+                        if unsaved >= SIDECAR_UPDATE_BYTES:
+                            # only record as received what has been flushed to the file
+                            part_file.flush()
+                            with self._lock:
+                                segment[2] = received
+                                self.received += unsaved
+                                self.save_sidecar(sidecar)
+                            unsaved = 0
+                part_file.flush()
+                with self._lock:
+                    segment[2] = received
+                    self.received += unsaved
+
+            if start + received <= end and not self._aborted:
+                raise IncompleteDownloadException('segment incomplete (%d of %d bytes)' % (received, end - start + 1))
+        except requests.RequestException, e:
+            errors.append(ImportException('connection error while downloading: %s' % str(e)))
+        except IOError, e:
+            errors.append(ImportException('could not write downloaded data to %s: %s' % (self.part_filename, str(e))))
+        except ImportException, e:
+            errors.append(e)
+
+    def _transferred(self, amount):
+        """ Account some bytes received from the network, waiting if the bandwidth limit is exceeded
+        """
+        with self._lock:
+            self.transferred += amount
+        if self.limiter:
+            self.limiter.consume(amount)
+
+    def _verify(self):
+        """ Verify the downloaded file
+        """
+        size = os.path.getsize(self.part_filename)
+        if self.total is not None and size != self.total:
+            self.discard()
+            raise ImportException('downloaded file has %d bytes but %d were expected' % (size, self.total))
+
+    @staticmethod
+    def _parse_content_range(content_range):
+        """ Parse a `Content-Range` header, returning the first byte and the total size
+        """
+        m = _CONTENT_RANGE_RE.match(content_range.strip())
+        if not m:
+            raise ImportException('invalid Content-Range received from server: "%s"' % content_range)
+        total = m.group(3)
+        return int(m.group(1)), int(total) if total != '*' else None
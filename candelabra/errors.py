@@ -126,6 +126,12 @@ class SchedulerTaskException(CandelabraException):
     """
     pass
 
+
+class PreflightException(CandelabraException):
+    """ There are not enough resources in the host for running a command
+    """
+    pass
+
 #########################################
 # boxes and images
 
@@ -136,6 +142,12 @@ class ImportException(CandelabraException):
     pass
 
 
+class ChecksumMismatchException(ImportException):
+    """ The checksum of a box does not match the expected checksum
+    """
+    pass
+
+
 class UnsupportedBoxException(CandelabraException):
     """ Unsupported box or not recognized error
     """
@@ -0,0 +1,293 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Extraction of boxes.
+
+Boxes are (optionally compressed) tar files. They are extracted as a stream: chunks of data (from a
+file or directly from a HTTP connection) are decompressed on the fly and fed to `tarfile` in stream
+mode, so the box does not need to be stored in the disc before being extracted. Checksums of the
+raw data and of every file extracted are computed while extracting.
+
+Files are written as sparse files: runs of zeros (like the unused space in the virtual disks) are
+not written, and GNU sparse members in the tar file are honoured.
+"""
+
+import os
+import bz2
+import zlib
+import hashlib
+import tarfile
+from logging import getLogger
+
+from candelabra.errors import ImportException, UnsupportedBoxException
+
+logger = getLogger(__name__)
+
+#: magic numbers of the supported compression formats
+COMPRESSION_MAGICS = [
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bzip2'),
+    ('\xfd7zXZ\x00', 'xz'),
+]
+
+_MAGIC_MAX_LEN = max(len(magic) for magic, _ in COMPRESSION_MAGICS)
+
+#: size of the blocks read from files
+READ_BLOCK_SIZE = 1024 * 1024
+
+#: runs of zeros of this size (and aligned to it) are not written, but left as holes in the files
+SPARSE_BLOCK_SIZE = 64 * 1024
+
+_ZEROS = '\0' * READ_BLOCK_SIZE
+
+
+def _get_decompressor(compression):
+    """ Get a decompressor object for a compression format
+    """
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bzip2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise UnsupportedBoxException('xz compressed boxes require the "backports.lzma" package '
+                                              '(install candelabra with the "xz" extra)')
+        return lzma.LZMADecompressor()
+    else:
+        return None
+
+
+def file_chunks(filename, block_size=READ_BLOCK_SIZE):
+    """ Iterate over the contents of a file in chunks
+    """
+    with open(filename, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(block_size), ''):
+            yield chunk
+
+
+class ChunksReader(object):
+    """ A file-like object that reads from an iterator of chunks of data.
+
+    The data is decompressed on the fly if a known compression format is detected, and a checksum
+    of the raw (compressed) data is computed while reading.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._decompressor = None
+        self._exhausted = False
+        self.compression = None
+        self.hash = hashlib.sha256()
+        self.raw_size = 0
+
+        self._detect()
+
+    def _next_raw(self):
+        """ Get the next chunk of raw data, or an empty string when there is no more data
+        """
+        for chunk in self._chunks:
+            if chunk:
+                self.hash.update(chunk)
+                self.raw_size += len(chunk)
+                return chunk
+        self._exhausted = True
+        return ''
+
+    def _detect(self):
+        """ Detect the compression format from the first bytes of data
+        """
+        head = ''
+        while len(head) < _MAGIC_MAX_LEN and not self._exhausted:
+            head += self._next_raw()
+
+        for magic, compression in COMPRESSION_MAGICS:
+            if head.startswith(magic):
+                logger.debug('... %s compression detected', compression)
+                self.compression = compression
+                self._decompressor = _get_decompressor(compression)
+                break
+
+        self._buffer = self._decompress(head)
+
+    def _decompress(self, data):
+        """ Decompress some raw data
+        """
+        if not self._decompressor or not data:
+            return data
+
+        res = self._decompressor.decompress(data)
+        if self.compression == 'gzip':
+            # concatenated gzip members
+            while self._decompressor.unused_data:
+                unused_data = self._decompressor.unused_data
+                self._decompressor = _get_decompressor(self.compression)
+                res += self._decompressor.decompress(unused_data)
+        return res
+
+    def read(self, size=-1):
+        """ Read up to :param:`size` bytes of (decompressed) data
+        """
+        while not self._buffer and not self._exhausted:
+            self._buffer = self._decompress(self._next_raw())
+
+        if size < 0:
+            while not self._exhausted:
+                self._buffer += self._decompress(self._next_raw())
+            size = len(self._buffer)
+
+        res, self._buffer = self._buffer[:size], self._buffer[size:]
+        return res
+
+    def drain(self):
+        """ Consume all the remaining data (so the checksum covers all the input)
+        """
+        while self.read(READ_BLOCK_SIZE):
+            pass
+
+    @property
+    def checksum(self):
+        """ The checksum of the raw data read, as `sha256:<hex digest>`
+        """
+        return 'sha256:' + self.hash.hexdigest()
+
+
+def _is_safe_member(member):
+    """ Return True if a tar member can be extracted safely (ie, it does not escape the destination)
+
+    Only regular files and directories are extracted: links (and devices) could be used for writing
+    or reading files outside the destination.
+    """
+    if not (member.isfile() or member.isdir()):
+        return False
+    name = os.path.normpath(member.name)
+    return not (os.path.isabs(name) or name == '..' or name.startswith('..' + os.sep))
+
+
+class SparseWriter(object):
+    """ A writer that leaves runs of zeros as holes in the output file, so they use no disc space
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.position = 0
+        self.written = 0
+
+    def write(self, data, offset=None):
+        """ Write some :param:`data` at the current position (or at some :param:`offset`)
+        """
+        if offset is not None:
+            self.position = offset
+
+        for start in xrange(0, len(data), SPARSE_BLOCK_SIZE):
+            block = data[start:start + SPARSE_BLOCK_SIZE]
+            if block != _ZEROS[:len(block)]:
+                if self.output_file.tell() != self.position:
+                    self.output_file.seek(self.position)
+                self.output_file.write(block)
+                self.written += len(block)
+            self.position += len(block)
+
+    def close(self, size):
+        """ Finish the file, setting its final :param:`size` (so trailing holes are included)
+        """
+        self.output_file.truncate(size)
+
+
+def _extract_file(tar, member, path):
+    """ Extract a regular file from the tar, computing its checksum.
+
+    Files are written as sparse files. For GNU sparse members, only the data sections stored in
+    the tar are read.
+
+    :returns: the checksum of the file
+    """
+    target = os.path.join(path, member.name)
+    target_dir = os.path.dirname(target)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    h = hashlib.sha256()
+    with open(target, 'wb') as output_file:
+        writer = SparseWriter(output_file)
+        if member.issparse():
+            data_sections = [section for section in member.sparse
+                             if hasattr(section, 'realpos') and section.size > 0]
+            position = 0
+            for section in sorted(data_sections, key=lambda section: section.offset):
+                _hash_zeros(h, section.offset - position)
+                tar.fileobj.seek(member.offset_data + section.realpos)
+                remaining = section.size
+                writer.position = section.offset
+                while remaining > 0:
+                    block = tar.fileobj.read(min(remaining, READ_BLOCK_SIZE))
+                    if not block:
+                        raise ImportException('unexpected end of data in %s' % member.name)
+                    h.update(block)
+                    writer.write(block)
+                    remaining -= len(block)
+                position = section.offset + section.size
+            _hash_zeros(h, member.size - position)
+        else:
+            source = tar.extractfile(member)
+            for block in iter(lambda: source.read(READ_BLOCK_SIZE), ''):
+                h.update(block)
+                writer.write(block)
+        writer.close(member.size)
+
+    logger.debug('...... %d bytes written for %d bytes', writer.written, member.size)
+    os.chmod(target, member.mode)
+    os.utime(target, (member.mtime, member.mtime))
+    return 'sha256:' + h.hexdigest()
+
+
+def _hash_zeros(h, size):
+    """ Update a hash with :param:`size` zeros (for the holes in sparse files)
+    """
+    while size > 0:
+        h.update(_ZEROS[:min(size, READ_BLOCK_SIZE)])
+        size -= READ_BLOCK_SIZE
+
+
+def get_physical_size(filename):
+    """ Get the space used in the disc by a file (that can be smaller than its size for sparse files)
+    """
+    st = os.stat(filename)
+    return st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+
+
+def extract_stream(chunks, path):
+    """ Extract a (possibly compressed) tar file, read from an iterator of :param:`chunks`, in :param:`path`
+
+    :returns: a tuple with the checksum of the input data and a dictionary with the checksums of
+              the regular files extracted (by their path, relative to :param:`path`)
+    :raises ImportException: if the data is not a valid tar file
+    """
+    files = {}
+    try:
+        reader = ChunksReader(chunks)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        for member in tar:
+            if not _is_safe_member(member):
+                logger.warning('... skipping unsafe file "%s" in box', member.name)
+                continue
+            logger.debug('... extracting "%s"', member.name)
+            if member.isfile():
+                files[os.path.normpath(member.name)] = _extract_file(tar, member, path)
+            else:
+                tar.extract(member, path=path)
+        tar.close()
+    except (tarfile.TarError, zlib.error, EOFError, IOError), e:
+        raise ImportException('could not extract box: %s' % str(e))
+
+    reader.drain()
+    logger.debug('... extracted %d bytes: %s', reader.raw_size, reader.checksum)
+    return reader.checksum, files
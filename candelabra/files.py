@@ -0,0 +1,155 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Some helpers for dealing with files in a safe way.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import tempfile
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+#: the FICLONE ioctl, for cloning files in copy-on-write filesystems (btrfs, XFS...)
+FICLONE = 0x40049409
+
+#: blocks of zeros of this size are not written when copying files
+COPY_BLOCK_SIZE = 64 * 1024
+
+
+def atomic_write(path, content):
+    """ Write some :param:`content` to a file in an atomic way.
+
+    The contents are written to a temporal file in the same directory, synced to disc and then
+    renamed to the final name, so readers will see either the old or the new contents, but never
+    a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    fd, temp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.rename(temp_path, path)
+    except:
+        logger.debug('... removing %s', temp_path)
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def reflink(source, destination):
+    """ Create :param:`destination` as a clone of :param:`source` that shares its data blocks, so no
+    data is copied until one of the files is modified.
+
+    :raises IOError: if the filesystem does not support cloning files
+    """
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            except:
+                os.remove(destination)
+                raise
+
+
+def sparse_copy(source, destination):
+    """ Copy :param:`source` to :param:`destination`, leaving blocks of zeros as holes in the destination
+    """
+    zeros = '\0' * COPY_BLOCK_SIZE
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            for block in iter(lambda: source_file.read(COPY_BLOCK_SIZE), ''):
+                if block == zeros[:len(block)]:
+                    destination_file.seek(len(block), os.SEEK_CUR)
+                else:
+                    destination_file.write(block)
+            destination_file.truncate()
+
+
+def reflink_or_copy(source, destination):
+    """ Clone :param:`source` as :param:`destination`, falling back to a (sparse) copy if the filesystem does
+    not support cloning files
+
+    :returns: True if the file has been cloned, False if it has been copied
+    """
+    try:
+        reflink(source, destination)
+        cloned = True
+    except (IOError, OSError), e:
+        logger.debug('could not clone %s (%s): copying it', source, os.strerror(e.errno) if e.errno else str(e))
+        sparse_copy(source, destination)
+        cloned = False
+
+    shutil.copymode(source, destination)
+    return cloned
+
+
+def append_line(path, line):
+    """ Append a line to a file, making sure it has reached the disc before returning
+    """
+    with open(path, 'a') as output_file:
+        output_file.write(line.rstrip('\n') + '\n')
+        output_file.flush()
+        os.fsync(output_file.fileno())
+
+
+class FileLock(object):
+    """ An inter-process lock, implemented with `flock()` on a lock file.
+
+    It can be used as a context manager:
+
+        >>> with FileLock('/some/file.lock'):
+        >>>     ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """ Acquire the lock, returning False if it is held by someone else and we are not :param:`blocking`
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(self._fd)
+            self._fd = None
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def release(self):
+        """ Release the lock
+        """
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    locked = property(lambda self: self._fd is not None, doc='True if we are holding the lock')
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
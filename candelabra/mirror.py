@@ -0,0 +1,340 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+A mirror of boxes, for sharing the boxes in the local storage with other hosts.
+
+The mirror is a HTTP server that serves, for each box in the storage:
+
+* `/boxes/<box>.json`: the box manifest (the checksum of the original box file, the checksums of
+  all the files in the box and the providers available).
+* `/boxes/<box>/<provider>.box`: a (uncompressed) box file with the appliance for a provider. These
+  files are not stored anywhere: they are generated on the fly as a tar of the files in the
+  appliance directory, in a deterministic way, so `Range` requests (and resumed downloads) can
+  be supported.
+
+Other hosts can use a list of mirrors: the mirrors are ranked by latency, and boxes are
+downloaded from the nearest mirror that has them, before trying the original URL. As the box
+files served are not the original files, boxes downloaded from mirrors are verified with the
+checksums of their files.
+"""
+
+import os
+import re
+import json
+import time
+import tarfile
+import threading
+import urlparse
+from logging import getLogger
+
+from candelabra.config import config
+from candelabra.constants import CFG_DOWNLOAD_MIRRORS, CFG_MIRRORS_TIMEOUT
+
+logger = getLogger(__name__)
+
+#: size of the blocks read from files when serving them
+SERVE_BLOCK_SIZE = 1024 * 1024
+
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class VirtualBoxFile(object):
+    """ A tar file, generated on the fly, with all the files in a directory
+    """
+
+    def __init__(self, path):
+        """ Initialize the tar for the files in :param:`path`
+        """
+        self.path = path
+        self.segments = []          # list of (offset, length, data, filename)
+        self.size = 0
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                relative_path = os.path.relpath(full_path, path)
+
+                info = tarfile.TarInfo(relative_path)
+                info.size = os.path.getsize(full_path)
+                info.mode = 0644
+                info.mtime = int(os.path.getmtime(full_path))
+                self._add(info.tobuf(format=tarfile.GNU_FORMAT))
+                self._add(None, info.size, full_path)
+
+                padding = (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+                if padding:
+                    self._add('\0' * padding)
+
+        # end of archive
+        self._add('\0' * 2 * tarfile.BLOCKSIZE)
+
+    def _add(self, data, length=None, filename=None):
+        length = len(data) if length is None else length
+        self.segments.append((self.size, length, data, filename))
+        self.size += length
+
+    def read(self, start=0, end=None):
+        """ Iterate over the contents of the file, from :param:`start` to :param:`end` (inclusive)
+        """
+        end = self.size - 1 if end is None else min(end, self.size - 1)
+        for offset, length, data, filename in self.segments:
+            if offset + length <= start:
+                continue
+            if offset > end:
+                break
+
+            first = max(start, offset) - offset
+            last = min(end, offset + length - 1) - offset
+            if data is not None:
+                yield data[first:last + 1]
+            else:
+                with open(filename, 'rb') as input_file:
+                    input_file.seek(first)
+                    remaining = last - first + 1
+                    while remaining > 0:
+                        block = input_file.read(min(remaining, SERVE_BLOCK_SIZE))
+                        if not block:
+                            break
+                        remaining -= len(block)
+                        yield block
+
+
+class MirrorServer(object):
+    """ A HTTP server for the boxes in the storage
+    """
+
+    def __init__(self, storage, address='0.0.0.0', port=0):
+        """ Initialize a server for the :class:`BoxesStorage` :param:`storage`
+        """
+        import BaseHTTPServer
+        import SocketServer
+
+        self.storage = storage
+        self._files = {}
+        self._lock = threading.Lock()
+
+        mirror = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, fmt, *args):
+                logger.debug('%s: %s', self.client_address[0], fmt % args)
+
+            def do_HEAD(self):
+                mirror.handle(self, send_body=False)
+
+            def do_GET(self):
+                mirror.handle(self)
+
+        class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.httpd = ThreadedServer((address, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        address, port = self.httpd.server_address
+        return 'http://%s:%d' % ('127.0.0.1' if address == '0.0.0.0' else address, port)
+
+    def serve_forever(self):
+        """ Serve the boxes until interrupted
+        """
+        logger.info('serving boxes from %s at %s', self.storage.path, self.url)
+        self.httpd.serve_forever()
+
+    def start(self):
+        """ Start serving in a background thread
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    #####################
+    # requests
+    #####################
+
+    def _get_box(self, name):
+        """ Get a box from the storage, refreshing the storage if the box is not known
+        """
+        box = self.storage.boxes.get(name)
+        if not box:
+            with self._lock:
+                self.storage.refresh()
+            box = self.storage.boxes.get(name)
+        return box
+
+    def _get_box_file(self, box, provider):
+        """ Get the (cached) virtual box file for a provider
+        """
+        key = (box.storage_name, provider)
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = VirtualBoxFile(os.path.join(box.path, provider))
+            return self._files[key]
+
+    def handle(self, request, send_body=True):
+        """ Handle a request
+        """
+        path = urlparse.urlparse(request.path).path.strip('/').split('/')
+        if path == ['']:
+            self._send_json(request, dict((name, {'checksum': box.checksum, 'providers': sorted(box.appliances)})
+                                          for name, box in self.storage.boxes.iteritems()), send_body)
+        elif len(path) == 2 and path[0] == 'boxes' and path[1].endswith('.json'):
+            box = self._get_box(path[1][:-len('.json')])
+            if not box:
+                return request.send_error(404)
+            manifest = {
+                'name': box.storage_name,
+                'checksum': box.checksum,
+                'files': box.files,
+                'providers': sorted(box.appliances),
+            }
+            self._send_json(request, manifest, send_body)
+        elif len(path) == 3 and path[0] == 'boxes' and path[2].endswith('.box'):
+            box = self._get_box(path[1])
+            provider = path[2][:-len('.box')]
+            if not box or provider not in box.appliances:
+                return request.send_error(404)
+            self._send_box_file(request, box, self._get_box_file(box, provider), send_body)
+        else:
+            request.send_error(404)
+
+    def _send_json(self, request, data, send_body):
+        body = json.dumps(data, indent=2, sort_keys=True)
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        if send_body:
+            request.wfile.write(body)
+
+    def _send_box_file(self, request, box, box_file, send_body):
+        etag = '"%s-%d"' % ((box.checksum or 'unknown').split(':')[-1][:16], box_file.size)
+        start, end = 0, box_file.size - 1
+
+        range_header = request.headers.get('Range')
+        if_range = request.headers.get('If-Range')
+        m = _RANGE_RE.match(range_header.strip()) if range_header else None
+        if m and (not if_range or if_range == etag):
+            if m.group(1):
+                start = int(m.group(1))
+                end = int(m.group(2)) if m.group(2) else box_file.size - 1
+            else:
+                start = max(box_file.size - int(m.group(2)), 0)
+            if start >= box_file.size or end < start:
+                request.send_response(416)
+                request.send_header('Content-Range', 'bytes */%d' % box_file.size)
+                request.send_header('Content-Length', '0')
+                request.end_headers()
+                return
+            end = min(end, box_file.size - 1)
+            request.send_response(206)
+            request.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, box_file.size))
+        else:
+            request.send_response(200)
+
+        request.send_header('Content-Type', 'application/x-tar')
+        request.send_header('Content-Length', str(end - start + 1))
+        request.send_header('Accept-Ranges', 'bytes')
+        request.send_header('ETag', etag)
+        request.end_headers()
+        if send_body:
+            for block in box_file.read(start, end):
+                request.wfile.write(block)
+
+
+#####################
+# clients
+#####################
+
+def get_mirrors(extra_mirrors=None):
+    """ Get the list of mirrors: the :param:`extra_mirrors` (ie, from the topology) and the mirrors in the config file
+    """
+    def split(value):
+        if isinstance(value, basestring):
+            return [m for m in re.split(r'[\s,]+', value) if m]
+        return list(value or [])
+
+    mirrors = split(extra_mirrors) + split(config.get_key(CFG_DOWNLOAD_MIRRORS))
+
+    res = []
+    for mirror in mirrors:
+        mirror = mirror.rstrip('/')
+        if mirror not in res:
+            res.append(mirror)
+    return res
+
+
+def rank_mirrors(mirrors):
+    """ Sort the :param:`mirrors` by latency, removing the mirrors that cannot be reached
+    """
+    import requests
+
+    timeout = float(config.get_key(CFG_MIRRORS_TIMEOUT))
+    latencies = {}
+
+    def probe(mirror):
+        start = time.time()
+        try:
+            r = requests.head(mirror + '/', timeout=timeout)
+        except requests.RequestException, e:
+            logger.debug('... mirror %s is not reachable: %s', mirror, str(e))
+        else:
+            if r.status_code == 200:
+                latencies[mirror] = time.time() - start
+
+    threads = [threading.Thread(target=probe, args=(mirror,)) for mirror in mirrors]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ranked = sorted(latencies, key=lambda mirror: latencies[mirror])
+    for mirror in ranked:
+        logger.debug('... mirror %s: %.1f ms', mirror, latencies[mirror] * 1000)
+    return ranked
+
+
+def find_in_mirrors(mirrors, name, provider, checksum=None):
+    """ Find the nearest mirror with the box :param:`name` for a :param:`provider`
+
+    :returns: a tuple with the URL of the box file and the box manifest, or `(None, None)` if not found
+    """
+    import requests
+
+    if not mirrors:
+        return None, None
+
+    timeout = float(config.get_key(CFG_MIRRORS_TIMEOUT))
+    for mirror in rank_mirrors(mirrors):
+        try:
+            r = requests.get('%s/boxes/%s.json' % (mirror, name), timeout=timeout)
+            if r.status_code != 200:
+                continue
+            manifest = r.json()
+        except (requests.RequestException, ValueError), e:
+            logger.debug('... could not get box "%s" from %s: %s', name, mirror, str(e))
+            continue
+
+        if provider not in manifest.get('providers', []):
+            continue
+        if checksum and manifest.get('checksum') != checksum:
+            logger.debug('... box "%s" at %s has a different checksum', name, mirror)
+            continue
+
+        logger.info('box "%s" found at mirror %s', name, mirror)
+        return '%s/boxes/%s/%s.box' % (mirror, name, provider), manifest
+
+    return None, None
@@ -105,8 +105,11 @@ class CommandPlugin(object):
         """
         raise NotImplementedError('must be implemented')
 
-    def run_with_topology(self, args, topology_file, command=None, save_state=True):
+    def run_with_topology(self, args, topology_file, command=None, save_state=True, fresh=None, command_args=None):
         """ Run a command, managing the topology
+
+        :param fresh: ignore the runtime facts cached in the state (by default, only when running a command)
+        :param command_args: a dictionary of arguments for the `get_tasks_<command>` methods of the machines
         """
         if command:
             logger.info('running command "%s"', command)
@@ -123,7 +126,7 @@ class CommandPlugin(object):
             logger.critical('topology file %s does not exist', topology_file)
             sys.exit(1)
 
-        from candelabra.errors import TopologyException, ProviderNotFoundException, CandelabraException
+        from candelabra.errors import TopologyException, ProviderNotFoundException, CandelabraException, ImportException
         from candelabra.scheduler.base import TasksScheduler
 
         # load the topology file and create a tree
@@ -131,13 +134,17 @@ class CommandPlugin(object):
             from candelabra.topology.root import TopologyRoot
 
             topology = TopologyRoot()
-            topology.load(topology_file)
+            topology.load(topology_file, fresh=bool(command) if fresh is None else fresh)
         except TopologyException, e:
             logger.critical(str(e))
             sys.exit(1)
         except ProviderNotFoundException, e:
             logger.critical(str(e))
             sys.exit(1)
+        except ImportException, e:
+            # ie, the catalog of a box cannot be obtained
+            logger.critical(str(e))
+            sys.exit(1)
         except KeyboardInterrupt:
             logger.critical('interrupted with Ctrl-C... bye!')
             sys.exit(0)
@@ -145,9 +152,14 @@ class CommandPlugin(object):
         scheduler = None
         try:
             if command:
+                topology.last_command = command
                 scheduler = TasksScheduler()
-                tasks = topology.get_tasks(command)
+                tasks = topology.get_tasks(command, **(command_args or {}))
                 assert all(isinstance(t, tuple) for t in tasks)
+
+                from candelabra.preflight import run_preflight
+
+                run_preflight(topology, command, **(command_args or {}))
                 scheduler.append(tasks)
                 scheduler.run()
         except CandelabraException:
@@ -162,6 +174,10 @@ class CommandPlugin(object):
                 if scheduler and scheduler.num_completed > 0:
                     topology.state.save()
 
+            from candelabra.waits import wait_stats
+
+            wait_stats().report()
+
         return topology
 
 
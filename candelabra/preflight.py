@@ -0,0 +1,136 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Preflight checks, run before the tasks of a command are scheduled.
+
+Machines can report the resources they need for running a command (with a
+`get_requirements_<command>` method, like the `get_tasks_<command>` methods), and these resources
+are compared against the free space in the filesystems involved and the free memory in the host,
+so commands fail before doing anything instead of halfway.
+"""
+
+import os
+import itertools
+from logging import getLogger
+
+from candelabra.config import config
+from candelabra.constants import CFG_PREFLIGHT
+from candelabra.errors import PreflightException
+
+logger = getLogger(__name__)
+
+MBYTE = 1024 * 1024
+
+_anonymous_keys = itertools.count()
+
+
+class Requirements(object):
+    """ The resources needed for running a command
+    """
+
+    def __init__(self):
+        self.space = {}         # key -> (path, bytes)
+        self.memory = 0         # in Mb
+        self.cache = {}         # values obtained once for all the machines (ie, the size of a box to download)
+
+    def add_space(self, path, size, key=None):
+        """ Add some disc space needed in :param:`path`.
+
+        Requirements with the same :param:`key` are counted only once (ie, a box that must be
+        downloaded for many machines)
+        """
+        if size > 0:
+            self.space[key if key else next(_anonymous_keys)] = (path, size)
+
+    def add_memory(self, memory):
+        """ Add some memory (in Mb) needed in the host
+        """
+        self.memory += memory
+
+    def check(self):
+        """ Check the requirements against the resources available
+
+        :returns: a list of problems found
+        """
+        problems = []
+
+        # group the space needed by filesystem
+        filesystems = {}
+        for path, size in self.space.itervalues():
+            device, free = get_free_space(path)
+            paths, needed, _ = filesystems.get(device, (set(), 0, free))
+            paths.add(path)
+            filesystems[device] = (paths, needed + size, free)
+
+        for paths, needed, free in filesystems.itervalues():
+            logger.debug('preflight: %d Mb needed in %s (%d Mb free)',
+                         needed / MBYTE, ', '.join(sorted(paths)), free / MBYTE)
+            if needed > free:
+                problems.append('not enough disc space in %s: %d Mb needed, %d Mb available' %
+                                (', '.join(sorted(paths)), needed / MBYTE, free / MBYTE))
+
+        free_memory = get_free_memory()
+        if free_memory is not None:
+            logger.debug('preflight: %d Mb of memory needed (%d Mb free)', self.memory, free_memory)
+            if self.memory > free_memory:
+                problems.append('not enough memory in the host: %d Mb needed, %d Mb available' %
+                                (self.memory, free_memory))
+
+        return problems
+
+
+def get_free_space(path):
+    """ Get the filesystem and the free space (in bytes) for :param:`path` (or its closest existing parent)
+
+    :returns: a tuple with the filesystem device and the free space
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+
+    st = os.statvfs(path)
+    return os.stat(path).st_dev, st.f_bavail * st.f_frsize
+
+
+def get_free_memory():
+    """ Get the memory available in the host (in Mb), or None if it cannot be obtained
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            values = dict(line.split(':', 1) for line in meminfo if ':' in line)
+    except IOError:
+        return None
+
+    value = values.get('MemAvailable') or values.get('MemFree')
+    return int(value.split()[0]) / 1024 if value else None
+
+
+def run_preflight(topology, command, **kwargs):
+    """ Check that the host has the resources needed for running :param:`command` in the :param:`topology`
+
+    Any keyword arguments are passed to the `get_requirements_<command>` method of the machines (like
+    the arguments for the `get_tasks_<command>` methods).
+
+    :raises PreflightException: if there are not enough resources (and the preflight mode is `fail`)
+    """
+    mode = config.get_key(CFG_PREFLIGHT)
+    if mode == 'off':
+        return
+
+    requirements = Requirements()
+    method_name = 'get_requirements_%s' % command
+    for machine in topology.machines:
+        requirements_gen = getattr(machine, method_name, None)
+        if requirements_gen:
+            requirements_gen(requirements, **kwargs)
+
+    problems = requirements.check()
+    if problems:
+        if mode == 'warn':
+            for problem in problems:
+                logger.warning('preflight: %s', problem)
+        else:
+            raise PreflightException('; '.join(problems))
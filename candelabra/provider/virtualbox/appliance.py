@@ -5,27 +5,72 @@
 #
 
 import os
+import hashlib
 from logging import getLogger
 from candelabra.boxes import BoxesStorage
 
 from candelabra.errors import UnsupportedBoxException, ImportException
+from candelabra.files import reflink_or_copy
+from candelabra.provider.virtualbox.ovf import parse_ovf, STREAM_OPTIMIZED_FORMAT
 
 import virtualbox as _virtualbox
 
 
 logger = getLogger(__name__)
 
+#: prefix for the names of the master VMs
+MASTER_PREFIX = 'candelabra-master-'
+
+#: group where master VMs are kept
+MASTER_GROUP = '/candelabra-masters'
+
+#: name of the snapshot linked clones are created from
+MASTER_SNAPSHOT = 'base'
+
 
 class VirtualboxAppliance(object):
     """ A VirtualBox appliance
+
+    Machines can be created from the appliance in two ways (see the `clone_mode` setting):
+
+    * `import`: the OVF is imported for every machine, with a full copy of the disks.
+    * `linked`: the OVF is imported only once, as a hidden master VM with a base snapshot, and
+      machines are created as linked clones of this snapshot, with differencing disks. Masters are
+      named after the box checksum, so a new box (or a new version of a box) gets a new master.
+    * `reflink`: the OVF is imported for every machine, but the disks are not copied by VirtualBox:
+      they are cloned from the box with reflinks (in copy-on-write filesystems like btrfs or XFS,
+      or copied otherwise) and then attached to the machine. This is not possible for
+      stream-optimized disks (that VirtualBox must convert), so these boxes are fully imported.
     """
     provider = 'virtualbox'
 
-    def __init__(self, path):
+    def __init__(self, path, descriptor=None):
         """ Initialize a virtualbox box
         :param path: the OVF file
+        :param descriptor: the parsed OVF (it will be parsed when needed if not provided)
         """
         self.ovf = path
+        self._descriptor = descriptor
+
+    @property
+    def descriptor(self):
+        """ The OVF descriptor, as parsed by :func:`parse_ovf`
+        """
+        if self._descriptor is None:
+            self._descriptor = parse_ovf(self.ovf)
+        return self._descriptor
+
+    @property
+    def required_space(self):
+        """ The (approximate) disc space needed for a full import of the appliance
+        """
+        return sum(disk['size'] for disk in self.descriptor['disks'])
+
+    @property
+    def has_stream_optimized_disks(self):
+        """ True if the appliance has stream-optimized disks (that VirtualBox must convert when importing them)
+        """
+        return any(disk['format'] == STREAM_OPTIMIZED_FORMAT for disk in self.descriptor['disks'])
 
     @staticmethod
     def is_valid(folder):
@@ -41,16 +86,135 @@ class VirtualboxAppliance(object):
         """
         ovf_file = os.path.join(folder, 'box.ovf')
         if os.path.isfile(ovf_file):
-            return VirtualboxAppliance(path=ovf_file)
+            return VirtualboxAppliance(path=ovf_file, descriptor=parse_ovf(ovf_file))
         else:
             raise UnsupportedBoxException('OVF file not found at %s' % ovf_file)
 
+    @staticmethod
+    def from_index_entry(entry):
+        """ Obtain a VirtualboxBox appliance from an entry in the boxes index
+        """
+        return VirtualboxAppliance(path=entry['ovf'], descriptor=entry.get('descriptor'))
+
+    def get_index_entry(self):
+        """ Get the entry for this appliance in the boxes index
+        """
+        return {'ovf': self.ovf, 'descriptor': self.descriptor}
+
     def import_to_machine(self, machine_node):
         """ Copy (import) the appliance to VirtualBox
         """
-        logger.info('importing appliance from /%s as "%s"', BoxesStorage.get_relative_path(self.ovf),
-                    machine_node.cfg_name)
+        machine_node.cfg_uuid = self.create_machine(machine_node.cfg_name, machine_node.cfg_box,
+                                                    clone_mode=machine_node.cfg_clone_mode)
+        logger.debug(machine_node.get_info())
+
+    def create_machine(self, name, box, clone_mode='import'):
+        """ Create a new virtual machine from the appliance in a :param:`box`, with a full import or as a
+        linked clone (depending on the :param:`clone_mode`)
+
+        :returns: the UUID of the new machine
+        """
+        if clone_mode == 'linked':
+            return self._clone(name, box)
+
+        logger.info('importing appliance from /%s as "%s"', BoxesStorage.get_relative_path(self.ovf), name)
+        machines = self._import(reflink_disks=(clone_mode == 'reflink'))
+        if len(machines) == 0:
+            raise ImportException('no virtual machine created after import of %s' % name)
+        return machines[0]
+
+    def _clone(self, name, box):
+        """ Create a machine as a linked clone of the master VM for this appliance
+        """
+        master = self.get_master(box)
+
+        logger.info('cloning master "%s" as "%s"', master.name, name)
+        try:
+            clone = master.clone(snapshot_name_or_id=MASTER_SNAPSHOT,
+                                 options=[_virtualbox.library.CloneOptions.link,
+                                          _virtualbox.library.CloneOptions.keep_natma_cs],
+                                 name=name)
+        except _virtualbox.library.VBoxError, e:
+            raise ImportException('could not clone master "%s": %s' % (master.name, str(e)))
+        return clone.id_p
+
+    def get_key(self, box):
+        """ Get a key that identifies the contents of this appliance in a :param:`box`
+        """
+        key = box.checksum if box.checksum else os.path.abspath(self.ovf)
+        return '%s-%s' % (box.storage_name, hashlib.sha1(key).hexdigest()[:12])
+
+    def get_master_name(self, box):
+        """ Get the name of the master VM for this appliance in a :param:`box`
+        """
+        return MASTER_PREFIX + self.get_key(box)
+
+    def get_pool(self, box, clone_mode=None):
+        """ Get the pool of pre-created machines for this appliance in a :param:`box`
+        """
+        from candelabra.provider.virtualbox.pool import VirtualboxPool
+
+        return VirtualboxPool(self, box, clone_mode=clone_mode)
+
+    def has_master(self, box):
+        """ Return True if the master VM for this appliance in a :param:`box` has already been created
+        """
+        import virtualbox
+
+        try:
+            virtualbox.VirtualBox().find_machine(self.get_master_name(box))
+        except _virtualbox.library.VBoxErrorObjectNotFound:
+            return False
+        return True
+
+    def get_master(self, box):
+        """ Get the master VM for this appliance, importing it if it does not exist
+
+        Masters are created with an inter-process lock, so only one master is imported for a box, even
+        when many machines (or many candelabra processes) are created from the box at the same time.
+        """
+        import virtualbox
+
+        vbox = virtualbox.VirtualBox()
+        name = self.get_master_name(box)
+        with BoxesStorage.get_box_lock(name):
+            try:
+                master = vbox.find_machine(name)
+                master.find_snapshot(MASTER_SNAPSHOT)
+                return master
+            except _virtualbox.library.VBoxErrorObjectNotFound:
+                pass
+
+            logger.info('importing appliance from /%s as master "%s"', BoxesStorage.get_relative_path(self.ovf), name)
+            machines = self._import()
+            if len(machines) == 0:
+                raise ImportException('no virtual machine created after import of %s' % self.ovf)
+
+            try:
+                master = vbox.find_machine(machines[0])
+                session = _virtualbox.Session()
+                master.lock_machine(session, _virtualbox.library.LockType.write)
+                try:
+                    mutable_master = session.machine
+                    mutable_master.name = name
+                    mutable_master.groups = [MASTER_GROUP]
+                    mutable_master.set_extra_data('GUI/HideFromManager', 'true')
+                    mutable_master.set_extra_data('candelabra/master/ovf', os.path.abspath(self.ovf))
+                    mutable_master.save_settings()
+
+                    logger.info('... taking "%s" snapshot', MASTER_SNAPSHOT)
+                    progress, _ = mutable_master.take_snapshot(MASTER_SNAPSHOT, 'candelabra master', False)
+                    progress.wait_for_completion(-1)
+                finally:
+                    session.unlock_machine()
+            except _virtualbox.library.VBoxError, e:
+                raise ImportException('could not create master "%s": %s' % (name, str(e)))
 
+            return vbox.find_machine(name)
+
+    def _import(self, reflink_disks=False):
+        """ Import the OVF, returning the UUIDs of the machines created
+        """
         import virtualbox
 
         vbox = virtualbox.VirtualBox()
@@ -59,17 +223,94 @@ class VirtualboxAppliance(object):
         progress.wait_for_completion(-1)
         appliance.interpret()
 
+        if reflink_disks and self.has_stream_optimized_disks:
+            logger.info('... the appliance has stream-optimized disks: disks will be copied')
+            reflink_disks = False
+        disks = self._disable_disks(appliance) if reflink_disks else []
+
         logger.info('... importing the machines')
         progress = appliance.import_machines([_virtualbox.library.ImportOptions.keep_natma_cs])
         logger.info('... waiting for import to finish')
         progress.wait_for_completion(-1)
 
-        if len(appliance.machines) > 0:
-            machine_uuid = appliance.machines[0]
-            machine_node.cfg_uuid = machine_uuid
-            logger.debug(machine_node.get_info())
-        else:
-            raise ImportException('no virtual machine created after import of %s' % machine_node.cfg_name)
+        if disks and len(appliance.machines) > 0:
+            self._attach_disks(vbox.find_machine(appliance.machines[0]), disks)
+        return appliance.machines
+
+    def _disable_disks(self, appliance):
+        """ Disable the disks in the import, so VirtualBox does not copy them
+
+        :returns: a list of the disks disabled, as (source, target, bus, port, device) tuples
+        """
+        types_enum = _virtualbox.library.VirtualSystemDescriptionType
+        buses = {
+            int(types_enum.hard_disk_controller_ide): _virtualbox.library.StorageBus.ide,
+            int(types_enum.hard_disk_controller_sata): _virtualbox.library.StorageBus.sata,
+            int(types_enum.hard_disk_controller_scsi): _virtualbox.library.StorageBus.scsi,
+            int(types_enum.hard_disk_controller_sas): _virtualbox.library.StorageBus.sas,
+        }
+
+        description = appliance.virtual_system_descriptions[0]
+        types, refs, ovf_values, vbox_values, extra_values = description.get_description()
+
+        # the controllers, by reference (OVF IDE controllers are the channels of a VirtualBox IDE controller)
+        controllers = {}
+        num_ide = 0
+        for num, item_type in enumerate(types):
+            if int(item_type) in buses:
+                bus = buses[int(item_type)]
+                controllers[str(refs[num])] = (bus, num_ide)
+                if bus == _virtualbox.library.StorageBus.ide:
+                    num_ide += 1
+
+        enabled = [True] * len(types)
+        disks = []
+        for num, item_type in enumerate(types):
+            if int(item_type) != int(types_enum.hard_disk_image):
+                continue
+
+            source = os.path.join(os.path.dirname(self.ovf), ovf_values[num])
+            attachment = dict(item.split('=', 1) for item in extra_values[num].split(';') if '=' in item)
+            bus, num_controller = controllers[attachment['controller']]
+            channel = int(attachment.get('channel', 0))
+            if bus == _virtualbox.library.StorageBus.ide:
+                port, device = num_controller + channel // 2, channel % 2
+            else:
+                port, device = channel, 0
+
+            disks.append((source, vbox_values[num], bus, port, device))
+            enabled[num] = False
+
+        description.set_final_values(enabled, vbox_values, extra_values)
+        return disks
+
+    def _attach_disks(self, machine, disks):
+        """ Clone the :param:`disks` from the box and attach them to the :param:`machine`
+        """
+        import virtualbox
+
+        vbox = virtualbox.VirtualBox()
+        machine_folder = os.path.dirname(machine.settings_file_path)
+        session = _virtualbox.Session()
+        machine.lock_machine(session, _virtualbox.library.LockType.write)
+        try:
+            mutable_machine = session.machine
+            for source, target, bus, port, device in disks:
+                target = os.path.join(machine_folder, os.path.basename(target))
+                cloned = reflink_or_copy(source, target)
+                logger.info('... disk %s %s', os.path.basename(target), 'cloned' if cloned else 'copied')
+
+                # the disks get new UUIDs, as all the machines created from the box have the same disks
+                medium = vbox.open_medium(target, _virtualbox.library.DeviceType.hard_disk,
+                                          _virtualbox.library.AccessMode.read_write, True)
+                controller = [c for c in mutable_machine.storage_controllers if c.bus == bus][0]
+                mutable_machine.attach_device(controller.name, port, device,
+                                              _virtualbox.library.DeviceType.hard_disk, medium)
+            mutable_machine.save_settings()
+        except (_virtualbox.library.VBoxError, IndexError, IOError, OSError), e:
+            raise ImportException('could not attach disks to %s: %s' % (machine.name, str(e)))
+        finally:
+            session.unlock_machine()
 
     #####################
     # auxiliary
@@ -0,0 +1,253 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+A process-wide dispatcher of VirtualBox events.
+
+There is only one listener for the VirtualBox events: a passive listener, with a thread that
+blocks in `get_event()` and dispatches the events received to the waiters interested in them
+(filtered by machine and event type). Waiters are registered before doing the operation that
+will generate the event, so events cannot be missed, and waits return as soon as the event
+arrives:
+
+    >>> with events_dispatcher().watch(machine_uuid, [VBoxEventType.on_machine_state_changed]) as waiter:
+    >>>     ... launch the machine ...
+    >>>     event = waiter.wait(timeout=5.0)
+
+Events that are only available in the console of a machine (ie, the guest additions or guest
+sessions events) are dispatched by attaching the console event source for that machine while
+waiting for them. Conditions that change with some events (ie, the guest additions run level) can
+be waited with :meth:`EventsDispatcher.wait_until`, that checks the condition when the events
+arrive (and with some interval, in case they are missed).
+"""
+
+import time
+import threading
+from logging import getLogger
+
+import virtualbox as _virtualbox
+
+from candelabra.waits import wait_stats
+
+logger = getLogger(__name__)
+
+#: timeout (in milliseconds) for each blocking `get_event()`, so threads can check if they must stop
+GET_EVENT_TIMEOUT = 500
+
+#: maximum time (in seconds) between checks of a condition waited with events
+POLL_INTERVAL = 2.0
+
+#: the events dispatched from the VirtualBox event source
+VBOX_EVENTS = [
+    _virtualbox.library.VBoxEventType.on_machine_state_changed,
+    _virtualbox.library.VBoxEventType.on_session_state_changed,
+    _virtualbox.library.VBoxEventType.on_machine_data_changed,
+    _virtualbox.library.VBoxEventType.on_guest_property_changed,
+    _virtualbox.library.VBoxEventType.on_snapshot_taken,
+]
+
+
+class EventWaiter(object):
+    """ A waiter for some events of a machine
+    """
+
+    def __init__(self, dispatcher, machine_id, event_types, predicate=None):
+        self.dispatcher = dispatcher
+        self.machine_id = machine_id
+        self.event_types = set(int(event_type) for event_type in event_types)
+        self.predicate = predicate
+        self.event = None
+        self._received = threading.Event()
+
+    def matches(self, machine_id, event_type, event):
+        """ Return True if the waiter is interested in an event
+        """
+        if self.machine_id and machine_id != self.machine_id:
+            return False
+        if int(event_type) not in self.event_types:
+            return False
+        return self.predicate(event) if self.predicate else True
+
+    def notify(self, event):
+        self.event = event
+        self._received.set()
+
+    def wait(self, timeout=None, reason='event'):
+        """ Wait up to :param:`timeout` seconds for an event
+
+        :param reason: the reason for waiting (for the statistics), or None if the wait must not be recorded
+        :returns: the event, or None if no event has been received
+        """
+        start = time.time()
+        self._received.wait(timeout)
+        if reason is not None:
+            elapsed = time.time() - start
+            logger.debug('waited %.3f seconds for %s: %s', elapsed, reason, 'received' if self.event else 'timeout')
+            wait_stats().record(reason, elapsed, timed_out=self.event is None)
+        return self.event
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.dispatcher.remove(self)
+
+
+class EventsDispatcher(object):
+    """ The dispatcher of events
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._threads = {}
+
+    def start(self):
+        """ Start listening for events in the VirtualBox event source (if not started yet)
+        """
+        with self._lock:
+            if 'vbox' in self._threads:
+                return
+            event_source = _virtualbox.VirtualBox().event_source
+            self._threads['vbox'] = self._listen('vbox', event_source, VBOX_EVENTS, None)
+
+    def attach(self, key, event_source, event_types, machine_id):
+        """ Start dispatching events from another :param:`event_source` (ie, a console), as events of a machine
+        """
+        with self._lock:
+            if key not in self._threads:
+                self._threads[key] = self._listen(key, event_source, event_types, machine_id)
+
+    def detach(self, key):
+        """ Stop dispatching events from the event source attached as :param:`key`
+        """
+        with self._lock:
+            thread, quit = self._threads.pop(key, (None, None))
+        if thread:
+            quit.set()
+            thread.join()
+
+    def _listen(self, key, event_source, event_types, machine_id):
+        """ Create a passive listener for some events, with a thread for dispatching them
+        """
+        listener = event_source.create_listener()
+        event_source.register_listener(listener, event_types, False)
+
+        quit = threading.Event()
+        thread = threading.Thread(target=self._run, args=(key, event_source, listener, machine_id, quit))
+        thread.daemon = True
+        thread.start()
+        return thread, quit
+
+    def _run(self, key, event_source, listener, machine_id, quit):
+        """ Get events and dispatch them until we must :param:`quit`
+
+        A failure dispatching an event does not stop the thread. If the thread stops for any other
+        reason, it is forgotten, so it can be started again.
+        """
+        try:
+            while not quit.is_set():
+                try:
+                    event = event_source.get_event(listener, GET_EVENT_TIMEOUT)
+                except _virtualbox.library.VBoxError, e:
+                    logger.warning('could not get events: %s', str(e))
+                    break
+                if event:
+                    try:
+                        self.dispatch(event, machine_id)
+                    except Exception:
+                        logger.exception('could not dispatch event')
+                    finally:
+                        event_source.event_processed(listener, event)
+        finally:
+            try:
+                event_source.unregister_listener(listener)
+            except _virtualbox.library.VBoxError:
+                pass
+
+            with self._lock:
+                thread = self._threads.get(key, (None, None))[0]
+                if thread is threading.current_thread():
+                    del self._threads[key]
+
+    def dispatch(self, event, machine_id=None):
+        """ Dispatch an event to the waiters interested in it
+        """
+        event_type = event.type_p
+        event = _virtualbox.events.type_to_interface(event_type)(event)
+        machine_id = getattr(event, 'machine_id', machine_id)
+        logger.debug('event: %s (machine:%s)', event_type, machine_id)
+
+        with self._lock:
+            waiters = [waiter for waiter in self._waiters if waiter.matches(machine_id, event_type, event)]
+            for waiter in waiters:
+                self._waiters.remove(waiter)
+
+        for waiter in waiters:
+            waiter.notify(event)
+
+    def watch(self, machine_id, event_types, predicate=None):
+        """ Register a waiter for the next event of some :param:`event_types` of a machine (that satisfies a
+        :param:`predicate`).
+
+        :returns: a :class:`EventWaiter`, that can be used as a context manager
+        """
+        self.start()
+        waiter = EventWaiter(self, machine_id, event_types, predicate)
+        with self._lock:
+            self._waiters.append(waiter)
+        return waiter
+
+    def remove(self, waiter):
+        """ Remove a waiter (if it has not received its event yet)
+        """
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def wait_for(self, machine_id, event_types, predicate=None, timeout=None, reason='event'):
+        """ Wait up to :param:`timeout` seconds for an event of a machine
+
+        :param reason: the reason for waiting (for the statistics)
+        :returns: the event, or None if no event has been received
+        """
+        with self.watch(machine_id, event_types, predicate) as waiter:
+            return waiter.wait(timeout, reason=reason)
+
+    def wait_until(self, condition, machine_id, event_types, timeout, reason='unknown', interval=POLL_INTERVAL):
+        """ Wait until a :param:`condition` (a callable) returns a true value, for up to :param:`timeout` seconds
+
+        The condition is checked when an event of some :param:`event_types` of a machine arrives, and
+        every :param:`interval` seconds (in case the events are not available).
+
+        :returns: the last value returned by the condition (so a false value means we have timed out)
+        """
+        start = time.time()
+        deadline = start + float(timeout)
+        while True:
+            # the waiter is registered before checking the condition, so changes cannot be missed
+            with self.watch(machine_id, event_types) as waiter:
+                res = condition()
+                remaining = deadline - time.time()
+                if res or remaining <= 0:
+                    break
+                waiter.wait(min(remaining, interval), reason=None)
+
+        elapsed = time.time() - start
+        logger.debug('waited %.3f seconds for %s: %s', elapsed, reason, 'done' if res else 'timeout')
+        wait_stats().record(reason, elapsed, timed_out=not res)
+        return res
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def events_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if not _dispatcher:
+            _dispatcher = EventsDispatcher()
+    return _dispatcher
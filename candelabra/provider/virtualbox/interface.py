@@ -5,14 +5,14 @@
 #
 
 from logging import getLogger
-from time import sleep
 
 import virtualbox as _virtualbox
 
-from candelabra.errors import MachineChangeException
+from candelabra.provider.virtualbox.reconfig import MachineReconfig
 from candelabra.topology.interface import InterfaceNode
 from candelabra.topology.network import NetworkNode
 from candelabra.topology.node import TopologyAttribute
+from candelabra.waits import wait_until
 
 logger = getLogger(__name__)
 
@@ -40,55 +40,50 @@ class VirtualboxInterfaceNode(InterfaceNode):
     def machine(self):
         return self._container
 
+    def configure(self, reconfig):
+        """ Add the settings of the network adapter to a :class:`MachineReconfig`
+        """
+        logger.debug('configuring network interface #%d (connected to %s)', self._num, self.cfg_connected.cfg_name)
+        if self.cfg_type == 'nat':
+            logger.info('... type: NAT')
+            reconfig.set_nic(self._num, _virtualbox.library.NetworkAttachmentType.nat)
+        elif self.cfg_connected.cfg_scope == 'private':
+            logger.info('... type: private')
+            reconfig.set_nic(self._num, _virtualbox.library.NetworkAttachmentType.internal,
+                             internal_network=self.cfg_connected.cfg_name)
+        else:
+            reconfig.set_nic(self._num)
+
     def do_iface_create(self):
         """ Setup the net
         """
         logger.info('creating network interface #%d', self._num)
-        logger.debug('... connected to %s', self.cfg_connected.cfg_name)
 
         if self.machine.is_global:
             logger.warning('... trying to setup a network interface in a global machine!!')
             return
 
-        try:
-            sleep(1.0)
-            session = self.machine.lock(lock_type='write')
-
-            # create a mutable copy of the machine for doing changes...
-            new_machine = session.machine
-            adapter = new_machine.get_network_adapter(self._num)
-
-            if self.cfg_type == 'nat':
-                logger.info('... type: NAT')
-                adapter.attachment_type = _virtualbox.library.NetworkAttachmentType.nat
-            elif self.cfg_connected.cfg_scope == 'private':
-                logger.info('... type: private')
-                adapter.attachment_type = _virtualbox.library.NetworkAttachmentType.internal
-                adapter.internal_network = self.cfg_connected.cfg_name
-
-            adapter.cable_connected = True
-            adapter.enabled = True
-
-            # save the new machine and unlock it
-            new_machine.save_settings()
-            self.machine.unlock(session)
-        except _virtualbox.library.VBoxError, e:
-            raise MachineChangeException(str(e))
-        else:
-            adapter = self.machine.vbox_machine.get_network_adapter(self._num)
-            logger.info("...... [%d] MAC:%s family:%s enabled:%s",
-                        adapter.slot,
-                        adapter.mac_address,
-                        adapter.adapter_type,
-                        adapter.enabled)
-            sleep(1.0)
+        reconfig = MachineReconfig(self.machine)
+        self.configure(reconfig)
+        reconfig.apply()
+
+        adapter = self.machine.vbox_machine.get_network_adapter(self._num)
+        logger.info("...... [%d] MAC:%s family:%s enabled:%s",
+                    adapter.slot,
+                    adapter.mac_address,
+                    adapter.adapter_type,
+                    adapter.enabled)
 
     def do_iface_up(self):
         """ Setup the interface in the guest machine
         """
         logger.info('setting up network interface #%d', self._num)
         self.machine.guest.setup_iface(self._num, type=self.cfg_type, ip=self.cfg_ip, netmask=self.cfg_netmask)
-        sleep(1.0)
+        if self.cfg_ip:
+            # wait until the guest additions report the new address
+            if not wait_until(lambda: self.cfg_ip in self.machine._query_ips(self.machine.vbox_machine),
+                              timeout=10.0, reason='interface up'):
+                logger.warning('... address %s not reported by the guest', self.cfg_ip)
 
     #####################
     # auxiliary
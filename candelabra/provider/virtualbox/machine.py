@@ -7,17 +7,22 @@
 from logging import getLogger
 import os
 import shutil
-from time import sleep
 
 import virtualbox as _virtualbox
 
 from candelabra.config import config
 from candelabra.constants import DEFAULT_CFG_SECTION_VIRTUALBOX, CFG_USERLAND_TIMEOUT, CFG_MACHINE_UPDOWN_TIMEOUT, CFG_MACHINE_COMMANDS_TIMEOUT
-from candelabra.errors import MachineChangeException, MachineException, MalformedTopologyException
+from candelabra.constants import CFG_VIRTUALBOX_CLONE_MODE, CFG_VIRTUALBOX_POOL_SIZE
+from candelabra.errors import MachineException, MalformedTopologyException
 from candelabra.plugins import build_communicator_instance, build_guest_instance
+from candelabra.provider.virtualbox.events import events_dispatcher
+from candelabra.provider.virtualbox.reconfig import MachineReconfig
+from candelabra.provider.virtualbox.sessions import SessionManager, LOCK_TYPES
+from candelabra.provider.virtualbox.snapshots import save_snapshot, restore_snapshot, delete_snapshot, find_template
 from candelabra.topology.machine import MachineNode
 from candelabra.topology.machine import STATE_POWERDOWN, STATE_RUNNING, STATE_PAUSED, STATE_ABORTED, STATE_STARTING, STATE_STOPPING, STATE_UNKNOWN
 from candelabra.topology.node import TopologyAttribute
+from candelabra.waits import wait_until
 
 logger = getLogger(__name__)
 
@@ -31,10 +36,10 @@ _VIRTUALBOX_ST_TO_STATES = {
     11: STATE_STOPPING,
 }
 
-LOCK_TYPES = {
-    'shared': _virtualbox.library.LockType.shared,
-    'write': _virtualbox.library.LockType.write,
-}
+# guest properties published by the guest additions
+_GUEST_PROP_ADDITIONS_VERSION = '/VirtualBox/GuestAdd/Version'
+_GUEST_PROP_NET_COUNT = '/VirtualBox/GuestInfo/Net/Count'
+_GUEST_PROP_NET_IP = '/VirtualBox/GuestInfo/Net/{num}/V4/IP'
 
 
 ########################################################################################################################
@@ -54,6 +59,10 @@ class VirtualboxMachineNode(MachineNode):
         TopologyAttribute('password', str, default='vagrant'),
         TopologyAttribute('userland_timeout', int, default=None),
         TopologyAttribute('commands_timeout', int, default=None),
+        TopologyAttribute('clone_mode', str, default=None),
+        TopologyAttribute('cpus', int, default=None),
+        TopologyAttribute('memory', int, default=None),
+        TopologyAttribute('snapshot', str, default=''),    # the snapshot the machine was restored from
     ]
 
     # attributes that are saved in the state file
@@ -83,9 +92,10 @@ class VirtualboxMachineNode(MachineNode):
         self._vbox_machine = None
         self._vbox_guest = None
         self._vbox_guest_os_type = None
-        self._vbox_wait_events = {}
+        self.sessions = SessionManager(self)
 
         self._created_shared_folders = []
+        self._snapshot_name = None
 
         # check and fix topology parameters
         if not self.cfg_gui in ['headless', 'gui']:
@@ -96,6 +106,10 @@ class VirtualboxMachineNode(MachineNode):
             self.cfg_userland_timeout = config.get_key(CFG_USERLAND_TIMEOUT)
         if not self.cfg_commands_timeout:
             self.cfg_commands_timeout = config.get_key(CFG_MACHINE_COMMANDS_TIMEOUT)
+        if not self.cfg_clone_mode:
+            self.cfg_clone_mode = config.get_key(CFG_VIRTUALBOX_CLONE_MODE)
+        if not self.cfg_clone_mode in ['import', 'linked', 'reflink']:
+            raise MalformedTopologyException('invalid clone mode %s' % self.cfg_clone_mode)
 
         # create a communicator for this machine
         self.communicator = build_communicator_instance(_class='virtualbox', machine=self)
@@ -106,16 +120,9 @@ class VirtualboxMachineNode(MachineNode):
         assert not self.is_global
 
         logger.debug('synchronizing VM name: setting as %s', self.cfg_name)
-        try:
-            s = self.lock(lock_type='write')
-            new_machine = s.machine
-            new_machine.name = self.cfg_name
-            new_machine.save_settings()
-            self.unlock(s)
-        except _virtualbox.library.VBoxError, e:
-            raise MachineChangeException(str(e))
-        else:
-            sleep(1.0)
+        reconfig = MachineReconfig(self)
+        reconfig.set_name(self.cfg_name)
+        reconfig.apply()
 
     def check_name(self):
         """ Check that the configured name matches the real VM name
@@ -128,6 +135,18 @@ class VirtualboxMachineNode(MachineNode):
             return False
         return True
 
+    #####################
+    # state
+    #####################
+
+    def get_state_dict(self):
+        """ Get current state as a dictionary, including the snapshot the machine was restored from
+        """
+        state_dict = super(VirtualboxMachineNode, self).get_state_dict()
+        if self.cfg_snapshot:
+            state_dict['snapshot'] = self.cfg_snapshot
+        return state_dict
+
     #####################
     # properties
     #####################
@@ -185,63 +204,76 @@ class VirtualboxMachineNode(MachineNode):
     def get_guest_level_system(self, guest=None, session=None):
         """ Return True if the guest session level is system
         """
+        s = None
         if not guest:
             s = self.lock() if not session else session
             guest = s.console.guest
 
-        res = bool(guest.get_additions_status(_virtualbox.library.AdditionsRunLevelType.system))
-        if not guest and not session:
-            self.unlock(s)
-        return res
+        try:
+            return bool(guest.get_additions_status(_virtualbox.library.AdditionsRunLevelType.system))
+        finally:
+            if s and not session:
+                self.unlock(s)
 
     def get_guest_level_userland(self, guest=None, session=None):
         """ Return True if the guest session level is userland
         """
+        s = None
         if not guest:
             s = self.lock() if not session else session
             guest = s.console.guest
 
-        res = bool(guest.get_additions_status(_virtualbox.library.AdditionsRunLevelType.userland))
-        if not session:
-            self.unlock(s)
-        return res
+        try:
+            return bool(guest.get_additions_status(_virtualbox.library.AdditionsRunLevelType.userland))
+        finally:
+            if s and not session:
+                self.unlock(s)
 
-    def get_state(self):
-        """ Get the VirtualBox machine state, as a recognized state code
+    def query_facts(self):
+        """ Get the runtime facts for this machine from VirtualBox, in one go
+
+        Facts about the guest (ie, the guest additions version or the IP addresses) are obtained
+        from the guest properties, so they do not need a session with the machine.
         """
-        if self.vbox_machine:
+        facts = {'state': STATE_UNKNOWN[0]}
+        vbox_machine = self.vbox_machine
+        if vbox_machine:
             try:
-                return _VIRTUALBOX_ST_TO_STATES[self.vbox_machine.state._value][0]
+                facts['state'] = _VIRTUALBOX_ST_TO_STATES[vbox_machine.state._value][0]
+                facts['guest_os'] = vbox_machine.os_type_id
+                facts['cpus'] = vbox_machine.cpu_count
+                facts['memory'] = vbox_machine.memory_size
+                if facts['state'] == STATE_RUNNING[0]:
+                    facts['additions_version'] = vbox_machine.get_guest_property_value(_GUEST_PROP_ADDITIONS_VERSION)
+                    facts['ips'] = self._query_ips(vbox_machine)
             except AttributeError, e:
                 logger.debug('no machine state available: %s', str(e))
             except KeyError, e:
                 logger.debug('no machine state available: %s', str(e))
+            except _virtualbox.library.VBoxError, e:
+                logger.debug('could not get all the machine facts: %s', str(e))
 
-        return STATE_UNKNOWN[0]
+        return facts
 
-    def wait_for_event(self, event, timeout=10000):
-        """ Wait for an event
+    def _query_ips(self, vbox_machine):
+        """ Get the IP addresses reported by the guest additions
+        """
+        ips = []
+        num_ifaces = vbox_machine.get_guest_property_value(_GUEST_PROP_NET_COUNT)
+        for num in xrange(int(num_ifaces) if num_ifaces else 0):
+            ip = vbox_machine.get_guest_property_value(_GUEST_PROP_NET_IP.format(num=num))
+            if ip:
+                ips.append(str(ip))
+        return ips
+
+    def wait_for_event(self, event, timeout=10.0, predicate=None, reason='event'):
+        """ Wait up to :param:`timeout` seconds for an event of this machine
         :param event: an instance of _virtualbox.library.VBoxEventType
+        :param reason: the reason for waiting (for the statistics)
+        :returns: the event received, or None if no event has been received
         """
-        self._vbox_wait_events[event] = False
-
-        def on_property_change(_event):
-            logger.debug('event: %s %s %s', _event.name, _event.value, _event.flags)
-            self._vbox_wait_events[event] = True
-
-        callback_id = self._vbox.event_source.register_callback(on_property_change, event)
-
-        # wait for some time...
-        num = 0
-        while not self._vbox_wait_events[event]:
-            sleep(1.0)
-            num += 1
-            if num >= timeout:
-                break
-
-        # clenaup
-        del self._vbox_wait_events[event]
-        _virtualbox.events.unregister_callback(callback_id)
+        return events_dispatcher().wait_for(self.cfg_uuid, [event], predicate=predicate, timeout=timeout,
+                                            reason=reason)
 
     #####################
     # guest sessions
@@ -249,7 +281,19 @@ class VirtualboxMachineNode(MachineNode):
 
     def get_guest_session(self, session, username='vagrant', password='vagrant', name='vagrant'):
         """ Get or create a guest session
+
+        The guest session is kept in the session manager while the :param:`session` is the session kept
+        open, so it is not looked up for every command.
         """
+        kept = session is self.sessions.session
+        if kept and self.sessions.guest_session:
+            try:
+                if self.sessions.guest_session.status == _virtualbox.library.GuestSessionStatus.started:
+                    return self.sessions.guest_session
+            except _virtualbox.library.VBoxError:
+                pass
+            self.sessions.guest_session = None
+
         guest_sessions = session.console.guest.sessions
         if len(guest_sessions) == 0:
             guest_session = session.console.guest.create_session(username, password, '', name)
@@ -257,43 +301,40 @@ class VirtualboxMachineNode(MachineNode):
                                          timeout_ms=self.cfg_updown_timeout * 1000)
         else:
             guest_session = guest_sessions[0]
+
+        if kept:
+            self.sessions.guest_session = guest_session
         return guest_session
 
     def wait_for_session_state_change(self, timeout=5):
         """ Wait for the session state to change
         """
         logger.debug('waiting up to %d seconds for state change...', timeout)
-        self.wait_for_event(event=_virtualbox.library.VBoxEventType.on_session_state_changed, timeout=timeout)
+        return self.wait_for_event(event=_virtualbox.library.VBoxEventType.on_session_state_changed, timeout=timeout,
+                                   reason='session state')
 
     def wait_for_guest_session_state_change(self, timeout=5):
-        """ Wait for the session state to change
+        """ Wait for the guest session state to change
+
+        Guest sessions events are only available in the console of the machine, so the console
+        events are dispatched while waiting.
         """
         logger.debug('waiting up to %d seconds for guest session state change...', timeout)
-        self.wait_for_event(event=_virtualbox.library.VBoxEventType.on_guest_session_state_changed, timeout=timeout)
+        event_type = _virtualbox.library.VBoxEventType.on_guest_session_state_changed
+        key = 'console-%s' % self.cfg_uuid
+        s = self.lock()
+        try:
+            with events_dispatcher().watch(self.cfg_uuid, [event_type]) as waiter:
+                events_dispatcher().attach(key, s.console.event_source, [event_type], self.cfg_uuid)
+                return waiter.wait(timeout, reason='guest session state')
+        finally:
+            events_dispatcher().detach(key)
+            self.unlock(s)
 
     def listen_events(self):
-        """ Listen for events
-        """
-
-        def on_property_change(_event):
-            logger.debug('event: %s', _event)
-
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_state_changed)
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_session_state_changed)
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_machine_state_changed)
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_additions_state_changed)
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_shared_folder_changed)
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_guest_keyboard)
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_guest_session_state_changed)
-        self._vbox.event_source.register_callback(on_property_change,
-                                                  _virtualbox.library.VBoxEventType.on_guest_process_registered)
+        """ Start listening for events (events are logged by the events dispatcher)
+        """
+        events_dispatcher().start()
 
     #####################
     # locking
@@ -301,22 +342,123 @@ class VirtualboxMachineNode(MachineNode):
 
     def lock(self, session=None, lock_type='shared'):
         """ Lock the machine
+
+        Unless a :param:`session` is provided, the session is obtained from the session manager of
+        the machine, so the same shared session is reused by all the operations.
         """
         assert lock_type in ['shared', 'write']
         assert self._vbox_machine is not None
-        session = session if session else _virtualbox.Session()
+        if not session:
+            return self.sessions.acquire(lock_type)
         self.vbox_machine.lock_machine(session, LOCK_TYPES[lock_type])
         return session
 
     def unlock(self, session):
         """ Unlock the machine
         """
-        session.unlock_machine()
+        self.sessions.release(session)
+
+    def wait_for_unlocked(self, timeout=5.0, reason='unlock'):
+        """ Wait until the machine is not locked by any session
+
+        :returns: True if the machine is unlocked, False if we have timed out
+        """
+        unlocked = _virtualbox.library.SessionState.unlocked
+        return wait_until(lambda: self.vbox_machine.session_state == unlocked, timeout=timeout, reason=reason)
 
     #####################
     # scheduling
     #####################
 
+    def get_requirements_up(self, requirements, from_snapshot=None):
+        """ Add the resources needed for the command "up" to some :class:`Requirements`
+
+        New machines need the disc space of the box disks (only once per box for linked clones),
+        and the box must be downloaded first if it is missing. Machines restored from a snapshot are
+        linked clones, so they only need memory. Machines that are not running need their memory
+        in the host.
+        """
+        if self.cfg_uuid:
+            if not self.is_running:
+                requirements.add_memory(int(self.facts.get('memory', 0)))
+            return
+
+        if from_snapshot:
+            template = find_template(self, from_snapshot)
+            if self.cfg_memory or template:
+                requirements.add_memory(self.cfg_memory or template.memory_size)
+            return
+
+        if self.cfg_memory:
+            requirements.add_memory(self.cfg_memory)
+
+        machine_folder = self._vbox.system_properties.default_machine_folder
+        box = self.cfg_box
+        if box.missing:
+            from candelabra.boxes import BoxesStorage
+            from candelabra.downloader import Download
+
+            # we do not know anything about the box until it is downloaded: use the size of the box file
+            # (obtained only once for all the machines using the box)
+            key = ('box', box.storage_name)
+            if key not in requirements.cache:
+                box.resolve()
+                download = Download(box.download_url, None) if box.download_url else None
+                requirements.cache[key] = download.get_remote_size() if download else None
+            size = requirements.cache[key]
+            if size:
+                requirements.add_space(BoxesStorage.get_storage_root(), size, key=key)
+                if self.cfg_clone_mode == 'linked':
+                    requirements.add_space(machine_folder, size, key=('master', box.storage_name))
+                else:
+                    requirements.add_space(machine_folder, size)
+            return
+
+        appliance = box.get_appliance(self.cfg_class)
+        if not appliance:
+            return
+
+        if self.cfg_clone_mode == 'linked':
+            if not appliance.has_master(box):
+                requirements.add_space(machine_folder, appliance.required_space,
+                                       key=('master', appliance.get_key(box)))
+        else:
+            requirements.add_space(machine_folder, appliance.required_space)
+        if not self.cfg_memory:
+            requirements.add_memory(appliance.descriptor['memory'])
+
+    def get_tasks_up(self, from_snapshot=None):
+        """ Get the tasks needed for the command "up"
+
+        When the machine does not exist and :param:`from_snapshot` is provided, the machine is restored
+        from that snapshot and resumed, and nothing else is needed.
+        """
+        if from_snapshot and not self.cfg_uuid:
+            self._snapshot_name = from_snapshot
+            self.add_task_seq(self.do_restore_snapshot)
+            self.add_task_seq(self.do_power_up)
+            return
+
+        if from_snapshot:
+            logger.info('%s seems to have been already created: snapshot "%s" ignored', self.cfg_name, from_snapshot)
+        super(VirtualboxMachineNode, self).get_tasks_up()
+
+    def get_tasks_snapshot_save(self, name):
+        """ Get the tasks needed for the command "snapshot save"
+        """
+        if self.is_running:
+            self._snapshot_name = name
+            self.add_task_seq(self.do_snapshot_save)
+        else:
+            logger.error('machine %s is not running!', self.cfg_name)
+            logger.error('... it must be running for this command (it will not be started automatically)')
+
+    def get_tasks_snapshot_delete(self, name):
+        """ Get the tasks needed for the command "snapshot delete"
+        """
+        self._snapshot_name = name
+        self.add_task_seq(self.do_snapshot_delete)
+
     def get_tasks_net_bridge(self):
         """ Get the tasks needed for the command "net up"
         """
@@ -335,19 +477,26 @@ class VirtualboxMachineNode(MachineNode):
     def do_power_up(self):
         """ Power up the machine via launch
         """
-        self.listen_events()
-
         logger.info('powering up "%s"', self.cfg_name)
-        try:
-            s = _virtualbox.Session()
-            p = self.vbox_machine.launch_vm_process(s, self.cfg_gui, "")
-            logger.info('... waiting from completion (up to %d seconds)', self.cfg_updown_timeout)
-            p.wait_for_completion(self.cfg_updown_timeout * 1000)
-            self.unlock(s)
-        except _virtualbox.library.VBoxError, e:
-            raise MachineException(str(e))
-        else:
-            sleep(1.0)
+        running = events_dispatcher().watch(self.cfg_uuid,
+                                            [_virtualbox.library.VBoxEventType.on_machine_state_changed],
+                                            predicate=lambda e: e.state == _virtualbox.library.MachineState.running)
+        with running:
+            try:
+                self.sessions.close()
+                s = _virtualbox.Session()
+                p = self.vbox_machine.launch_vm_process(s, self.cfg_gui, "")
+                logger.info('... waiting from completion (up to %d seconds)', self.cfg_updown_timeout)
+                p.wait_for_completion(self.cfg_updown_timeout * 1000)
+                self.unlock(s)
+            except _virtualbox.library.VBoxError, e:
+                raise MachineException(str(e))
+
+            if self.vbox_machine.state != _virtualbox.library.MachineState.running:
+                running.wait(float(self.cfg_updown_timeout), reason='power-up')
+
+        self.invalidate_facts()
+        self.record_state('up')
 
     def do_wait_userland(self):
         """ Wait for the guest session to be in userland-ready
@@ -367,15 +516,25 @@ class VirtualboxMachineNode(MachineNode):
                          self._vbox_guest.additions_version,
                          self._vbox_guest.additions_revision)
 
-            logger.info('waiting for machine up to %d seconds...', self.cfg_userland_timeout)
-            for _ in xrange(self.cfg_userland_timeout):
+            def is_userland_ready():
                 systemland = self.get_guest_level_system(guest=self._vbox_guest, session=s)
                 userland = self.get_guest_level_userland(guest=self._vbox_guest, session=s)
                 logger.debug('... status: system=%s userland=%s', systemland, userland)
-                if userland and systemland:
-                    break
-                else:
-                    sleep(1.0)
+                return userland and systemland
+
+            # the run levels are checked when the guest additions change (these events are only available
+            # in the console)
+            logger.info('waiting for machine up to %d seconds...', self.cfg_userland_timeout)
+            event_type = _virtualbox.library.VBoxEventType.on_additions_state_changed
+            key = 'additions-%s' % self.cfg_uuid
+            events_dispatcher().attach(key, s.console.event_source, [event_type], self.cfg_uuid)
+            try:
+                ready = events_dispatcher().wait_until(is_userland_ready, self.cfg_uuid, [event_type],
+                                                       timeout=self.cfg_userland_timeout, reason='userland')
+            finally:
+                events_dispatcher().detach(key)
+            if not ready:
+                logger.warning('... userland not ready after %d seconds', self.cfg_userland_timeout)
 
             logger.debug('%s facilities:', self.cfg_name)
             for f in self._vbox_guest.facilities:
@@ -384,7 +543,6 @@ class VirtualboxMachineNode(MachineNode):
         except _virtualbox.library.VBoxError, e:
             raise MachineException(str(e))
         else:
-            sleep(1.0)
             self.communicator.connected = True
         finally:
             self.unlock(s)
@@ -407,24 +565,25 @@ class VirtualboxMachineNode(MachineNode):
 
                 # wait for a change in the machine state
                 logger.info('waiting for machine to power down for up to %d seconds...', self.cfg_updown_timeout)
-                for _ in xrange(self.cfg_updown_timeout):
-                    systemland = self.get_guest_level_system(guest=self._vbox_guest, session=s)
-                    if not systemland:
-                        break
-                    else:
-                        sleep(1.0)
+                wait_until(lambda: not self.get_guest_level_system(guest=self._vbox_guest, session=s),
+                           timeout=self.cfg_updown_timeout, reason='guest shutdown')
 
             p = s.console.power_down()
             logger.info('... waiting from power down to finish (up to %d seconds)', self.cfg_updown_timeout)
             p.wait_for_completion(self.cfg_updown_timeout * 1000)
             logger.debug('...... done [code:%d]', p.result_code)
+            running = _virtualbox.library.MachineState.running
+            wait_until(lambda: self.vbox_machine.state < running,
+                       timeout=self.cfg_updown_timeout, reason='power down')
         except _virtualbox.library.VBoxError, e:
             raise MachineException(str(e))
         else:
-            sleep(1.0)
             self.communicator.connected = False
+            self.invalidate_facts()
+            self.record_state('down')
         finally:
             self.unlock(s)
+            self.sessions.close()
             self._vbox_guest = None
             self._vbox_guest_os_type = None
 
@@ -436,44 +595,98 @@ class VirtualboxMachineNode(MachineNode):
         try:
             p = s.console.pause()
             logger.info('... waiting from power down to finish (up to %d seconds)', self.cfg_updown_timeout)
-            while self.vbox_machine.state >= _virtualbox.library.MachineState.running:
-                sleep(1.0)
-                # p.wait_for_completion(self.cfg_updown_timeout * 1000)
+            paused = _virtualbox.library.MachineState.paused
+            if not wait_until(lambda: self.vbox_machine.state == paused,
+                              timeout=self.cfg_updown_timeout, reason='pause'):
+                logger.warning('... machine not paused after %d seconds', self.cfg_updown_timeout)
             logger.debug('...... done [code:%d]', p.result_code)
         except _virtualbox.library.VBoxError, e:
             raise MachineException(str(e))
         else:
-            sleep(1.0)
             self.communicator.connected = False
         finally:
             self.unlock(s)
+            self.invalidate_facts()
 
     def do_copy_appliance(self):
         """ Copy the appliance as a new virtual machine.
+
+        When warm pools are enabled, the machine is claimed from the pool of the box (and the pool is
+        refilled in the background when the command finishes) instead of importing the appliance.
         """
+        pool_size = int(config.get_key(CFG_VIRTUALBOX_POOL_SIZE))
+        appliance = self.cfg_box.get_appliance(self.cfg_class) if pool_size > 0 else None
+        if appliance:
+            pool = appliance.get_pool(self.cfg_box, clone_mode=self.cfg_clone_mode)
+            machine_uuid = pool.claim()
+            if machine_uuid:
+                pool.schedule_refill(pool_size)
+                self.cfg_uuid = machine_uuid
+                self.cfg_snapshot = ''
+                self.invalidate_facts()
+                self.record_state('created')
+                return
+
+        # the name is not synchronized here: the appliance can be something like 'redhat-minimal', but
+        # the nice, friendly name is set (with the rest of the settings) in `do_configure()`
         logger.debug('copying the appliance...')
+        self.cfg_snapshot = ''
         super(VirtualboxMachineNode, self).do_copy_appliance()
 
-        # we must synchronize the name, as the appliance can be something like 'redhat-minimal' and
-        # we want to set a nice, friendly name...
-        self.sync_name()
+    def do_restore_snapshot(self):
+        """ Create the machine from a snapshot (in a saved state, so it is resumed when powered up)
+        """
+        self.cfg_uuid = restore_snapshot(self, self._snapshot_name)
+        self.cfg_snapshot = self._snapshot_name
+        self.invalidate_facts()
+        self.record_state('restored')
+
+    def do_snapshot_save(self):
+        """ Take a live snapshot of the machine
+        """
+        save_snapshot(self, self._snapshot_name)
+
+    def do_snapshot_delete(self):
+        """ Delete a snapshot of the machine
+        """
+        delete_snapshot(self, self._snapshot_name)
+
+    def do_configure(self):
+        """ Configure the machine (name, CPUs, memory, network adapters and shared folders) with a
+        single change in the machine settings
+        """
+        assert not self.is_global
+
+        reconfig = MachineReconfig(self)
+        reconfig.set_name(self.cfg_name)
+        if self.cfg_cpus:
+            reconfig.set_cpus(self.cfg_cpus)
+        if self.cfg_memory:
+            reconfig.set_memory(self.cfg_memory)
+        for iface in self.cfg_interfaces:
+            iface.configure(reconfig)
+        for shared_folder in self.cfg_shared:
+            shared_folder.configure(reconfig)
+        reconfig.apply()
 
     def do_close_guest_sessions(self):
         """ Close all guest sessions
         """
         session = self.lock()
-        guest_sessions = session.console.guest.sessions
-        for session in guest_sessions:
-            session.close()
-        self.machine.unlock(session)
+        try:
+            for guest_session in session.console.guest.sessions:
+                guest_session.close()
+        finally:
+            self.unlock(session)
 
     def do_destroy(self):
         """ Destroy a virtual machine
         """
-        sleep(1.0)
         logger.info('destroying %s', self.cfg_name)
         try:
             if self.vbox_machine:
+                self.sessions.close()
+                self.wait_for_unlocked(reason='destroy')
                 media = self.vbox_machine.unregister(_virtualbox.library.CleanupMode.full)
                 p = self.vbox_machine.delete_config(media)
                 p.wait_for_completion(-1)
@@ -481,7 +694,6 @@ class VirtualboxMachineNode(MachineNode):
         except _virtualbox.library.VBoxErrorIprtError, e:
             logger.warning(str(e))
         else:
-            sleep(1.0)
             properties = self._vbox.system_properties
             full_path = os.path.join(properties.default_machine_folder, self.cfg_name)
             if os.path.isdir(full_path):
@@ -493,6 +705,8 @@ class VirtualboxMachineNode(MachineNode):
         self._vbox_machine = None
         self._vbox_guest = None
         self._vbox_guest_os_type = None
+        self.invalidate_facts()
+        self.record_state('destroyed')
 
     def do_create_user(self):
         """ Create a user
@@ -0,0 +1,126 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+A parser for OVF descriptors.
+
+The OVF descriptor of an appliance is parsed only once (when the box is added to the storage) and
+the information obtained is kept in the boxes index, so it can be used for validating the box,
+checking the disc space needed and deciding how the disks are imported (ie, if they can be cloned
+with reflinks) without parsing the OVF every time.
+
+VirtualBox still reads and interprets the OVF for every import: the import can only be done from
+the virtual system description VirtualBox builds, so the cached descriptor cannot replace it.
+"""
+
+import os
+import re
+from xml.etree import cElementTree as ElementTree
+from logging import getLogger
+
+from candelabra.errors import UnsupportedBoxException
+
+logger = getLogger(__name__)
+
+_NS_OVF = '{http://schemas.dmtf.org/ovf/envelope/1}'
+_NS_RASD = '{http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData}'
+_NS_VBOX = '{http://www.virtualbox.org/ovf/machine}'
+
+# resource types in the virtual hardware section
+_RESOURCE_CPU = '3'
+_RESOURCE_MEMORY = '4'
+_RESOURCE_NIC = '10'
+
+#: the format of stream-optimized disks
+STREAM_OPTIMIZED_FORMAT = 'http://www.vmware.com/interfaces/specifications/vmdk.html#streamOptimized'
+
+_UNITS_RE = re.compile(r'byte\s*\*\s*2\^(\d+)$', re.IGNORECASE)
+
+_UNITS = {
+    'bytes': 1,
+    'kilobytes': 1024,
+    'megabytes': 1024 * 1024,
+    'gigabytes': 1024 * 1024 * 1024,
+}
+
+
+def _parse_units(units, default=1):
+    """ Parse allocation units (ie, `byte * 2^30` or `MegaBytes`) as a number of bytes
+    """
+    if not units:
+        return default
+    m = _UNITS_RE.match(units.strip())
+    if m:
+        return 2 ** int(m.group(1))
+    return _UNITS.get(units.strip().lower(), default)
+
+
+def parse_ovf(ovf):
+    """ Parse an OVF descriptor
+
+    :returns: a dictionary with the `name`, `os_type`, number of `cpus`, `memory` (in Mb), number of
+              `nics` and the `disks` (with their `file`, `format`, `capacity` and `size`, in bytes) of the
+              first virtual system in the OVF.
+    :raises UnsupportedBoxException: if the OVF is not valid
+    """
+    try:
+        envelope = ElementTree.parse(ovf).getroot()
+    except (SyntaxError, IOError), e:
+        raise UnsupportedBoxException('invalid OVF file %s: %s' % (ovf, str(e)))
+
+    files = {}
+    for file_element in envelope.iter(_NS_OVF + 'File'):
+        files[file_element.get(_NS_OVF + 'id')] = {
+            'href': file_element.get(_NS_OVF + 'href'),
+            'size': int(file_element.get(_NS_OVF + 'size', 0)),
+        }
+
+    disks = []
+    for disk_element in envelope.iter(_NS_OVF + 'Disk'):
+        disk_file = files.get(disk_element.get(_NS_OVF + 'fileRef'), {})
+        capacity = int(disk_element.get(_NS_OVF + 'capacity', 0))
+        capacity *= _parse_units(disk_element.get(_NS_OVF + 'capacityAllocationUnits'))
+        disks.append({
+            'file': disk_file.get('href'),
+            'format': disk_element.get(_NS_OVF + 'format'),
+            'capacity': capacity,
+            'size': disk_file.get('size', 0),
+        })
+
+    descriptor = {
+        'name': None,
+        'os_type': None,
+        'cpus': 1,
+        'memory': 0,
+        'nics': 0,
+        'disks': disks,
+    }
+
+    virtual_system = envelope.find('.//' + _NS_OVF + 'VirtualSystem')
+    if virtual_system is not None:
+        descriptor['name'] = virtual_system.get(_NS_OVF + 'id')
+
+        os_section = virtual_system.find(_NS_OVF + 'OperatingSystemSection')
+        if os_section is not None:
+            os_type = os_section.find(_NS_VBOX + 'OSType')
+            descriptor['os_type'] = os_type.text if os_type is not None else os_section.get(_NS_OVF + 'id')
+
+        for item in virtual_system.iter(_NS_OVF + 'Item'):
+            resource_type = item.findtext(_NS_RASD + 'ResourceType')
+            quantity = item.findtext(_NS_RASD + 'VirtualQuantity')
+            if resource_type == _RESOURCE_CPU and quantity:
+                descriptor['cpus'] = int(quantity)
+            elif resource_type == _RESOURCE_MEMORY and quantity:
+                units = _parse_units(item.findtext(_NS_RASD + 'AllocationUnits'), default=1024 * 1024)
+                descriptor['memory'] = int(quantity) * units / (1024 * 1024)
+            elif resource_type == _RESOURCE_NIC:
+                descriptor['nics'] += 1
+
+    for disk in disks:
+        if not disk['file'] or not os.path.isfile(os.path.join(os.path.dirname(ovf), disk['file'])):
+            raise UnsupportedBoxException('disk file "%s" referenced in %s not found' % (disk['file'], ovf))
+
+    logger.debug('parsed %s: %s', ovf, descriptor)
+    return descriptor
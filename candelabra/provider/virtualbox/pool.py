@@ -0,0 +1,172 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Warm pools of VirtualBox machines.
+
+A pool keeps some stopped virtual machines, already created from a box, so new machines can be
+obtained by claiming (and renaming) one of them instead of importing the box. Pool machines are
+kept hidden in a VirtualBox group, and tagged with the key of the appliance they were created
+from and the clone mode used for creating them (so a new version of a box does not use machines
+from older versions, and machines are claimed only by machines with the same clone mode).
+
+After some machines are claimed, the pool is refilled in a background process (with the
+`candelabra boxes pool` command) when the command finishes, so the next machines can be claimed too.
+"""
+
+import os
+import sys
+import uuid
+import atexit
+import threading
+import subprocess
+from logging import getLogger
+
+import virtualbox as _virtualbox
+
+from candelabra.boxes import BoxesStorage
+from candelabra.config import config
+from candelabra.constants import CFG_VIRTUALBOX_CLONE_MODE
+
+logger = getLogger(__name__)
+
+#: prefix for the names of the machines in pools
+POOL_PREFIX = 'candelabra-pool-'
+
+#: group where the machines in pools are kept
+POOL_GROUP = '/candelabra-pool'
+
+#: extra data key with the pool a machine belongs to
+POOL_TAG = 'candelabra/pool'
+
+
+class VirtualboxPool(object):
+    """ A pool of pre-created machines for an appliance
+    """
+
+    def __init__(self, appliance, box, clone_mode=None):
+        """ Initialize the pool for the :param:`appliance` in a :param:`box`
+        """
+        self.appliance = appliance
+        self.box = box
+        self.clone_mode = clone_mode if clone_mode else config.get_key(CFG_VIRTUALBOX_CLONE_MODE)
+        self.key = '%s-%s' % (appliance.get_key(box), self.clone_mode)
+        self._vbox = _virtualbox.VirtualBox()
+
+    lock = property(lambda self: BoxesStorage.get_box_lock(POOL_PREFIX + self.key),
+                    doc='a lock for claiming machines from the pool')
+
+    fill_lock = property(lambda self: BoxesStorage.get_box_lock(POOL_PREFIX + self.key + '.fill'),
+                         doc='a lock for filling the pool')
+
+    def get_machines(self):
+        """ Get the machines available in the pool
+        """
+        machines = []
+        for machine in self._vbox.machines:
+            try:
+                if machine.get_extra_data(POOL_TAG) == self.key:
+                    machines.append(machine)
+            except _virtualbox.library.VBoxError:
+                pass            # inaccessible machines
+        return machines
+
+    def _tag(self, machine, name, group, tag):
+        """ Set the name, group and pool tag of a machine
+        """
+        session = _virtualbox.Session()
+        machine.lock_machine(session, _virtualbox.library.LockType.write)
+        try:
+            mutable_machine = session.machine
+            if name:
+                mutable_machine.name = name
+            mutable_machine.groups = [group]
+            mutable_machine.set_extra_data('GUI/HideFromManager', 'true' if tag else '')
+            mutable_machine.set_extra_data(POOL_TAG, tag)
+            mutable_machine.save_settings()
+        finally:
+            session.unlock_machine()
+
+    def claim(self):
+        """ Claim a machine from the pool
+
+        :returns: the UUID of the machine claimed, or None if the pool is empty
+        """
+        with self.lock:
+            for machine in self.get_machines():
+                if machine.state != _virtualbox.library.MachineState.powered_off:
+                    continue
+                try:
+                    self._tag(machine, None, '/', '')
+                except _virtualbox.library.VBoxError, e:
+                    logger.warning('could not claim "%s" from pool: %s', machine.name, str(e))
+                    continue
+
+                logger.info('claimed "%s" from the pool for box "%s"', machine.name, self.box.storage_name)
+                return machine.id_p
+
+        logger.debug('pool for box "%s" is empty', self.box.storage_name)
+        return None
+
+    def fill(self, size):
+        """ Create machines until there are :param:`size` machines in the pool
+
+        :returns: the number of machines created
+        """
+        if not self.fill_lock.acquire(blocking=False):
+            logger.info('pool for box "%s" is being filled by another process', self.box.storage_name)
+            return 0
+
+        created = 0
+        try:
+            while len(self.get_machines()) < size:
+                name = '%s%s-%s' % (POOL_PREFIX, self.key, uuid.uuid4().hex[:8])
+                machine_uuid = self.appliance.create_machine(name, self.box, clone_mode=self.clone_mode)
+                try:
+                    self._tag(self._vbox.find_machine(machine_uuid), name, POOL_GROUP, self.key)
+                except _virtualbox.library.VBoxError, e:
+                    logger.warning('could not add "%s" to the pool: %s', name, str(e))
+                    break
+                created += 1
+                logger.info('"%s" added to the pool for box "%s"', name, self.box.storage_name)
+        finally:
+            self.fill_lock.release()
+        return created
+
+    def schedule_refill(self, size):
+        """ Refill the pool (up to :param:`size` machines) in the background when the command finishes
+
+        The pool is refilled only once, no matter how many machines have been claimed from it.
+        """
+        with _refills_lock:
+            _refills[self.key] = (self, size)
+
+    def fill_async(self, size):
+        """ Fill the pool in a background process
+        """
+        logger.debug('refilling pool for box "%s" in the background', self.box.storage_name)
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen([sys.executable, '-m', 'candelabra.main', 'boxes', 'pool',
+                              '--provider', self.appliance.provider,
+                              '--size', str(size),
+                              '--clone-mode', self.clone_mode,
+                              self.box.storage_name],
+                             stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, preexec_fn=os.setsid)
+
+
+_refills = {}           # pool key -> (pool, size)
+_refills_lock = threading.Lock()
+
+
+@atexit.register
+def refill_pools():
+    """ Refill the pools machines have been claimed from
+    """
+    with _refills_lock:
+        refills = _refills.values()
+        _refills.clear()
+    for pool, size in refills:
+        pool.fill_async(size)
@@ -0,0 +1,148 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Batched reconfiguration of VirtualBox machines.
+
+Instead of locking the machine, changing something and saving the settings for every change
+(the name, every network adapter...), the desired settings are collected in a
+:class:`MachineReconfig` and applied in one write-locked session, with a single `save_settings()`:
+
+    >>> reconfig = MachineReconfig(machine)
+    >>> reconfig.set_name('web')
+    >>> reconfig.set_memory(512)
+    >>> reconfig.set_nic(1, _virtualbox.library.NetworkAttachmentType.internal, internal_network='private')
+    >>> reconfig.apply()
+
+Settings are compared with the current machine settings first, so only the settings that differ
+are changed, and the machine is not even locked when nothing differs.
+"""
+
+from logging import getLogger
+
+import virtualbox as _virtualbox
+
+from candelabra.errors import MachineChangeException
+
+logger = getLogger(__name__)
+
+
+def _get_shared_folder(machine, name):
+    """ Get the (host path, writable) of a permanent shared folder, or None if it does not exist
+    """
+    for shared_folder in machine.shared_folders:
+        if shared_folder.name == name:
+            return shared_folder.host_path, shared_folder.writable
+    return None
+
+
+def _set_shared_folder(machine, name, value):
+    """ Create a permanent shared folder (replacing any previous one with the same name)
+    """
+    if _get_shared_folder(machine, name):
+        machine.remove_shared_folder(name)
+    host_path, writable = value
+    machine.create_shared_folder(name, host_path, writable, False)
+
+
+class MachineReconfig(object):
+    """ A set of desired settings for a machine
+    """
+
+    def __init__(self, machine):
+        """ Initialize the reconfiguration of a :param:`machine` (a :class:`VirtualboxMachineNode`)
+        """
+        self.machine = machine
+        self._settings = []         # list of (description, getter, setter, value)
+
+    def _add(self, description, getter, setter, value):
+        self._settings.append((description, getter, setter, value))
+
+    def set_name(self, name):
+        self._add('name',
+                  lambda m: m.name,
+                  lambda m, v: setattr(m, 'name', v),
+                  name)
+
+    def set_cpus(self, cpus):
+        self._add('CPUs',
+                  lambda m: m.cpu_count,
+                  lambda m, v: setattr(m, 'cpu_count', v),
+                  int(cpus))
+
+    def set_memory(self, memory):
+        self._add('memory',
+                  lambda m: m.memory_size,
+                  lambda m, v: setattr(m, 'memory_size', v),
+                  int(memory))
+
+    def set_nic(self, slot, attachment_type=None, internal_network=None, cable_connected=True, enabled=True):
+        """ Set the settings of the network adapter in :param:`slot` (the attachment type is not
+        changed when :param:`attachment_type` is None)
+        """
+        def adapter_setting(attr, value):
+            self._add('NIC #%d %s' % (slot, attr.replace('_', ' ')),
+                      lambda m: getattr(m.get_network_adapter(slot), attr),
+                      lambda m, v: setattr(m.get_network_adapter(slot), attr, v),
+                      value)
+
+        if attachment_type is not None:
+            adapter_setting('attachment_type', attachment_type)
+        if internal_network is not None:
+            adapter_setting('internal_network', internal_network)
+        adapter_setting('cable_connected', cable_connected)
+        adapter_setting('enabled', enabled)
+
+    def add_shared_folder(self, name, host_path, writable=True):
+        """ Add a permanent shared folder
+        """
+        self._add('shared folder "%s"' % name,
+                  lambda m: _get_shared_folder(m, name),
+                  lambda m, v: _set_shared_folder(m, name, v),
+                  (host_path, bool(writable)))
+
+    def get_changes(self):
+        """ Get the settings that differ from the current machine settings
+
+        :returns: a list of (description, setter, value)
+        """
+        vbox_machine = self.machine.vbox_machine
+        changes = []
+        try:
+            for description, getter, setter, value in self._settings:
+                current = getter(vbox_machine)
+                if current != value:
+                    logger.debug('... %s: %s -> %s', description, current, value)
+                    changes.append((description, setter, value))
+        except _virtualbox.library.VBoxError, e:
+            raise MachineChangeException(str(e))
+        return changes
+
+    def apply(self):
+        """ Apply the settings that differ, in a single write-locked session
+
+        :returns: the number of settings changed
+        """
+        logger.debug('reconfiguring "%s"', self.machine.cfg_name)
+        changes = self.get_changes()
+        if not changes:
+            logger.debug('... nothing to change')
+            return 0
+
+        logger.info('changing %s in "%s"', ', '.join(c[0] for c in changes), self.machine.cfg_name)
+        try:
+            session = self.machine.lock(lock_type='write')
+            try:
+                mutable_machine = session.machine
+                for description, setter, value in changes:
+                    setter(mutable_machine, value)
+                mutable_machine.save_settings()
+            finally:
+                self.machine.unlock(session)
+        except _virtualbox.library.VBoxError, e:
+            raise MachineChangeException(str(e))
+
+        self.machine.invalidate_facts()
+        return len(changes)
@@ -0,0 +1,168 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Long-lived sessions for VirtualBox machines.
+
+Every operation on a machine (running a command in the guest, getting the guest type, creating a
+shared folder...) needs a session with the machine locked. Instead of creating a new session and
+locking/unlocking the machine for every operation, each machine has a session manager that keeps
+a shared-lock session open and hands it out with reference counting:
+
+    >>> s = manager.acquire()
+    >>> ... use s.console ...
+    >>> manager.release(s)
+
+Write locks are only taken when needed: the shared session is closed (it must not be in use) and
+a write-lock session is created, and this session is closed as soon as it is released, so other
+processes (ie, VBoxManage) can change the machine too.
+
+The guest session used for running commands in the guest is kept too, so it is not looked up
+again for every command while the session is open.
+
+Operations that need the machine completely unlocked (ie, launching it or destroying it) must
+:meth:`SessionManager.close` the session kept open first.
+"""
+
+import atexit
+import weakref
+import threading
+from logging import getLogger
+
+import virtualbox as _virtualbox
+
+from candelabra.errors import MachineException
+
+logger = getLogger(__name__)
+
+LOCK_TYPES = {
+    'shared': _virtualbox.library.LockType.shared,
+    'write': _virtualbox.library.LockType.write,
+}
+
+
+class SessionManager(object):
+    """ The manager of the session of a machine
+    """
+
+    def __init__(self, machine):
+        """ Initialize the manager for a :param:`machine` (a :class:`VirtualboxMachineNode`)
+        """
+        self.machine = machine
+        self._lock = threading.RLock()
+        self._session = None
+        self._lock_type = None
+        self._refs = 0
+        self.guest_session = None       # the guest session in the session kept open
+
+        _managers.add(self)
+
+    @property
+    def is_open(self):
+        return self._session is not None
+
+    @property
+    def session(self):
+        """ The session kept open (or None)
+        """
+        return self._session
+
+    def acquire(self, lock_type='shared'):
+        """ Get a session with the machine locked (at least) with :param:`lock_type`
+
+        The session must be released with :meth:`release` when it is not needed anymore.
+        """
+        assert lock_type in LOCK_TYPES
+        with self._lock:
+            if self._session and not self._is_usable():
+                logger.debug('session for "%s" is not usable: reopening', self.machine.cfg_name)
+                self._close(force=True)
+
+            if self._session and (lock_type == self._lock_type or self._lock_type == 'write'):
+                self._refs += 1
+                return self._session
+
+            if self._session:
+                # escalate from a shared lock to a write lock
+                if self._refs > 0:
+                    raise MachineException('cannot get a write lock for "%s": the machine is in use' %
+                                           self.machine.cfg_name)
+                logger.debug('escalating to a write lock for "%s"', self.machine.cfg_name)
+                self._close()
+
+            session = _virtualbox.Session()
+            try:
+                self.machine.vbox_machine.lock_machine(session, LOCK_TYPES[lock_type])
+            except _virtualbox.library.VBoxError:
+                # wait only when the machine is still unlocking (ie, after our own shared session has been
+                # closed): when it is locked by another process (or the VM), fail now
+                unlocking = _virtualbox.library.SessionState.unlocking
+                if lock_type != 'write' or self.machine.vbox_machine.session_state != unlocking:
+                    raise
+                logger.debug('could not get a write lock for "%s": waiting for unlock', self.machine.cfg_name)
+                if not self.machine.wait_for_unlocked(reason='write lock'):
+                    raise
+                self.machine.vbox_machine.lock_machine(session, LOCK_TYPES[lock_type])
+
+            self._session, self._lock_type, self._refs = session, lock_type, 1
+            return session
+
+    def release(self, session):
+        """ Release a session obtained with :meth:`acquire`
+
+        Shared sessions are kept open, while write sessions are closed when they are not in use.
+        """
+        with self._lock:
+            if session is not self._session:
+                # not a session from this manager (or it has been closed already)
+                if session.state == _virtualbox.library.SessionState.locked:
+                    session.unlock_machine()
+                return
+
+            assert self._refs > 0
+            self._refs -= 1
+            if self._refs == 0 and self._lock_type == 'write':
+                self._close()
+
+    def close(self):
+        """ Close the session kept open (if it is not in use)
+
+        :returns: True if there is no session open
+        """
+        with self._lock:
+            if self._session and self._refs > 0:
+                logger.warning('session for "%s" is in use: it cannot be closed', self.machine.cfg_name)
+                return False
+            self._close()
+            return True
+
+    def _is_usable(self):
+        try:
+            return self._session.state == _virtualbox.library.SessionState.locked
+        except _virtualbox.library.VBoxError:
+            return False
+
+    def _close(self, force=False):
+        if self._session:
+            if force:
+                self._refs = 0
+            try:
+                if self._session.state == _virtualbox.library.SessionState.locked:
+                    self._session.unlock_machine()
+            except _virtualbox.library.VBoxError, e:
+                logger.debug('could not close session for "%s": %s', self.machine.cfg_name, str(e))
+            self._session, self._lock_type = None, None
+            self.guest_session = None
+
+
+_managers = weakref.WeakSet()
+
+
+@atexit.register
+def close_all_sessions():
+    """ Close the sessions kept open (ie, at exit)
+    """
+    for manager in list(_managers):
+        manager.close()
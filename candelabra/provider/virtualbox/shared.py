@@ -10,7 +10,7 @@ import os
 import virtualbox as _virtualbox
 from candelabra.topology.node import TopologyAttribute
 
-from candelabra.topology.shared import SharedNode
+from candelabra.topology.shared import SharedNode, _path_norm
 
 
 logger = getLogger(__name__)
@@ -30,6 +30,10 @@ class VirtualboxSharedNode(SharedNode):
 
         assert self._container is not None and isinstance(self._container, VirtualboxMachineNode)
 
+        # the local path is normalized once, so it can be compared with the host path of the shared folders
+        if self.cfg_local:
+            self.cfg_local = _path_norm(self.cfg_local)
+
         self.installed = False
 
     @property
@@ -40,20 +44,29 @@ class VirtualboxSharedNode(SharedNode):
     # tasks
     #####################
 
+    def configure(self, reconfig):
+        """ Add the folder as a permanent shared folder to a :class:`MachineReconfig`
+        """
+        if os.path.isdir(self.cfg_local):
+            reconfig.add_shared_folder(self.cfg_remote, self.cfg_local, writable=self.cfg_writable)
+
     def do_shared_create(self):
         """ Share the folders
         """
         assert not self.machine.is_global
 
+        # the folder could be shared already when the machine was configured
+        for shared_folder in self.machine.vbox_machine.shared_folders:
+            if shared_folder.name == self.cfg_remote and shared_folder.host_path == self.cfg_local:
+                logger.info('folder already shared: %s -> %s', self.cfg_local, self.cfg_remote)
+                self.installed = True
+                return
+
         s = self.machine.lock()
         try:
-            local_path = os.path.abspath(os.path.expandvars(self.cfg_local))
+            local_path = self.cfg_local
             remote_path = self.cfg_remote
 
-            # update the paths, so they are left for the "mount" action
-            self.cfg_local = local_path
-            self.cfg_remote = remote_path
-
             if not os.path.exists(local_path):
                 logger.warning('... local folder %s does not exist! skipping...', local_path)
             elif not os.path.isdir(local_path):
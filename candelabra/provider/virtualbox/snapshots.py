@@ -0,0 +1,208 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Live snapshots of fully configured machines.
+
+A snapshot of a running machine (after it has been booted, configured and provisioned) is kept in
+a hidden template VM, a full clone of the machine in a saved state, so the snapshot survives the
+machine being destroyed. The template has a base snapshot, and machines are restored as linked
+clones of this snapshot: they are created in the saved state, so powering them up resumes the
+machine instead of booting it, and there is nothing else to do (no userland wait, no network
+configuration, no shared folders mounts, no provisioning...).
+
+Templates are named after the topology, the machine and the snapshot, so every machine gets its
+own snapshot (ie, `candelabra-snapshot-1a2b3c4d-web-ready`).
+"""
+
+import os
+import hashlib
+from logging import getLogger
+
+import virtualbox as _virtualbox
+
+from candelabra.errors import MachineException
+
+logger = getLogger(__name__)
+
+#: prefix for the names of the templates VMs
+SNAPSHOT_PREFIX = 'candelabra-snapshot-'
+
+#: group where templates VMs are kept
+SNAPSHOT_GROUP = '/candelabra-snapshots'
+
+#: name of the snapshot (in the template) machines are restored from
+SNAPSHOT_BASE = 'base'
+
+#: suffix for the name of a template while it is being saved
+NEW_SUFFIX = '.new'
+
+#: the clone options: machines keep the MAC addresses, as the saved guest has its network configured
+_CLONE_OPTIONS = [_virtualbox.library.CloneOptions.keep_all_ma_cs]
+
+
+def get_template_name(machine_node, name):
+    """ Get the name of the template VM for the snapshot :param:`name` of a machine
+
+    The name includes a key for the topology (obtained from its state file), so machines with the same
+    name in different topologies do not share their snapshots.
+    """
+    state = machine_node.topology_state
+    if state is not None and state.enabled:
+        topology_key = hashlib.sha1(os.path.abspath(state.filename)).hexdigest()[:8]
+        return '%s%s-%s-%s' % (SNAPSHOT_PREFIX, topology_key, machine_node.cfg_name, name)
+    return '%s%s-%s' % (SNAPSHOT_PREFIX, machine_node.cfg_name, name)
+
+
+def _find_machine(name):
+    try:
+        return _virtualbox.VirtualBox().find_machine(name)
+    except _virtualbox.library.VBoxErrorObjectNotFound:
+        return None
+
+
+def find_template(machine_node, name):
+    """ Find the template VM for the snapshot :param:`name` of a machine
+
+    :returns: the template, or None if there is no such snapshot
+    """
+    # a new template that could not be renamed after replacing the previous one is still valid
+    template_name = get_template_name(machine_node, name)
+    return _find_machine(template_name) or _find_machine(template_name + NEW_SUFFIX)
+
+
+def _delete_template(template):
+    """ Unregister a template VM and delete its files
+    """
+    media = template.unregister(_virtualbox.library.CleanupMode.full)
+    progress = template.delete_config(media)
+    progress.wait_for_completion(-1)
+
+
+def _rename_template(template, name):
+    session = _virtualbox.Session()
+    template.lock_machine(session, _virtualbox.library.LockType.write)
+    try:
+        session.machine.name = name
+        session.machine.save_settings()
+    finally:
+        session.unlock_machine()
+
+
+def save_snapshot(machine_node, name):
+    """ Take a live snapshot :param:`name` of a running machine
+
+    Any previous snapshot with the same name is replaced, but only once the new snapshot has been
+    saved: the snapshot is saved in a new template, and then the old template is deleted and the new
+    one takes its name.
+    """
+    template_name = get_template_name(machine_node, name)
+    new_template_name = template_name + NEW_SUFFIX
+    logger.info('taking snapshot "%s" of "%s"', name, machine_node.cfg_name)
+
+    s = machine_node.lock()
+    try:
+        progress, snapshot_id = s.machine.take_snapshot(name, 'candelabra snapshot', False)
+        progress.wait_for_completion(-1)
+    except _virtualbox.library.VBoxError, e:
+        raise MachineException('could not take snapshot of "%s": %s' % (machine_node.cfg_name, str(e)))
+    finally:
+        machine_node.unlock(s)
+
+    template = None
+    replaced = False
+    try:
+        # a new template left by a previous save is complete if it replaced the previous template already
+        leftover = _find_machine(new_template_name)
+        if leftover:
+            if _find_machine(template_name):
+                _delete_template(leftover)
+            else:
+                _rename_template(leftover, template_name)
+
+        logger.info('... saving snapshot as "%s"', template_name)
+        vbox_machine = machine_node.vbox_machine
+        template = vbox_machine.clone(snapshot_name_or_id=vbox_machine.find_snapshot(snapshot_id),
+                                      mode=_virtualbox.library.CloneMode.machine_state,
+                                      options=_CLONE_OPTIONS,
+                                      name=new_template_name,
+                                      groups=[SNAPSHOT_GROUP])
+
+        session = _virtualbox.Session()
+        template.lock_machine(session, _virtualbox.library.LockType.write)
+        try:
+            mutable_template = session.machine
+            mutable_template.set_extra_data('GUI/HideFromManager', 'true')
+            mutable_template.save_settings()
+            progress, _ = mutable_template.take_snapshot(SNAPSHOT_BASE, 'candelabra snapshot base', False)
+            progress.wait_for_completion(-1)
+        finally:
+            session.unlock_machine()
+
+        # replace the old template
+        old_template = _find_machine(template_name)
+        if old_template:
+            logger.info('... replacing the previous snapshot "%s"', name)
+            _delete_template(old_template)
+        replaced = True
+
+        _rename_template(template, template_name)
+    except _virtualbox.library.VBoxError, e:
+        # keep the new template if the previous one has been deleted already (so there is still a snapshot)
+        if template and not replaced:
+            try:
+                _delete_template(template)
+            except _virtualbox.library.VBoxError:
+                logger.warning('could not remove the incomplete snapshot "%s"', new_template_name)
+        raise MachineException('could not save snapshot "%s" of "%s" (are there machines restored from '
+                               'the previous snapshot?): %s' % (name, machine_node.cfg_name, str(e)))
+    finally:
+        # the snapshot is not needed in the machine anymore
+        try:
+            s = machine_node.lock()
+            try:
+                progress = s.machine.delete_snapshot(snapshot_id)
+                progress.wait_for_completion(-1)
+            finally:
+                machine_node.unlock(s)
+        except _virtualbox.library.VBoxError, e:
+            logger.warning('could not remove snapshot "%s" from "%s": %s', name, machine_node.cfg_name, str(e))
+
+
+def restore_snapshot(machine_node, name):
+    """ Create a machine from the snapshot :param:`name`
+
+    :returns: the UUID of the new machine (in a saved state)
+    """
+    template = find_template(machine_node, name)
+    if not template:
+        raise MachineException('there is no snapshot "%s" for "%s"' % (name, machine_node.cfg_name))
+
+    logger.info('restoring "%s" from snapshot "%s"', machine_node.cfg_name, name)
+    try:
+        clone = template.clone(snapshot_name_or_id=SNAPSHOT_BASE,
+                               mode=_virtualbox.library.CloneMode.machine_state,
+                               options=[_virtualbox.library.CloneOptions.link] + _CLONE_OPTIONS,
+                               name=machine_node.cfg_name)
+    except _virtualbox.library.VBoxError, e:
+        raise MachineException('could not restore snapshot "%s" of "%s": %s' % (name, machine_node.cfg_name, str(e)))
+    return clone.id_p
+
+
+def delete_snapshot(machine_node, name):
+    """ Delete the snapshot :param:`name` of a machine (if it exists)
+
+    Snapshots cannot be deleted while there are machines restored from them.
+    """
+    template = find_template(machine_node, name)
+    if not template:
+        return
+
+    logger.info('deleting snapshot "%s" of "%s"', name, machine_node.cfg_name)
+    try:
+        _delete_template(template)
+    except _virtualbox.library.VBoxError, e:
+        raise MachineException('could not delete snapshot "%s" of "%s" (are there machines restored from it?): %s' %
+                               (name, machine_node.cfg_name, str(e)))
@@ -0,0 +1,146 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+The topologies registry.
+
+The registry is a host-wide index of all the topologies that have been created in this host, updated
+every time the state of a topology is saved. For each topology, it keeps:
+
+* the topology file path.
+* the machines in the topology, with their UUIDs and boxes.
+* the last command run on the topology.
+* the resources used by the topology (number of machines, CPUs and memory).
+
+so things like listing all the topologies, or checking what boxes are being used, do not need to
+scan the filesystem or query the provider.
+"""
+
+import os
+import json
+import time
+from logging import getLogger
+
+from candelabra.config import config
+from candelabra.constants import CFG_REGISTRY_PATH
+from candelabra.files import atomic_write, FileLock
+
+logger = getLogger(__name__)
+
+
+class TopologiesRegistry(object):
+    """ The registry of topologies in this host
+    """
+
+    def __init__(self, path=None):
+        """ Initialize the registry
+        """
+        self.path = path if path else TopologiesRegistry.get_registry_path()
+        self.topologies = {}
+        self.load()
+
+    @staticmethod
+    def get_registry_path():
+        """ Get the path for the registry file
+        """
+        return os.path.expandvars(config.get_key(CFG_REGISTRY_PATH))
+
+    @property
+    def lock(self):
+        """ A lock for serializing updates from different processes
+        """
+        return FileLock(self.path + '.lock')
+
+    def load(self):
+        """ Load the registry from disc
+        """
+        self.topologies = {}
+        if os.path.exists(self.path):
+            with open(self.path) as registry_file:
+                try:
+                    self.topologies = json.load(registry_file)
+                except ValueError:
+                    logger.warning('registry: invalid registry file at %s: ignoring it', self.path)
+        return self.topologies
+
+    def _save(self):
+        """ Save the registry to disc (the lock must be held)
+        """
+        atomic_write(self.path, json.dumps(self.topologies, indent=2, sort_keys=True))
+
+    def update(self, topology):
+        """ Update the registry entry for a :class:`TopologyRoot`
+        """
+        topology_path = os.path.abspath(topology._filename)
+
+        machines = []
+        resources = {'machines': 0, 'cpus': 0, 'memory': 0}
+        for machine in topology.machines:
+            machine_state = machine.get_state_dict()
+            if not machine_state.get('uuid'):
+                continue
+
+            facts = machine_state.get('facts', {})
+            box = getattr(machine, 'cfg_box', None)
+            machines.append({
+                'name': machine.cfg_name,
+                'uuid': machine_state['uuid'],
+                'class': machine.cfg_class,
+                'box': box.storage_name if box else None,
+            })
+            resources['machines'] += 1
+            resources['cpus'] += int(facts.get('cpus', 0))
+            resources['memory'] += int(facts.get('memory', 0))
+
+        entry = {
+            'path': topology_path,
+            'machines': machines,
+            'last_command': topology.last_command,
+            'updated': time.time(),
+            'resources': resources,
+        }
+
+        logger.debug('registry: updating entry for %s', topology_path)
+        with self.lock:
+            self.load()
+            if not entry['last_command'] and topology_path in self.topologies:
+                entry['last_command'] = self.topologies[topology_path].get('last_command')
+            self.topologies[topology_path] = entry
+            self._save()
+
+    def remove(self, topology_path):
+        """ Remove the entry for a topology from the registry
+        """
+        topology_path = os.path.abspath(topology_path)
+        with self.lock:
+            self.load()
+            if topology_path in self.topologies:
+                logger.debug('registry: removing entry for %s', topology_path)
+                del self.topologies[topology_path]
+                self._save()
+
+    def get_totals(self):
+        """ Get the resources used by all the topologies in the host
+        """
+        totals = {'topologies': len(self.topologies), 'machines': 0, 'cpus': 0, 'memory': 0}
+        for entry in self.topologies.itervalues():
+            for k, v in entry.get('resources', {}).iteritems():
+                totals[k] = totals.get(k, 0) + v
+        return totals
+
+    def get_boxes(self):
+        """ Get the set of boxes names used by all the topologies in the host
+        """
+        return {m['box'] for entry in self.topologies.itervalues() for m in entry.get('machines', []) if m.get('box')}
+
+
+_registry = None
+
+
+def registry_factory():
+    global _registry
+    if not _registry or _registry.path != TopologiesRegistry.get_registry_path():
+        _registry = TopologiesRegistry()
+    return _registry
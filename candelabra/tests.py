@@ -27,3 +27,106 @@ class CandelabraTestBase(unittest.TestCase):
 skipTravis = lambda x: unittest.skipIf(os.environ.get('TRAVIS', '').lower() in ['true', 'yes', '1'],
 	                                   'running in Travis-CI')
 
+
+def make_box_file(files, compression=''):
+    """ Make the contents of a box file (a tar file with some :param:`files`, as a dictionary `name: content`)
+    """
+    import tarfile
+    import StringIO
+
+    output = StringIO.StringIO()
+    tar = tarfile.open(fileobj=output, mode='w|' + compression)
+    for name, content in sorted(files.items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, StringIO.StringIO(content))
+    tar.close()
+    return output.getvalue()
+
+
+class BytesHTTPServer(object):
+    """ A local HTTP server that serves some bytes, for testing downloads
+
+    The server can be configured for supporting (or refusing) `Range` requests, and for dropping
+    the connection after sending some bytes. All the requests headers are recorded in `requests`.
+
+    The :param:`content` can also be a dictionary of `path: content`, for serving several files.
+    Conditional requests (with `If-None-Match`) are supported.
+    """
+
+    def __init__(self, content, ranges=True, drop_after=None):
+        import threading
+        import BaseHTTPServer
+        import SocketServer
+
+        self.content = content
+        self.ranges = ranges
+        self.drop_after = drop_after
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                import hashlib
+
+                server.requests.append(dict(self.headers, path=self.path))
+                if isinstance(server.content, dict):
+                    if self.path not in server.content:
+                        self.send_error(404)
+                        return
+                    content = server.content[self.path]
+                    etag = '"%s"' % hashlib.sha1(content).hexdigest()
+                else:
+                    content = server.content
+                    etag = '"some-etag"'
+
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+
+                range_header = self.headers.get('Range')
+                if server.ranges and range_header:
+                    start, end = range_header.split('=')[1].split('-')
+                    start = int(start)
+                    end = int(end) if end else len(content) - 1
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(content)))
+                    content = content[start:end + 1]
+                else:
+                    self.send_response(200)
+                    if server.ranges:
+                        self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+
+                if server.drop_after is not None and len(content) > server.drop_after:
+                    # drop the connection (only once)
+                    content = content[:server.drop_after]
+                    server.drop_after = None
+                self.wfile.write(content)
+
+        class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = ThreadedServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return self.url_for('/some.box')
+
+    def url_for(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_address[1], path)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -5,23 +5,29 @@
 #
 
 import os
+import time
+import shutil
+from distutils.version import LooseVersion
 from logging import getLogger
-import tempfile
-import tarfile
 import json
 
+from candelabra.blobs import blobs_store_factory, normalize_checksum
+from candelabra.catalog import BoxCatalog, is_catalog_url
+from candelabra.config import config
+from candelabra.constants import CFG_DOWNLOAD_STREAMING, CFG_DEFAULT_PROVIDER, CFG_CATALOG_TTL, BOX_MANIFEST_FILE
+from candelabra.downloader import Download
+from candelabra.extractor import extract_stream, file_chunks, get_physical_size
+from candelabra.files import atomic_write
+from candelabra.mirror import get_mirrors, find_in_mirrors
 from candelabra.tasks import TaskGenerator
-from candelabra.errors import UnsupportedBoxException, ImportException
+from candelabra.errors import UnsupportedBoxException, ImportException, ChecksumMismatchException
 from candelabra.plugins import PLUGINS_REGISTRIES
 from candelabra.topology.node import TopologyNode, TopologyAttribute
 
 logger = getLogger(__name__)
 
-#: a mbyte
-MBYTE = 1024 * 1024
-
-#: download chunk size
-CHUNK_SIZE = 4 * MBYTE
+#: versions resolved from catalogs, by (url, version, provider), as (time, resolved version)
+_resolved_catalogs = {}
 
 
 class BoxNode(TopologyNode, TaskGenerator):
@@ -30,6 +36,20 @@ class BoxNode(TopologyNode, TaskGenerator):
 
     Boxes contain subdirectories for providers, where appliances are stored.
 
+    Boxes are stored in a content-addressed way: the checksums of the box file and of all the files
+    in the box are kept in a manifest file in the box directory, and the files are hardlinks to the
+    blobs in the blobs store, so boxes with the same contents do not use extra disc space.
+    Topologies can pin the expected checksum of a box with a `checksum` attribute.
+
+    The `url` can also point to a Vagrant-style catalog (a `.json` file) with all the versions of
+    the box. In this case, the latest version (or the `version` requested) is used, and each version
+    is stored in its own directory (ie, `box1@1.0.2`), so new versions can be downloaded while
+    machines created from older versions keep using them.
+
+    Boxes are looked for in the `mirrors` (a list of URLs of hosts running `candelabra boxes serve`,
+    plus the mirrors in the config file) before downloading them from the `url`, starting with the
+    nearest mirror.
+
     Example: box1 has two appliances: a virtualbox appliance and a vmware appliance
 
 .. code-block:: yaml
@@ -47,6 +67,9 @@ class BoxNode(TopologyNode, TaskGenerator):
         TopologyAttribute('name', str, default='', inherited=True),
         TopologyAttribute('path', str, default='', inherited=True),
         TopologyAttribute('url', str, default='', inherited=True),
+        TopologyAttribute('checksum', str, default='', inherited=True),
+        TopologyAttribute('version', str, default='', inherited=True),
+        TopologyAttribute('mirrors', str, default=[], inherited=True),
         TopologyAttribute('username', str, default='vagrant', inherited=True),
         TopologyAttribute('password', str, default='password', inherited=True),
         TopologyAttribute('sudo_command', str, default='/usr/bin/sudo', inherited=True),
@@ -55,24 +78,165 @@ class BoxNode(TopologyNode, TaskGenerator):
 
     def __init__(self, _parent=None, **kwargs):
         """ Initialize a topology node
+
+        Boxes can be initialized from an entry in the boxes index (with the `_index_entry` argument),
+        so nothing has to be read from the box directory.
         """
+        index_entry = kwargs.pop('_index_entry', None)
         super(BoxNode, self).__init__(_parent=_parent, **kwargs)
         TopologyAttribute.setall(self, kwargs, self.__known_attributes)
 
         self.appliances = {}
+        self.loaded = False
+        self.checksum = None
+        self.files = {}
+
+        # the bandwidth limiter and the number of bytes transferred in the last download
+        self.limiter = None
+        self.transferred = 0
+
+        # the version, URL and checksum resolved from a catalog
+        self.version = self.cfg_version or None
+        self.download_url = self.cfg_url
+        self.download_checksum = self.cfg_checksum or None
+        self.resolved = not is_catalog_url(self.cfg_url)
+
+        if index_entry:
+            self.path = self.cfg_path
+            self.missing = False
+            self._load_index_entry(index_entry)
+            return
 
         self.path = getattr(self, 'cfg_path', None)
         if not self.path:
             from candelabra.boxes import BoxesStorage
 
-            self.path = os.path.join(BoxesStorage.get_storage_root(), self.cfg_name)
+            if not self.version:
+                # the latest version in the catalog is needed for finding the box in the storage
+                try:
+                    self.resolve()
+                except ImportException, e:
+                    self.version = self._get_latest_stored_version()
+                    if not self.version:
+                        raise
+                    logger.warning('%s: using the latest version of box "%s" in the storage (%s)',
+                                   str(e), self.cfg_name, self.version)
+
+            self.path = os.path.join(BoxesStorage.get_storage_root(),
+                                     BoxNode.get_storage_name(self.cfg_name, self.version))
 
         if not os.path.exists(self.path):
             logger.debug('creating box directory "%s"', self.path)
             os.makedirs(self.path)
             self.missing = True
         else:
-            self.missing = False
+            self.load_manifest()
+            self.missing = not self.is_complete()
+
+    @staticmethod
+    def get_storage_name(name, version=None):
+        """ Get the name of the directory for a box (and version) in the storage
+        """
+        return '%s@%s' % (name, version) if version else name
+
+    storage_name = property(lambda self: os.path.basename(self.path),
+                            doc='the name of the box in the storage (including the version)')
+
+    @property
+    def provider(self):
+        """ The provider of the machines using this box
+        """
+        return getattr(self._container, 'cfg_class', None) or config.get_key(CFG_DEFAULT_PROVIDER)
+
+    def _get_latest_stored_version(self):
+        """ Get the latest version of the box downloaded to the storage, or None if there is no version
+        """
+        from candelabra.boxes import BoxesStorage
+
+        prefix = BoxNode.get_storage_name(self.cfg_name, 'x')[:-1]
+        root = BoxesStorage.get_storage_root()
+        if not os.path.isdir(root):
+            return None
+        versions = [entry[len(prefix):] for entry in os.listdir(root)
+                    if entry.startswith(prefix) and os.path.exists(os.path.join(root, entry, BOX_MANIFEST_FILE))]
+        return max(versions, key=LooseVersion) if versions else None
+
+    def resolve(self):
+        """ Resolve the version, URL and checksum of the box from the catalog at the `url` (if it is a catalog)
+
+        Boxes with a version are only resolved when they must be downloaded. Versions resolved are
+        reused for the catalog TTL, so all the boxes with the same catalog share the same resolution.
+        """
+        if self.resolved:
+            return
+
+        key = (self.cfg_url, self.cfg_version, self.provider)
+        resolved_time, resolved = _resolved_catalogs.get(key, (0, None))
+        if not resolved or time.time() - resolved_time >= float(config.get_key(CFG_CATALOG_TTL)):
+            catalog = BoxCatalog(self.cfg_url)
+            if catalog.refresh():
+                logger.info('catalog for box "%s" has been updated', self.cfg_name)
+            resolved = catalog.get_version(version=self.cfg_version, provider=self.provider)
+            _resolved_catalogs[key] = (time.time(), resolved)
+
+        logger.debug('box "%s" resolved to version %s at %s', self.cfg_name, resolved['version'], resolved['url'])
+        self.version = resolved['version']
+        self.download_url = resolved['url']
+        if not self.cfg_checksum:
+            self.download_checksum = resolved['checksum']
+        self.resolved = True
+
+    @property
+    def manifest_filename(self):
+        """ The manifest file, with the checksums of the box and its files
+        """
+        return os.path.join(self.path, BOX_MANIFEST_FILE)
+
+    @property
+    def download_filename(self):
+        """ The file where the box file is downloaded (partial downloads are kept next to it)
+        """
+        from candelabra.boxes import BoxesStorage
+
+        return os.path.join(BoxesStorage.get_downloads_root(), '%s.box' % self.storage_name)
+
+    def is_complete(self):
+        """ Return True if the box has been completely downloaded and extracted
+
+        A box is not complete while there is a partial download of it, or when some file in its
+        manifest is missing. Boxes without a manifest (ie, copied by hand to the storage) are complete
+        when they have a valid appliance.
+        """
+        if os.path.exists(Download(self.download_url, self.download_filename).sidecar_filename):
+            logger.debug('box "%s" has a partial download', self.storage_name)
+            return False
+        if self.files:
+            return all(os.path.exists(os.path.join(self.path, name)) for name in self.files)
+        return self.load()
+
+    def load_manifest(self):
+        """ Load the checksums of the box and its files from the manifest (if present)
+        """
+        if os.path.exists(self.manifest_filename):
+            try:
+                with open(self.manifest_filename) as manifest_file:
+                    manifest = json.load(manifest_file)
+            except (IOError, ValueError), e:
+                logger.warning('invalid manifest for box %s: %s', self.cfg_name, str(e))
+            else:
+                self.checksum = manifest.get('checksum')
+                self.files = manifest.get('files', {})
+
+    def save_manifest(self):
+        """ Save the checksums of the box and its files in the manifest
+        """
+        manifest = {
+            'url': self.download_url,
+            'version': self.version,
+            'checksum': self.checksum,
+            'files': self.files,
+        }
+        atomic_write(self.manifest_filename, json.dumps(manifest, indent=2, sort_keys=True))
 
     def load(self):
         """ Load a box from a path
@@ -99,98 +263,305 @@ class BoxNode(TopologyNode, TaskGenerator):
                 else:
                     self.appliances[provider] = appliance_instance
 
+        self.loaded = True
         return bool(len(self.appliances) > 0)
 
+    def _load_index_entry(self, entry):
+        """ Load the box from an entry in the boxes index
+        """
+        providers_registry = PLUGINS_REGISTRIES['candelabra.provider']
+        self.checksum = entry.get('checksum')
+        self.files = entry.get('files', {})
+        for provider, appliance_entry in entry.get('providers', {}).iteritems():
+            if provider in providers_registry.plugins:
+                appliance_class = providers_registry.plugins[provider].APPLIANCE
+                self.appliances[provider] = appliance_class.from_index_entry(appliance_entry)
+        self.loaded = True
+
+    def get_index_entry(self):
+        """ Get the entry for this box in the boxes index.
+
+        Entries keep the modification times of the box directory and its providers directories, so
+        we can detect when the entry is not valid anymore.
+
+        The space used by every file is kept by inode, as files are hardlinks shared with other boxes.
+        """
+        mtimes = {'.': os.stat(self.path).st_mtime}
+        for provider in self.appliances:
+            mtimes[provider] = os.stat(os.path.join(self.path, provider)).st_mtime
+
+        size, inodes = 0, {}
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                filename = os.path.join(root, name)
+                st = os.stat(filename)
+                size += st.st_size
+                inodes['%d:%d' % (st.st_dev, st.st_ino)] = get_physical_size(filename)
+
+        return {
+            'mtimes': mtimes,
+            'providers': dict((provider, appliance.get_index_entry())
+                              for provider, appliance in self.appliances.iteritems()),
+            'size': size,
+            'physical_size': sum(inodes.itervalues()),
+            'inodes': inodes,
+            'checksum': self.checksum,
+            'files': self.files,
+        }
+
     def get_appliance(self, provider):
         """ Get a instance of one of the appliances in this box, or None if not found
+
+        Appliances are loaded from the boxes index when possible, so the box directory is not scanned
+        (and the OVF is not parsed) again.
         """
-        if len(self.appliances) == 0:
-            self.load()
+        from candelabra.boxes import boxes_storage_factory
+
+        if not self.loaded:
+            index_entry = boxes_storage_factory().get_index_entry(self.storage_name)
+            if index_entry:
+                self._load_index_entry(index_entry)
+            else:
+                self.load()
 
         try:
             # returns the provider (ie, a 'VirtualboxAppliance' instance)
-            return self.appliances[provider]
+            appliance = self.appliances[provider]
         except KeyError:
             return None
 
+        boxes_storage_factory().touch_box(self.storage_name)
+        return appliance
+
     #####################
     # tasks
     #####################
 
     def do_download(self):
         """ Download a box
+
+        The box is downloaded to the downloads directory in the boxes storage, so an interrupted
+        download can be resumed later on. In streaming mode, the box is extracted while it is
+        being downloaded, without storing it in the disc.
+
+        Downloads are serialized with an inter-process lock, so concurrent runs of candelabra share
+        the same download: if another process is downloading the box, we wait for it and then use
+        the box it has downloaded.
+
+        If the topology pins a checksum and there is a box with the same checksum in the storage,
+        it is reused instead of downloading it again.
         """
         if self.missing:
-            if not self.cfg_url:
-                raise ImportException('input URL not specified (url="%s")' % str(self.cfg_url))
+            # the URL and checksum in the catalog are only needed for downloading the box
+            self.resolve()
 
-            logger.info('downloading image from "%s"', self.cfg_url)
+        pinned_checksum = normalize_checksum(self.download_checksum) if self.download_checksum else None
 
-            try:
-                temp_box_fp, temp_box_name = tempfile.mkstemp()
-                temp_box_file = os.fdopen(temp_box_fp, 'w+')
-            except IOError, e:
-                raise ImportException('could not create temporal file for download: %s' % str(e))
+        if self.missing:
+            from candelabra.boxes import BoxesStorage
+
+            lock = BoxesStorage.get_box_lock(self.storage_name)
+            if not lock.acquire(blocking=False):
+                logger.info('box "%s" is being downloaded by another process: waiting...', self.storage_name)
+                lock.acquire()
 
             try:
-                logger.info('... downloading to temporal file "%s"', temp_box_name)
-
-                import requests
-
-                downloaded_bytes = 0
-                last_downloaded_mbytes = 0
-                r = requests.get(self.cfg_url, stream=True)
-                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-                    if chunk:                           # filter out keep-alive new chunks
-                        downloaded_bytes += temp_box_file.write(chunk)
-                        downloaded_mbytes = int(downloaded_bytes / MBYTE)
-                        if downloaded_mbytes > last_downloaded_mbytes:
-                            logger.debug('downloaded=%d Mb', downloaded_mbytes)
-                            last_downloaded_mbytes = downloaded_mbytes
-
-                        temp_box_file.flush()
-
-            except KeyboardInterrupt:
-                logger.debug('... removing %s', temp_box_name)
-                os.remove(temp_box_name)
-                raise ImportException('could not perform download')
-            except Exception, e:
-                logger.critical('while downloading: %s', str(e))
-                logger.debug('... removing %s', temp_box_name)
-                os.remove(temp_box_name)
-                raise ImportException('could not perform download')
+                # check if the box was downloaded while we were waiting
+                self.load_manifest()
+                if self.is_complete():
+                    logger.info('box "%s" has been downloaded by another process', self.storage_name)
+                    self.missing = False
+                else:
+                    self._download(pinned_checksum)
             finally:
-                temp_box_file.close()
+                lock.release()
 
-            logger.info('downloaded %d bytes!', self.downloaded_mbytes)
-            self.missing = False
+        if pinned_checksum and self.checksum and self.checksum != pinned_checksum:
+            raise ChecksumMismatchException('box "%s" in the storage has checksum %s, but %s was expected' %
+                                            (self.cfg_name, self.checksum, pinned_checksum))
+
+    def _download(self, pinned_checksum=None):
+        """ Download the box (the box lock must be held)
+        """
+        from candelabra.boxes import boxes_storage_factory
+
+        if pinned_checksum:
+            existing_box = boxes_storage_factory().find_box_by_checksum(pinned_checksum)
+            if existing_box and existing_box is not self:
+                self._link_from(existing_box)
+                return
+
+        self.transferred = 0
+        if not self._download_from_mirrors(pinned_checksum):
+            if not self.download_url:
+                raise ImportException('input URL not specified (url="%s")' % str(self.download_url))
+
+            logger.info('downloading image from "%s"', self.download_url)
+            self.checksum = self._fetch(self.download_url)
+
+        logger.debug('... box checksum: %s', self.checksum)
+        if pinned_checksum and self.checksum != pinned_checksum:
+            checksum, self.checksum, self.files = self.checksum, None, {}
+            self._remove_contents()
+            raise ChecksumMismatchException('box "%s" has checksum %s, but %s was expected' % (self.cfg_name,
+                                                                                              checksum,
+                                                                                              pinned_checksum))
+        self._add_to_blobs()
+        self.save_manifest()
+        self.missing = False
+        boxes_storage_factory().update_box(self)
+
+    def _download_from_mirrors(self, pinned_checksum=None):
+        """ Try to download the box from the nearest mirror that has it
+
+        Mirrors serve box files generated from the files in their storage, so the checksum of the box
+        file cannot be verified: the files extracted are verified with the checksums in the manifest
+        provided by the mirror, and the checksum of the original box file is taken from this manifest.
+
+        :returns: True if the box has been downloaded from a mirror
+        """
+        mirrors = get_mirrors(self.cfg_mirrors)
+        if not mirrors:
+            return False
+
+        provider = self.provider
+        box_url, manifest = find_in_mirrors(mirrors, self.storage_name, provider, checksum=pinned_checksum)
+        if not box_url:
+            logger.debug('box "%s" not found in mirrors', self.storage_name)
+            return False
+
+        logger.info('downloading image from mirror "%s"', box_url)
+        try:
+            self._fetch(box_url)
+            expected_files = dict((name, file_checksum) for name, file_checksum in manifest.get('files', {}).iteritems()
+                                  if name.split(os.sep)[0] == provider)
+            if self.files != expected_files:
+                raise ChecksumMismatchException('files in box do not match the checksums provided by the mirror')
+        except ImportException, e:
+            logger.warning('could not download box "%s" from mirror: %s', self.storage_name, str(e))
+            self.files = {}
+            self._remove_contents()
+            return False
+
+        self.checksum = manifest.get('checksum')
+        return True
+
+    def _fetch(self, url):
+        """ Download and extract the box file at :param:`url`
+
+        :returns: the checksum of the box file
+        """
+        from candelabra.boxes import BoxesStorage, boxes_storage_factory
 
-            appliance_path = os.path.join(self.path, 'unknown')
-            if not os.path.exists(appliance_path):
-                logger.debug('creating unknown box directory "%s"', appliance_path)
-                os.makedirs(appliance_path)
+        download = Download(url, self.download_filename, limiter=self.limiter)
 
+        if BoxesStorage.get_quota() > 0:
+            size = download.get_remote_size()
+            if size:
+                boxes_storage_factory().ensure_space(size, exclude=[self.storage_name])
+
+        try:
+            if config.get_boolean_key(CFG_DOWNLOAD_STREAMING) and not download.load_sidecar():
+                return self._download_streaming(download)
+            else:
+                box_filename = download.run()
+                try:
+                    return self._extract(file_chunks(box_filename))
+                finally:
+                    logger.debug('removing downloaded file...')
+                    os.remove(box_filename)
+        finally:
+            self.transferred += download.transferred
+
+    def _download_streaming(self, download):
+        """ Download and extract the box at the same time, retrying from the beginning on errors
+        """
+        attempt = 0
+        while True:
             try:
-                logger.info('extracting box...')
-                tar = tarfile.open(temp_box_name)
-                tar.extractall(path=appliance_path)
-                tar.close()
-                logger.debug('... done')
-            except IOError, e:
-                logger.info('error extracting box: %s', str(e))
-            finally:
-                logger.debug('removing temporal file...')
-                os.remove(temp_box_name)
-
-            metadata_file_path = os.path.join(appliance_path, 'metadata.json')
-            if os.path.isfile(metadata_file_path):
-                with open(metadata_file_path, 'r') as metadata_file:
-                    metadata = json.load(metadata_file)
-                    provider = metadata["provider"]
-
-                    logger.debug('renaming box to "%s"', provider)
-                    fixed_appliance_path = os.path.join(self.path, provider)
-                    os.rename(appliance_path, fixed_appliance_path)
+                return self._extract(download.stream())
+            except ImportException, e:
+                attempt += 1
+                if attempt > download.retries:
+                    raise
+                logger.warning('%s: retrying (attempt %d of %d)', str(e), attempt, download.retries)
+
+    def _extract(self, chunks):
+        """ Extract a box, read as an iterator of :param:`chunks`, in the box directory
+
+        :returns: the checksum of the box file (the checksums of the files in the box are kept in `files`)
+        """
+        appliance_path = os.path.join(self.path, 'unknown')
+        if os.path.exists(appliance_path):
+            shutil.rmtree(appliance_path)
+        logger.debug('creating unknown box directory "%s"', appliance_path)
+        os.makedirs(appliance_path)
+
+        try:
+            logger.info('extracting box...')
+            checksum, files = extract_stream(chunks, appliance_path)
+            logger.debug('... done')
+        except:
+            shutil.rmtree(appliance_path, ignore_errors=True)
+            raise
+
+        provider = 'unknown'
+        metadata_file_path = os.path.join(appliance_path, 'metadata.json')
+        if os.path.isfile(metadata_file_path):
+            with open(metadata_file_path, 'r') as metadata_file:
+                metadata = json.load(metadata_file)
+                provider = metadata["provider"]
+
+                logger.debug('renaming box to "%s"', provider)
+                fixed_appliance_path = os.path.join(self.path, provider)
+                if os.path.exists(fixed_appliance_path):
+                    # the remains of an incomplete box
+                    shutil.rmtree(fixed_appliance_path)
+                os.rename(appliance_path, fixed_appliance_path)
+
+        self.files = dict((os.path.join(provider, name), file_checksum) for name, file_checksum in files.iteritems())
+        return checksum
+
+    def _add_to_blobs(self):
+        """ Add the files in the box to the blobs store, deduplicating the files already present
+        """
+        blobs_store = blobs_store_factory()
+        deduplicated = 0
+        for name, file_checksum in self.files.iteritems():
+            if blobs_store.add(os.path.join(self.path, name), file_checksum):
+                deduplicated += 1
+        if deduplicated > 0:
+            logger.info('... %d files in box "%s" were already present in the storage', deduplicated, self.cfg_name)
+
+    def _link_from(self, box):
+        """ Populate this (missing) box with hardlinks to the files in another :param:`box`
+        """
+        logger.info('reusing box "%s" for "%s" (same checksum)', box.cfg_name, self.cfg_name)
+        for name in box.files:
+            target = os.path.join(self.path, name)
+            target_dir = os.path.dirname(target)
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+            os.link(os.path.join(box.path, name), target)
+
+        self.checksum = box.checksum
+        self.files = dict(box.files)
+        self.save_manifest()
+        self.missing = False
+
+        from candelabra.boxes import boxes_storage_factory
+
+        boxes_storage_factory().update_box(self)
+
+    def _remove_contents(self):
+        """ Remove all the contents in the box directory
+        """
+        for entry in os.listdir(self.path):
+            full_path = os.path.join(self.path, entry)
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path)
+            else:
+                os.remove(full_path)
 
     #####################
     # auxiliary
@@ -9,10 +9,11 @@ A machine in a topology.
 """
 
 from logging import getLogger
+import time
 
 from candelabra.config import config
-from candelabra.constants import CFG_DEFAULT_PROVIDER
-from candelabra.errors import MalformedTopologyException, MissingBoxException
+from candelabra.constants import CFG_DEFAULT_PROVIDER, CFG_FACTS_TTL
+from candelabra.errors import MalformedTopologyException, MissingBoxException, UnsupportedCommandException
 from candelabra.topology.box import BoxNode
 from candelabra.topology.node import TopologyNode, TopologyAttribute
 
@@ -52,6 +53,9 @@ class MachineNode(TopologyNode):
 
     * communicator: a :class:`Communicator` instance, used for communicating with the machine.
     * guest: a :class:`Guest` instance, used for running some standard commands in the machine.
+
+    The runtime facts of the machine (state, IPs, guest OS type, etc) are obtained from the provider
+    with :meth:`query_facts` and cached for some time (see :meth:`get_facts`)
     """
 
     __known_attributes = [
@@ -81,6 +85,11 @@ class MachineNode(TopologyNode):
 
         self.guest = None
         self.communicator = None
+        self.topology_state = None
+
+        self._facts = {}
+        self._facts_timestamp = 0
+        self._facts_changed = False
 
         # validate the attributes
         if not self.cfg_name and not self.is_global:
@@ -108,12 +117,22 @@ class MachineNode(TopologyNode):
             super_dict.update(local_dict)
         except AttributeError:
             pass
+
+        if self._facts:
+            super_dict['facts'] = dict(self._facts, timestamp=self._facts_timestamp)
         return super_dict
 
+    def record_state(self, event):
+        """ Record a change in this machine in the topology state journal (if this machine belongs to
+        a topology), so the change is not lost if we crash before the state file is saved
+        """
+        if self.topology_state is not None:
+            self.topology_state.record(self, event)
+
     def get_state(self):
         """ Return the machine current state
         """
-        return STATE_UNKNOWN[0]
+        return self.get_facts().get('state', STATE_UNKNOWN[0])
 
     def get_state_str(self):
         """ Return the machine current state
@@ -136,6 +155,45 @@ class MachineNode(TopologyNode):
     is_stopping = property(lambda self: self.get_state() == STATE_STOPPING[0],
                            doc='True if the machine is stopping')
 
+    #####################
+    # runtime facts
+    #####################
+
+    def query_facts(self):
+        """ Query the provider for the runtime facts of this machine, returning a dictionary
+        with things like the 'state', the 'ips', the 'guest_os', etc...
+        """
+        return {'state': STATE_UNKNOWN[0]}
+
+    def get_facts(self, fresh=False):
+        """ Get the runtime facts of this machine
+
+        The facts are obtained with :meth:`query_facts` only if they are older than the
+        configured TTL, or if :param:`fresh` is set.
+        """
+        ttl = float(config.get_key(CFG_FACTS_TTL))
+        if fresh or not self._facts or (time.time() - self._facts_timestamp) > ttl:
+            self.set_facts(self.query_facts())
+            self._facts_changed = True
+        return self._facts
+
+    def set_facts(self, facts, timestamp=None):
+        """ Set the runtime facts of this machine (ie, with some facts loaded from the state file)
+        """
+        self._facts = dict(facts)
+        self._facts_timestamp = timestamp if timestamp else time.time()
+        self._facts.pop('timestamp', None)
+
+    def invalidate_facts(self):
+        """ Invalidate the runtime facts, so they will be queried again the next time they are needed
+        """
+        self._facts = {}
+        self._facts_timestamp = 0
+
+    facts = property(lambda self: self.get_facts())
+    facts_changed = property(lambda self: self._facts_changed,
+                             doc='True if the facts have been queried since the machine was loaded')
+
     #####################
     # properties
     #####################
@@ -160,9 +218,14 @@ class MachineNode(TopologyNode):
     # tasks: sched
     #####################
 
-    def get_tasks_up(self):
+    def get_tasks_up(self, from_snapshot=None):
         """ Get the tasks needed for the command "up"
+
+        :param from_snapshot: create the machine from a snapshot (not supported by default)
         """
+        if from_snapshot:
+            raise UnsupportedCommandException('%s machines cannot be restored from snapshots' % self.cfg_class)
+
         if not self.cfg_name:
             raise MalformedTopologyException('missing attribute in topology: the virtual machine has no "name"')
 
@@ -172,9 +235,19 @@ class MachineNode(TopologyNode):
         else:
             logger.info('"%s" does not seem to exist', self.cfg_name)
             logger.info('... will import it from %s appliance "%s"', self.cfg_class, self.cfg_box.cfg_name)
+
+            from candelabra.boxes import boxes_storage_factory
+
+            # the box cannot be evicted (ie, for downloading other boxes) until the machine is created
+            boxes_storage_factory().use_box(self.cfg_box.storage_name)
             if self.cfg_box.missing:
-                logger.debug('... box "%s" must be downloaded first', self.cfg_name)
-                self.add_task_seq(self._box_instance.do_download)
+                logger.debug('... box "%s" must be downloaded first', self.cfg_box.cfg_name)
+                # use the storage instance, so machines with the same box share the download task
+                box = boxes_storage_factory().get_box(name=self.cfg_box.cfg_name,
+                                                      url=self.cfg_box.cfg_url,
+                                                      checksum=self.cfg_box.cfg_checksum,
+                                                      version=self.cfg_box.version)
+                self.add_task_seq(box.do_download)
 
             self.add_task_seq(self.do_copy_appliance)
 
@@ -183,9 +256,8 @@ class MachineNode(TopologyNode):
         else:
             for network in self.cfg_networks:
                 self.add_task_seq(network.do_network_create)
-            for iface in self.cfg_interfaces:
-                self.add_task_seq(iface.do_iface_create)
 
+            self.add_task_seq(self.do_configure)
             self.add_task_seq(self.do_power_up)
 
         self.add_task_seq(self.do_wait_userland)
@@ -286,6 +358,14 @@ class MachineNode(TopologyNode):
             raise MissingBoxException('box "%s" does not have a %s appliance' % (self.cfg_box.cfg_name, self.cfg_class))
 
         self._appliance.import_to_machine(self)
+        self.invalidate_facts()
+        self.record_state('created')
+
+    def do_configure(self):
+        """ Configure the machine before powering it up (ie, create the network interfaces)
+        """
+        for iface in self.cfg_interfaces:
+            iface.do_iface_create()
 
     def do_create_guest_reference(self):
         """ Create a guest reference
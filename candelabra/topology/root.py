@@ -22,7 +22,7 @@ import yaml
 from candelabra.constants import YAML_ROOT, YAML_SECTION_DEFAULT, YAML_SECTION_MACHINES, DEFAULT_TOPOLOGY_DIR_GUESSES, DEFAULT_TOPOLOGY_FILE_GUESSES, YAML_SECTION_NETWORKS
 from candelabra.errors import TopologyException
 from candelabra.plugins import build_machine_instance, build_interface_instance, build_network_instance
-from candelabra.topology.state import State
+from candelabra.topology.state import state_factory
 
 logger = getLogger(__name__)
 
@@ -81,12 +81,17 @@ class TopologyRoot(object):
         self._global_machine = None
         self._networks = []
         self._machines = []
-        self._state = State(self)
+        self._state = state_factory(self)
+        self._fresh = False
+        self.last_command = None
 
-    def load(self, filename):
+    def load(self, filename, fresh=False):
         """ Load the topology from a YAML file
+
+        :param fresh: ignore the runtime facts cached in the state
         """
         self._filename = filename
+        self._fresh = fresh
 
         if self._state.persisted:
             self._state.load()
@@ -166,6 +171,10 @@ class TopologyRoot(object):
 
                     # get the right instance for this machine class (ie, VirtualboxMachine)
                     machine_inst = build_machine_instance(_parent=self._global_machine, **machine_definition)
+                    machine_inst.topology_state = self._state
+                    if machine_state.get('facts') and 'uuid' in machine_state and not self._fresh:
+                        facts = machine_state['facts']
+                        machine_inst.set_facts(facts, timestamp=facts.get('timestamp'))
                     self._machines.append(machine_inst)
 
             logger.debug('topology: ... %d machines loaded', len(self._machines))
@@ -184,8 +193,9 @@ class TopologyRoot(object):
     def machines(self):
         return self._machines
 
-    def get_tasks(self, task_name):
-        """ Get all tasks needed for running something in all machines
+    def get_tasks(self, task_name, **kwargs):
+        """ Get all tasks needed for running something in all machines (any keyword arguments are
+        passed to the `get_tasks_<task_name>` method of the machines)
         """
         logger.debug('getting tasks for running "%s" on %d machines', task_name, len(self._machines))
         method_name = 'get_tasks_%s' % task_name
@@ -198,7 +208,7 @@ class TopologyRoot(object):
                 continue
             else:
                 machine.clear_tasks()
-                tasks_gen()
+                tasks_gen(**kwargs)
                 new_tasks = machine.get_tasks()
                 assert all(isinstance(t, tuple) for t in new_tasks)
                 num_new_tasks = len(new_tasks)
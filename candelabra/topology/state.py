@@ -8,16 +8,33 @@ Topology state.
 
 This module is responsible for saving the current toplogy nodes state, as well as restorying a previously
 saved dump of the state.
+
+The state is persisted in two files:
+
+* the state file, a YAML snapshot of the state of all the machines in the topology.
+* the state journal, an append-only file where each change in a machine (ie, a new UUID assigned
+  after an import, the machine being powered up or destroyed) is recorded as soon as it happens.
+
+When loading the state, the journal is replayed on top of the snapshot. The journal is compacted
+into the snapshot when the state is saved, or when it has grown too much.
+
+Alternatively, the state can be kept in a SQLite database shared by all the topologies in the host
+(see :class:`SqliteState`), by setting `state_backend = sqlite` in the configuration file.
 """
 
 import os
+import json
+import sqlite3
+from contextlib import contextmanager
 
 from weakref import proxy
 from logging import getLogger
 import pyaml
 
-from candelabra.constants import YAML_ROOT, YAML_SECTION_MACHINES, STATE_FILE_EXTENSION
+from candelabra.config import config
+from candelabra.constants import YAML_ROOT, YAML_SECTION_MACHINES, STATE_FILE_EXTENSION, STATE_JOURNAL_EXTENSION, CFG_STATE_COMPACT_EVERY, CFG_STATE_BACKEND, CFG_STATE_DB, CFG_STATE_DB_TIMEOUT
 from candelabra.errors import TopologyException, MalformedStateFileException
+from candelabra.files import atomic_write, append_line
 
 logger = getLogger(__name__)
 
@@ -35,12 +52,20 @@ class State(object):
         self._yaml = None
         self._filename = None
         self._topology = proxy(topology)
+        self._journal_entries = 0
 
     def load(self):
         """ Load the state from a persisted file
 
         The state file is kept in memory as a dictionary, not as a tree of topology :class:`Node`:
         """
+        if os.path.exists(self.filename):
+            self._load_snapshot()
+        self._replay_journal()
+
+    def _load_snapshot(self):
+        """ Load the snapshot of the state from the state file
+        """
         logger.info('state: loading from "%s"...', self.filename)
         with open(self.filename) as input_file:
             input_contents = input_file.read()
@@ -74,15 +99,76 @@ class State(object):
             for m in self._machines.values():
                 logger.debug('state: ...... %s', m)
 
+    def _replay_journal(self):
+        """ Replay all the changes recorded in the journal on top of the current state
+        """
+        self._journal_entries = 0
+        if not os.path.exists(self.journal_filename):
+            return
+
+        logger.info('state: replaying journal "%s"...', self.journal_filename)
+        with open(self.journal_filename) as journal_file:
+            for line in journal_file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # we probably crashed while writing this entry: nothing after this point can be trusted
+                    logger.warning('state: ignoring truncated entry in journal')
+                    break
+                else:
+                    self._apply_entry(entry)
+                    self._journal_entries += 1
+
+        logger.debug('state: ... %d changes replayed', self._journal_entries)
+
+    def _apply_entry(self, entry):
+        """ Apply a journal entry to the in-memory state
+        """
+        machine_name = entry.get('name')
+        if entry.get('event') == 'destroyed':
+            self._machines.pop(machine_name, None)
+        else:
+            self._machines[machine_name] = entry.get('machine', {})
+
+    def record(self, machine, event):
+        """ Record a change in a :param:`machine` state in the journal.
+
+        This costs a single append to the journal, so it can be done every time something
+        important happens to a machine (ie, 'created', 'up', 'down' or 'destroyed')
+        """
+        if not self.enabled:
+            return
+
+        entry = {
+            'event': event,
+            'name': machine.cfg_name,
+            'machine': machine.get_state_dict(),
+        }
+        logger.debug('state: recording "%s" for %s', event, machine.cfg_name)
+        append_line(self.journal_filename, json.dumps(entry))
+        self._apply_entry(entry)
+        self._journal_entries += 1
+
+        if self._journal_entries >= int(config.get_key(CFG_STATE_COMPACT_EVERY)):
+            logger.debug('state: journal has %d entries: compacting', self._journal_entries)
+            self.save()
+
     def save(self):
         """ Save the state to a persisted file
+
+        The state file is replaced atomically, and the journal is discarded once the new
+        snapshot has been written.
         """
         machines_states = []
         logger.info('saving topology state...')
         for machine in self._topology._machines:
             machine_definition = {}
             machine_state = machine.get_state_dict()
-            if machine_state:
+            if machine_state.get('uuid'):
+                # machines without a UUID (ie, destroyed) have no state to keep
                 machine_definition['machine'] = machine_state
                 machines_states.append(machine_definition)
 
@@ -90,11 +176,40 @@ class State(object):
             output = {}
             output[YAML_ROOT] = {}
             output[YAML_ROOT][YAML_SECTION_MACHINES] = machines_states
-            with open(self.filename, 'w+') as output_file:
-                output_file.write(pyaml.dump(output))
+            atomic_write(self.filename, pyaml.dump(output))
             logger.debug('... state saved as %s', self.filename)
         else:
+            # the old snapshot must not survive the journal (ie, when all the machines have been destroyed)
             logger.info('... no state saved: no machines reported valid state')
+            try:
+                os.remove(self.filename)
+            except (OSError, IOError):
+                pass
+
+        self._remove_journal()
+        self._update_registry()
+
+    def _update_registry(self, remove=False):
+        """ Update (or remove) the entry for this topology in the topologies registry
+        """
+        from candelabra.registry import registry_factory
+
+        try:
+            if remove:
+                registry_factory().remove(self._topology._filename)
+            else:
+                registry_factory().update(self._topology)
+        except (IOError, OSError), e:
+            logger.warning('could not update the topologies registry: %s', str(e))
+
+    def _remove_journal(self):
+        """ Remove the journal file, if it exists
+        """
+        try:
+            os.remove(self.journal_filename)
+        except (OSError, IOError):
+            pass
+        self._journal_entries = 0
 
     @property
     def filename(self):
@@ -105,11 +220,23 @@ class State(object):
             self._filename = "%s.%s" % (file_name, STATE_FILE_EXTENSION)
         return self._filename
 
+    @property
+    def journal_filename(self):
+        """ Return the filename for the state journal
+        """
+        return "%s.%s" % (self.filename, STATE_JOURNAL_EXTENSION)
+
+    @property
+    def enabled(self):
+        """ Return True if the state can be persisted (ie, the topology was loaded from a file)
+        """
+        return bool(self._topology._filename)
+
     @property
     def persisted(self):
-        """ Return True if there is a persisted state file on disc
+        """ Return True if there is a persisted state file (or a journal) on disc
         """
-        return bool(os.path.exists(self.filename))
+        return bool(os.path.exists(self.filename) or os.path.exists(self.journal_filename))
 
     def get_machine_state(self, machine):
         """ Return a dictionary with the state for a machine
@@ -120,10 +247,175 @@ class State(object):
             return {}
 
     def remove(self):
-        """ Remove the state file, if it exists
+        """ Remove the state file (and the journal), if it exists
         """
-        if self._filename:
+        if self.enabled:
             try:
-                os.remove(self._filename)
+                os.remove(self.filename)
             except (OSError, IOError):
                 pass
+            self._remove_journal()
+            self._update_registry(remove=True)
+
+
+class SqliteState(State):
+    """ State definition, persisted in a SQLite database
+
+    The database is shared by all the topologies in the host, with one row per machine, indexed by
+    the topology file and the machine name. Only the rows for machines that have changed are written,
+    so concurrent processes working on different machines do not clobber each other, and all the
+    writes are done in transactions that hold the database write lock.
+    """
+
+    def __init__(self, topology):
+        """ Initialize a state.
+        """
+        super(SqliteState, self).__init__(topology)
+        self._db = None
+        self._saved = {}
+
+    @property
+    def db_filename(self):
+        """ Return the filename for the state database
+        """
+        return os.path.expandvars(config.get_key(CFG_STATE_DB))
+
+    @property
+    def topology_key(self):
+        """ Return the key used for identifying this topology in the database
+        """
+        return os.path.abspath(self._topology._filename)
+
+    def _connect(self):
+        """ Get a connection to the database, creating the database if it does not exist
+        """
+        if not self._db:
+            directory = os.path.dirname(self.db_filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+
+            logger.debug('state: using database at "%s"', self.db_filename)
+            self._db = sqlite3.connect(self.db_filename,
+                                       timeout=float(config.get_key(CFG_STATE_DB_TIMEOUT)),
+                                       isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS machines ('
+                             '  topology TEXT NOT NULL,'
+                             '  name TEXT NOT NULL,'
+                             '  data TEXT NOT NULL,'
+                             '  PRIMARY KEY (topology, name))')
+        return self._db
+
+    @contextmanager
+    def _transaction(self):
+        """ Run some statements in a transaction, holding the database write lock
+        """
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+    def load(self):
+        """ Load the state for this topology from the database
+        """
+        logger.info('state: loading from database "%s"...', self.db_filename)
+        rows = self._connect().execute('SELECT name, data FROM machines WHERE topology = ?', (self.topology_key,))
+        for machine_name, data in rows:
+            try:
+                self._machines[machine_name] = json.loads(data)
+            except ValueError:
+                raise MalformedStateFileException('invalid state for "%s" in database.' % machine_name)
+            self._saved[machine_name] = data
+
+        logger.debug('state: ... %d machines loaded:', len(self._machines))
+        for m in self._machines.values():
+            logger.debug('state: ...... %s', m)
+
+    def record(self, machine, event):
+        """ Record a change in a :param:`machine` state, updating only the row for that machine
+        """
+        if not self.enabled:
+            return
+
+        logger.debug('state: recording "%s" for %s', event, machine.cfg_name)
+        machine_state = machine.get_state_dict()
+        data = json.dumps(machine_state, sort_keys=True)
+        with self._transaction() as db:
+            if event == 'destroyed':
+                db.execute('DELETE FROM machines WHERE topology = ? AND name = ?',
+                           (self.topology_key, machine.cfg_name))
+            else:
+                db.execute('INSERT OR REPLACE INTO machines (topology, name, data) VALUES (?, ?, ?)',
+                           (self.topology_key, machine.cfg_name, data))
+
+        if event == 'destroyed':
+            self._machines.pop(machine.cfg_name, None)
+            self._saved.pop(machine.cfg_name, None)
+        else:
+            self._machines[machine.cfg_name] = machine_state
+            self._saved[machine.cfg_name] = data
+
+    def save(self):
+        """ Save the state of all the machines that have changed since they were loaded
+        """
+        current = {}
+        for machine in self._topology._machines:
+            machine_state = machine.get_state_dict()
+            if machine_state.get('uuid'):
+                current[machine.cfg_name] = json.dumps(machine_state, sort_keys=True)
+
+        logger.info('saving topology state...')
+        changed = [name for name, data in current.iteritems() if self._saved.get(name) != data]
+        removed = [name for name in self._saved if name not in current]
+        if changed or removed:
+            with self._transaction() as db:
+                for name in changed:
+                    db.execute('INSERT OR REPLACE INTO machines (topology, name, data) VALUES (?, ?, ?)',
+                               (self.topology_key, name, current[name]))
+                for name in removed:
+                    db.execute('DELETE FROM machines WHERE topology = ? AND name = ?', (self.topology_key, name))
+            logger.debug('... %d machines updated, %d removed', len(changed), len(removed))
+        else:
+            logger.debug('... nothing has changed')
+
+        self._saved = current
+        self._update_registry()
+
+    @property
+    def persisted(self):
+        """ Return True if there is some state for this topology in the database
+        """
+        row = self._connect().execute('SELECT 1 FROM machines WHERE topology = ? LIMIT 1',
+                                      (self.topology_key,)).fetchone()
+        return row is not None
+
+    def remove(self):
+        """ Remove the state for this topology from the database
+        """
+        if self.enabled:
+            with self._transaction() as db:
+                db.execute('DELETE FROM machines WHERE topology = ?', (self.topology_key,))
+            self._saved = {}
+            self._update_registry(remove=True)
+
+
+#: the available state backends
+STATE_BACKENDS = {
+    'yaml': State,
+    'sqlite': SqliteState,
+}
+
+
+def state_factory(topology):
+    """ Build a state instance for a topology, using the backend set in the configuration file
+    """
+    backend = config.get_key(CFG_STATE_BACKEND).lower()
+    try:
+        return STATE_BACKENDS[backend](topology)
+    except KeyError:
+        raise TopologyException('unknown state backend "%s": should be one of %s' % (backend, STATE_BACKENDS.keys()))
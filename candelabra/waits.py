@@ -0,0 +1,95 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+"""
+Waiting for conditions.
+
+Instead of sleeping for some fixed time and hoping things are ready, operations wait until some
+explicit postcondition is true (ie, a lock has been released or an adapter is visible), checking
+it with short intervals that grow until the condition is met (or a timeout is reached).
+
+The time spent waiting is recorded by reason, so we can see where the time goes.
+"""
+
+import time
+import threading
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+#: first interval (in seconds) between checks of a condition
+INITIAL_INTERVAL = 0.05
+
+#: maximum interval (in seconds) between checks of a condition
+MAX_INTERVAL = 1.0
+
+
+class WaitStats(object):
+    """ Statistics of the time spent waiting, by reason
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reasons = {}           # reason -> {'waits', 'timeouts', 'time'}
+
+    def record(self, reason, elapsed, timed_out=False):
+        """ Record a wait
+        """
+        with self._lock:
+            stats = self.reasons.setdefault(reason, {'waits': 0, 'timeouts': 0, 'time': 0.0})
+            stats['waits'] += 1
+            stats['time'] += elapsed
+            if timed_out:
+                stats['timeouts'] += 1
+
+    def get_total(self):
+        """ Get the total time spent waiting
+        """
+        return sum(stats['time'] for stats in self.reasons.itervalues())
+
+    def reset(self):
+        with self._lock:
+            self.reasons = {}
+
+    def report(self):
+        """ Log the time spent waiting, by reason
+        """
+        if not self.reasons:
+            return
+
+        logger.info('time spent waiting: %.2f seconds', self.get_total())
+        for reason, stats in sorted(self.reasons.iteritems(), key=lambda item: -item[1]['time']):
+            logger.info('... %s: %.2f seconds (%d waits, %d timeouts)',
+                         reason, stats['time'], stats['waits'], stats['timeouts'])
+
+
+_wait_stats = WaitStats()
+
+
+def wait_stats():
+    return _wait_stats
+
+
+def wait_until(condition, timeout=10.0, reason='unknown', interval=INITIAL_INTERVAL, max_interval=MAX_INTERVAL):
+    """ Wait until a :param:`condition` (a callable) returns a true value, for up to :param:`timeout` seconds
+
+    :param reason: the reason for waiting (for the statistics)
+    :returns: the last value returned by the condition (so a false value means we have timed out)
+    """
+    start = time.time()
+    deadline = start + float(timeout)
+    while True:
+        res = condition()
+        now = time.time()
+        if res or now >= deadline:
+            break
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * 2, max_interval)
+
+    elapsed = time.time() - start
+    if not res:
+        logger.debug('timeout after %.2f seconds waiting for %s', elapsed, reason)
+    _wait_stats.record(reason, elapsed, timed_out=not res)
+    return res
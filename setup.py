@@ -19,12 +19,14 @@ entry_points = """
 candelabra  = candelabra.main:main
 
 [candelabra.command]
+boxes = candelabra.command.boxes.plugin:register
 destroy = candelabra.command.destroy.plugin:register
 down = candelabra.command.down.plugin:register
 import = candelabra.command.import.plugin:register
 net = candelabra.command.net.plugin:register
 provision = candelabra.command.provision.plugin:register
 show = candelabra.command.show.plugin:register
+snapshot = candelabra.command.snapshot.plugin:register
 up = candelabra.command.up.plugin:register
 
 [candelabra.provider]
@@ -105,6 +107,9 @@ if __name__ == "__main__":
                 'coverage',
             ],
             'package' : package_deps,
+            'xz' : [
+                'backports.lzma',
+            ],
         },
 
         entry_points=entry_points,
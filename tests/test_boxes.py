@@ -0,0 +1,382 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+import os
+import shutil
+import hashlib
+import tempfile
+import logging
+
+from candelabra.boxes import boxes_storage_factory
+from candelabra.config import config
+from candelabra.downloader import Download
+from candelabra.errors import ChecksumMismatchException, ImportException
+from candelabra.tests import CandelabraTestBase, BytesHTTPServer, make_box_file
+from candelabra.topology.box import BoxNode
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+DISK = os.urandom(512 * 1024)
+
+BOX = make_box_file({
+    'box.ovf': '<Envelope/>',
+    'metadata.json': '{"provider": "virtualbox"}',
+    'box-disk1.vmdk': DISK,
+}, 'gz')
+
+BOX_CHECKSUM = 'sha256:' + hashlib.sha256(BOX).hexdigest()
+
+
+class BoxesTestSuite(CandelabraTestBase):
+    """ Test suite for boxes
+    """
+
+    CONFIG = """
+[candelabra]
+"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        config.set('candelabra', 'boxes_path', self.temp_dir)
+        self.server = BytesHTTPServer(BOX)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def test_dedup(self):
+        """ Testing that boxes with the same contents share their files
+        """
+        box1 = BoxNode(name='box1', url=self.server.url)
+        box1.do_download()
+        self.assertFalse(box1.missing)
+        self.assertEqual(box1.checksum, BOX_CHECKSUM)
+        self.assertEqual(set(box1.files), {'virtualbox/box.ovf', 'virtualbox/metadata.json',
+                                           'virtualbox/box-disk1.vmdk'})
+
+        box2 = BoxNode(name='box2', url=self.server.url)
+        box2.do_download()
+        disk1 = os.stat(os.path.join(box1.path, 'virtualbox', 'box-disk1.vmdk'))
+        disk2 = os.stat(os.path.join(box2.path, 'virtualbox', 'box-disk1.vmdk'))
+        self.assertEqual(disk1.st_ino, disk2.st_ino)
+        self.assertEqual(disk1.st_nlink, 3)
+
+        # the manifest is loaded when the box is found in the storage
+        self.assertEqual(BoxNode(name='box2').checksum, BOX_CHECKSUM)
+
+    def test_pinned_checksum(self):
+        """ Testing that boxes can be pinned to a checksum
+        """
+        BoxNode(name='box1', url=self.server.url).do_download()
+        num_requests = len(self.server.requests)
+
+        # a box with the same checksum is reused, without downloading it
+        boxes_storage_factory().refresh()
+        box2 = BoxNode(name='box2', checksum=BOX_CHECKSUM.split(':')[1].upper())
+        box2.do_download()
+        self.assertFalse(box2.missing)
+        self.assertEqual(len(self.server.requests), num_requests)
+        self.assertTrue(os.path.exists(os.path.join(box2.path, 'virtualbox', 'box-disk1.vmdk')))
+
+        # and a box that does not match the checksum is rejected
+        box3 = BoxNode(name='box3', url=self.server.url, checksum='sha256:' + '0' * 64)
+        self.assertRaises(ChecksumMismatchException, box3.do_download)
+        self.assertTrue(box3.missing)
+        self.assertEqual(os.listdir(box3.path), [])
+
+    def test_index(self):
+        """ Testing that boxes are loaded from the index, and the index is invalidated when boxes change
+        """
+        BoxNode(name='box1', url=self.server.url).do_download()
+
+        from candelabra.boxes import BoxesStorage
+        import candelabra.topology.box
+
+        storage = BoxesStorage()
+        self.assertEqual(storage.boxes.keys(), ['box1'])
+        self.assertEqual(storage.boxes['box1'].checksum, BOX_CHECKSUM)
+        self.assertTrue('virtualbox' in storage.boxes['box1'].appliances)
+
+        # a valid index does not need to load the boxes from their directories
+        original_load = candelabra.topology.box.BoxNode.load
+        candelabra.topology.box.BoxNode.load = lambda box: self.fail('box %s loaded' % box.cfg_name)
+        try:
+            storage.refresh()
+            # ... and neither do other instances of the box
+            self.assertTrue(BoxNode(name='box1').get_appliance('virtualbox'))
+        finally:
+            candelabra.topology.box.BoxNode.load = original_load
+        self.assertEqual(storage.boxes.keys(), ['box1'])
+        self.assertEqual(storage.index.entries['box1']['providers']['virtualbox']['descriptor']['disks'], [])
+
+        # removing an appliance invalidates the entry
+        shutil.rmtree(os.path.join(self.temp_dir, 'box1', 'virtualbox'))
+        storage.refresh()
+        self.assertEqual(storage.boxes.keys(), [])
+        self.assertEqual(storage.index.entries.keys(), [])
+
+        BoxNode(name='box2', url=self.server.url).do_download()
+        storage.refresh()
+        self.assertEqual(storage.boxes.keys(), ['box2'])
+        storage.delete_box('box2')
+        self.assertEqual(BoxesStorage().boxes.keys(), [])
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'box2')))
+
+    def test_incomplete(self):
+        """ Testing that boxes with a partial download or missing files are downloaded again
+        """
+        box = BoxNode(name='box1', url=self.server.url)
+        box.do_download()
+        self.assertFalse(BoxNode(name='box1').missing)
+
+        # a partial download is left
+        sidecar_filename = Download(self.server.url, box.download_filename).sidecar_filename
+        with open(sidecar_filename, 'w') as sidecar_file:
+            sidecar_file.write('{}')
+        self.assertTrue(BoxNode(name='box1').missing)
+        os.remove(sidecar_filename)
+
+        # a file in the box is missing
+        os.remove(os.path.join(box.path, 'virtualbox', 'box-disk1.vmdk'))
+        box = BoxNode(name='box1', url=self.server.url)
+        self.assertTrue(box.missing)
+        box.do_download()
+        self.assertFalse(box.missing)
+        self.assertFalse(BoxNode(name='box1').missing)
+        with open(os.path.join(box.path, 'virtualbox', 'box-disk1.vmdk'), 'rb') as disk:
+            self.assertEqual(disk.read(), DISK)
+
+    def test_single_flight(self):
+        """ Testing that a box being downloaded by another process is not downloaded again
+        """
+        import threading
+        from candelabra.boxes import BoxesStorage
+
+        storage = boxes_storage_factory()
+        box = storage.get_box(name='box1', url=self.server.url)
+        self.assertIs(storage.get_box(name='box1', url=self.server.url), box)
+
+        # simulate another process downloading the box
+        lock = BoxesStorage.get_box_lock('box1')
+        lock.acquire()
+        waiter = threading.Thread(target=box.do_download)
+        waiter.start()
+        try:
+            waiter.join(0.5)
+            self.assertTrue(waiter.is_alive())
+            BoxNode(name='box1', url=self.server.url)._download()
+        finally:
+            lock.release()
+        waiter.join()
+
+        self.assertFalse(box.missing)
+        self.assertEqual(box.checksum, BOX_CHECKSUM)
+        self.assertEqual(len([r for r in self.server.requests if not r.get('range') == 'bytes=0-0']), 1)
+
+    def test_gc(self):
+        """ Testing that the least recently used boxes not used by any topology are removed
+        """
+        import json
+        import time
+
+        registry_path = os.path.join(self.temp_dir, 'topologies.json')
+        config.set('candelabra', 'registry', registry_path)
+        with open(registry_path, 'w') as registry_file:
+            json.dump({'/some/topology.yaml': {'machines': [{'name': 'vm1', 'box': 'box2'}]}}, registry_file)
+
+        server = BytesHTTPServer(dict(('/%s.box' % name, make_box_file({
+            'box.ovf': '<Envelope/>',
+            'metadata.json': '{"provider": "virtualbox"}',
+            'box-disk1.vmdk': os.urandom(512 * 1024),
+        }, 'gz')) for name in ['box1', 'box2', 'box3', 'box4']))
+        try:
+            for name in ['box1', 'box2', 'box3']:
+                BoxNode(name=name, url=server.url_for('/%s.box' % name)).do_download()
+                time.sleep(0.01)
+            storage = boxes_storage_factory()
+            storage.boxes['box1'].get_appliance('virtualbox')
+            self.assertEqual(storage.touched.keys(), ['box1'])
+            box_size = storage.index.entries['box1']['physical_size']
+
+            # boxes with the same contents share their space
+            used_space = storage.get_used_space()
+            BoxNode(name='box5', url=server.url_for('/box2.box')).do_download()
+            self.assertLess(storage.get_used_space() - used_space, box_size / 10)
+            storage.delete_box('box5')
+
+            self.assertEqual(storage.gc(target=2 * box_size, dry_run=True), ['box3'])
+            self.assertEqual(storage.touched, {})
+            self.assertEqual(sorted(storage.boxes), ['box1', 'box2', 'box3'])
+            self.assertEqual(storage.gc(target=2 * box_size), ['box3'])
+            self.assertEqual(sorted(storage.boxes), ['box1', 'box2'])
+
+            # boxes needed by the current command are not evicted
+            storage.use_box('box1')
+            self.assertEqual(storage.gc(target=0, dry_run=True), [])
+            storage.in_use.clear()
+            self.assertEqual(storage.gc(target=0, dry_run=True, exclude=['box1']), [])
+
+            # downloading a new box exceeding the quota removes unused boxes
+            config.set('candelabra', 'boxes_quota', str(2 * box_size + box_size / 2))
+            try:
+                BoxNode(name='box4', url=server.url_for('/box4.box')).do_download()
+            finally:
+                config.set('candelabra', 'boxes_quota', '0')
+            self.assertEqual(sorted(boxes_storage_factory().boxes), ['box2', 'box4'])
+            self.assertEqual(storage.gc(), ['box4'])
+            self.assertEqual(sorted(storage.boxes), ['box2'])
+        finally:
+            server.stop()
+
+    def test_import_manifest(self):
+        """ Testing that boxes in a manifest are imported concurrently, skipping the boxes already present
+        """
+        import argparse
+        import importlib
+
+        import_command = importlib.import_module('candelabra.command.import.command').command
+
+        manifest_filename = os.path.join(self.temp_dir, 'boxes.yaml')
+        with open(manifest_filename, 'w') as manifest_file:
+            manifest_file.write("""
+boxes:
+    - name:         box1
+      url:          %(url)s
+      checksum:     %(checksum)s
+    - name:         box2
+      url:          %(url)s
+    - name:         box3
+      url:          %(url)s
+""" % {'url': self.server.url, 'checksum': BOX_CHECKSUM})
+
+        BoxNode(name='box3', url=self.server.url).do_download()
+
+        args = argparse.Namespace(manifest=manifest_filename, jobs=2, max_bandwidth='100M')
+        results = import_command.do_import_manifest(args)
+        self.assertEqual(sorted(results), ['box1', 'box2'])
+        self.assertEqual(results['box1']['bytes'], 0)          # same checksum as box3: not downloaded
+        self.assertEqual(results['box2']['bytes'], len(BOX))
+        self.assertEqual(sorted(boxes_storage_factory().boxes), ['box1', 'box2', 'box3'])
+
+        # now everything is present
+        self.assertEqual(import_command.do_import_manifest(args), {})
+
+        # but a box present with another checksum is an error
+        with open(manifest_filename, 'w') as manifest_file:
+            manifest_file.write("""
+boxes:
+    - name:         box3
+      url:          %(url)s
+      checksum:     sha256:%(checksum)s
+""" % {'url': self.server.url, 'checksum': '0' * 64})
+        self.assertRaises(ImportException, import_command.do_import_manifest, args)
+
+    def test_catalog(self):
+        """ Testing that boxes can be obtained from catalogs, and new versions are detected
+        """
+        import json
+        from candelabra.tests import BytesHTTPServer
+
+        box2 = make_box_file({
+            'box.ovf': '<Envelope version="2"/>',
+            'metadata.json': '{"provider": "virtualbox"}',
+        })
+
+        def make_catalog(versions):
+            return json.dumps({
+                'name': 'some/box',
+                'versions': [{'version': version,
+                              'providers': [{'name': 'virtualbox',
+                                             'url': server.url_for('/box-%s.box' % version),
+                                             'checksum_type': 'sha256',
+                                             'checksum': hashlib.sha256(content).hexdigest()}]}
+                             for version, content in versions]
+            })
+
+        server = BytesHTTPServer({'/box-1.0.9.box': BOX, '/box-1.0.10.box': box2})
+        try:
+            server.content['/catalog.json'] = make_catalog([('1.0.9', BOX)])
+            config.set('candelabra', 'catalog_ttl', '0')
+            catalog_url = server.url_for('/catalog.json')
+
+            box = boxes_storage_factory().get_box(name='box1', url=catalog_url)
+            self.assertEqual(box.version, '1.0.9')
+            self.assertEqual(box.storage_name, 'box1@1.0.9')
+            box.do_download()
+            self.assertEqual(box.checksum, BOX_CHECKSUM)
+
+            # the catalog is revalidated with a conditional request
+            box = BoxNode(name='box1', url=catalog_url)
+            self.assertFalse(box.missing)
+            self.assertEqual(server.requests[-1]['path'], '/catalog.json')
+            self.assertTrue(server.requests[-1].get('if-none-match'))
+
+            # a new version is detected and downloaded, and the old version is kept
+            server.content['/catalog.json'] = make_catalog([('1.0.9', BOX), ('1.0.10', box2)])
+            box = BoxNode(name='box1', url=catalog_url)
+            self.assertEqual(box.version, '1.0.10')
+            self.assertTrue(box.missing)
+            box.do_download()
+            self.assertEqual(sorted(boxes_storage_factory().boxes), ['box1@1.0.10', 'box1@1.0.9'])
+
+            # a specific version can be requested
+            self.assertEqual(BoxNode(name='box1', url=catalog_url, version='1.0.9').storage_name, 'box1@1.0.9')
+
+            # the catalog is not needed for boxes with a version in the storage, and resolved versions
+            # are reused while they are fresh
+            num_requests = len(server.requests)
+            self.assertFalse(BoxNode(name='box1', url=catalog_url, version='1.0.9').missing)
+            config.set('candelabra', 'catalog_ttl', '300')
+            self.assertEqual(BoxNode(name='box1', url=catalog_url).version, '1.0.10')
+            self.assertEqual(len(server.requests), num_requests)
+
+            # when the catalog cannot be obtained, the latest version in the storage is used
+            self.assertEqual(BoxNode(name='box1', url=server.url_for('/missing.json')).version, '1.0.10')
+            self.assertRaises(ImportException, BoxNode, name='box2', url=server.url_for('/missing.json'))
+        finally:
+            config.set('candelabra', 'catalog_ttl', '300')
+            server.stop()
+
+    def test_mirror(self):
+        """ Testing that boxes can be served to other hosts, and downloaded from mirrors
+        """
+        import requests
+        from candelabra.mirror import MirrorServer
+
+        boxes_storage_factory().get_box(name='box1', url=self.server.url).do_download()
+        mirror = MirrorServer(boxes_storage_factory(), address='127.0.0.1')
+        mirror.start()
+
+        other_dir = tempfile.mkdtemp()
+        try:
+            # the box file can be downloaded by ranges
+            box_url = mirror.url + '/boxes/box1/virtualbox.box'
+            full = requests.get(box_url).content
+            r = requests.get(box_url, headers={'Range': 'bytes=100-1099'})
+            self.assertEqual(r.status_code, 206)
+            self.assertEqual(r.content, full[100:1100])
+            self.assertEqual(requests.get(mirror.url + '/boxes/box2.json').status_code, 404)
+
+            # another host (another storage) gets the box from the nearest mirror, not from the origin
+            config.set('candelabra', 'boxes_path', other_dir)
+            num_requests = len(self.server.requests)
+            box = BoxNode(name='box1', url=self.server.url, checksum=BOX_CHECKSUM,
+                          mirrors=['http://127.0.0.1:1', mirror.url])
+            box.do_download()
+            self.assertEqual(len(self.server.requests), num_requests)
+            self.assertEqual(box.checksum, BOX_CHECKSUM)
+            with open(os.path.join(box.path, 'virtualbox', 'box-disk1.vmdk'), 'rb') as disk:
+                self.assertEqual(disk.read(), DISK)
+
+            # boxes not found in the mirrors are downloaded from the origin
+            box = BoxNode(name='box2', url=self.server.url, mirrors=[mirror.url])
+            box.do_download()
+            self.assertGreater(len(self.server.requests), num_requests)
+            self.assertEqual(box.checksum, BOX_CHECKSUM)
+        finally:
+            mirror.stop()
+            shutil.rmtree(other_dir)
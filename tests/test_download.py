@@ -0,0 +1,121 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+import os
+import shutil
+import tempfile
+import logging
+
+import time
+
+from candelabra.downloader import Download, BandwidthLimiter
+from candelabra.errors import ImportException
+from candelabra.tests import CandelabraTestBase, BytesHTTPServer
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+CONTENT = os.urandom(1024 * 1024)
+
+
+class DownloadTestSuite(CandelabraTestBase):
+    """ Test suite for downloads
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.temp_dir, 'some.box')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_resume(self):
+        """ Testing that a dropped download is resumed with a Range request
+        """
+        server = BytesHTTPServer(CONTENT, ranges=True, drop_after=300 * 1024)
+        try:
+            download = Download(server.url, self.destination, chunk_size=64 * 1024, connections=1, retries=0)
+            self.assertRaises(ImportException, download.run)
+            self.assertTrue(os.path.exists(download.part_filename))
+            self.assertTrue(os.path.exists(download.sidecar_filename))
+            self.assertEqual(download.load_sidecar()['received'], 300 * 1024)
+
+            download = Download(server.url, self.destination, chunk_size=64 * 1024, connections=1, retries=0)
+            self.assertEqual(download.run(), self.destination)
+            self.assertEqual(server.requests[-1].get('range'), 'bytes=%d-' % (300 * 1024))
+            self.assertEqual(server.requests[-1].get('if-range'), '"some-etag"')
+            with open(self.destination, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+            self.assertFalse(os.path.exists(download.part_filename))
+            self.assertFalse(os.path.exists(download.sidecar_filename))
+        finally:
+            server.stop()
+
+    def test_retry(self):
+        """ Testing that a dropped download is resumed automatically when retrying
+        """
+        server = BytesHTTPServer(CONTENT, ranges=True, drop_after=500 * 1024)
+        try:
+            download = Download(server.url, self.destination, chunk_size=64 * 1024, connections=1, retries=1)
+            download.run()
+            self.assertEqual(len(server.requests), 2)
+            with open(self.destination, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+        finally:
+            server.stop()
+
+    def test_no_ranges(self):
+        """ Testing that a download is restarted when the server refuses ranges
+        """
+        server = BytesHTTPServer(CONTENT, ranges=False, drop_after=300 * 1024)
+        try:
+            download = Download(server.url, self.destination, chunk_size=64 * 1024, connections=1, retries=0)
+            self.assertRaises(ImportException, download.run)
+
+            download = Download(server.url, self.destination, chunk_size=64 * 1024, connections=1, retries=0)
+            download.run()
+            with open(self.destination, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+        finally:
+            server.stop()
+
+    def test_segmented(self):
+        """ Testing that a large file is downloaded (and resumed) in segments
+        """
+        server = BytesHTTPServer(CONTENT, ranges=True, drop_after=100 * 1024)
+        try:
+            download = Download(server.url, self.destination, chunk_size=64 * 1024, retries=0,
+                                connections=4, segment_min_size=512 * 1024)
+            self.assertRaises(ImportException, download.run)
+
+            sidecar = download.load_sidecar()
+            self.assertEqual(len(sidecar['segments']), 4)
+            self.assertEqual(os.path.getsize(download.part_filename), len(CONTENT))
+            self.assertTrue(sidecar['received'] < len(CONTENT))
+
+            num_requests = len(server.requests)
+            download = Download(server.url, self.destination, chunk_size=64 * 1024, retries=0,
+                                connections=4, segment_min_size=512 * 1024)
+            download.run()
+            resumed = [r.get('range') for r in server.requests[num_requests:]]
+            self.assertEqual(len(resumed), 1)
+            pending = ['bytes=%d-%d' % (start + received, end)
+                       for start, end, received in sidecar['segments'] if start + received <= end]
+            self.assertEqual(resumed, pending)
+            with open(self.destination, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+        finally:
+            server.stop()
+
+    def test_bandwidth_limit(self):
+        """ Testing that the bandwidth limiter delays downloads exceeding the limit
+        """
+        limiter = BandwidthLimiter(1024 * 1024)
+        start = time.time()
+        limiter.consume(1024 * 1024)
+        self.assertLess(time.time() - start, 0.1)
+        limiter.consume(512 * 1024)
+        self.assertGreater(time.time() - start, 0.4)
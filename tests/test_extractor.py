@@ -0,0 +1,154 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+import os
+import shutil
+import hashlib
+import tempfile
+import logging
+
+from candelabra.downloader import Download
+from candelabra.errors import ImportException
+from candelabra.extractor import extract_stream, file_chunks
+from candelabra.tests import CandelabraTestBase, BytesHTTPServer, make_box_file
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+FILES = {
+    'box.ovf': '<Envelope/>',
+    'metadata.json': '{"provider": "virtualbox"}',
+    'box-disk1.vmdk': os.urandom(256 * 1024),
+}
+
+
+def make_box(compression=''):
+    return make_box_file(FILES, compression)
+
+
+def chunked(data, size=10000):
+    return (data[i:i + size] for i in xrange(0, len(data), size))
+
+
+class ExtractorTestSuite(CandelabraTestBase):
+    """ Test suite for the boxes extractor
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_extracted(self):
+        for name, content in FILES.items():
+            with open(os.path.join(self.temp_dir, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_compressions(self):
+        """ Testing the extraction of plain, gzip and bzip2 boxes
+        """
+        for compression in ['', 'gz', 'bz2']:
+            box = make_box(compression)
+            checksum, files = extract_stream(chunked(box), self.temp_dir)
+            self.assertEqual(checksum, 'sha256:' + hashlib.sha256(box).hexdigest())
+            self.assertEqual(files, dict((name, 'sha256:' + hashlib.sha256(content).hexdigest())
+                                         for name, content in FILES.items()))
+            self.check_extracted()
+
+    def test_invalid(self):
+        """ Testing that invalid boxes are detected
+        """
+        self.assertRaises(ImportException, extract_stream, chunked(os.urandom(100000)), self.temp_dir)
+
+    def test_streaming(self):
+        """ Testing that a box can be extracted while it is being downloaded
+        """
+        box = make_box('gz')
+        server = BytesHTTPServer(box)
+        try:
+            download = Download(server.url, os.path.join(self.temp_dir, 'some.box'), chunk_size=4096)
+            checksum, _ = extract_stream(download.stream(), self.temp_dir)
+            self.assertEqual(checksum, 'sha256:' + hashlib.sha256(box).hexdigest())
+            self.check_extracted()
+            self.assertFalse(os.path.exists(download.part_filename))
+        finally:
+            server.stop()
+
+    def test_file(self):
+        """ Testing the extraction of a box file
+        """
+        box_filename = os.path.join(self.temp_dir, 'some.box')
+        with open(box_filename, 'wb') as f:
+            f.write(make_box('bz2'))
+        extract_stream(file_chunks(box_filename), self.temp_dir)
+        self.check_extracted()
+
+    def test_sparse(self):
+        """ Testing that runs of zeros are not written, and GNU sparse members are honoured
+        """
+        from candelabra.extractor import get_physical_size
+        from candelabra.tests import make_box_file
+
+        disk = 'x' * 4096 + '\0' * (8 * 1024 * 1024) + 'y' * 4096
+        box = make_box_file({'disk.vmdk': disk}, 'gz')
+        _, files = extract_stream(chunked(box), self.temp_dir)
+        disk_filename = os.path.join(self.temp_dir, 'disk.vmdk')
+        self.assertEqual(os.path.getsize(disk_filename), len(disk))
+        self.assertLess(get_physical_size(disk_filename), 1024 * 1024)
+        with open(disk_filename, 'rb') as f:
+            self.assertEqual(f.read(), disk)
+
+        # make a GNU sparse tar with GNU tar (if available)
+        import subprocess
+
+        sparse_dir = os.path.join(self.temp_dir, 'sparse')
+        os.makedirs(sparse_dir)
+        with open(os.path.join(sparse_dir, 'disk.vmdk'), 'wb') as f:
+            f.write('x' * 4096)
+            f.seek(16 * 1024 * 1024)
+            f.write('y' * 4096)
+        sparse_tar = os.path.join(self.temp_dir, 'sparse.tar')
+        try:
+            subprocess.check_call(['tar', '--sparse', '--format=gnu', '-cf', sparse_tar, '-C', sparse_dir, 'disk.vmdk'])
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('GNU tar not available')
+        self.assertLess(os.path.getsize(sparse_tar), 1024 * 1024)
+
+        output_dir = os.path.join(self.temp_dir, 'output')
+        _, sparse_files = extract_stream(file_chunks(sparse_tar), output_dir)
+        disk_filename = os.path.join(output_dir, 'disk.vmdk')
+        self.assertEqual(os.path.getsize(disk_filename), 16 * 1024 * 1024 + 4096)
+        self.assertLess(get_physical_size(disk_filename), 1024 * 1024)
+        expected = 'x' * 4096 + '\0' * (16 * 1024 * 1024 - 4096) + 'y' * 4096
+        with open(disk_filename, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(sparse_files['disk.vmdk'], 'sha256:' + hashlib.sha256(expected).hexdigest())
+
+    def test_links(self):
+        """ Testing that links in boxes are not extracted
+        """
+        import tarfile
+        import StringIO
+
+        output = StringIO.StringIO()
+        tar = tarfile.open(fileobj=output, mode='w|')
+        for name, link_type, target in [('outside', tarfile.SYMTYPE, '..'),
+                                        ('passwd', tarfile.LNKTYPE, '/etc/passwd')]:
+            info = tarfile.TarInfo(name)
+            info.type, info.linkname = link_type, target
+            tar.addfile(info)
+        info = tarfile.TarInfo('outside/some.file')
+        info.size = 4
+        tar.addfile(info, StringIO.StringIO('data'))
+        tar.close()
+
+        destination = os.path.join(self.temp_dir, 'box')
+        _, files = extract_stream(chunked(output.getvalue()), destination)
+        self.assertEqual(files.keys(), ['outside/some.file'])
+        self.assertFalse(os.path.islink(os.path.join(destination, 'outside')))
+        self.assertFalse(os.path.exists(os.path.join(destination, 'passwd')))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'some.file')))
@@ -0,0 +1,51 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+import os
+import shutil
+import tempfile
+import logging
+
+from candelabra.files import reflink, reflink_or_copy
+from candelabra.tests import CandelabraTestBase
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class FilesTestSuite(CandelabraTestBase):
+    """ Test suite for the files helpers
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_reflink_or_copy(self):
+        """ Testing that files are cloned, or copied as sparse files when the filesystem cannot clone them
+        """
+        data = os.urandom(64 * 1024) + '\0' * (4 * 1024 * 1024) + os.urandom(100)
+        source = os.path.join(self.temp_dir, 'disk.vmdk')
+        with open(source, 'wb') as source_file:
+            source_file.write(data)
+
+        try:
+            reflink(source, os.path.join(self.temp_dir, 'probe.vmdk'))
+            supported = True
+        except IOError:
+            supported = False
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'probe.vmdk')) and not supported)
+
+        destination = os.path.join(self.temp_dir, 'copy.vmdk')
+        self.assertEqual(reflink_or_copy(source, destination), supported)
+        with open(destination, 'rb') as destination_file:
+            self.assertEqual(destination_file.read(), data)
+
+        if not supported:
+            # the run of zeros is not written
+            self.assertLess(os.stat(destination).st_blocks * 512, len(data) / 2)
@@ -0,0 +1,94 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+import os
+import shutil
+import tempfile
+import logging
+
+from candelabra.errors import UnsupportedBoxException
+from candelabra.provider.virtualbox.ovf import parse_ovf, STREAM_OPTIMIZED_FORMAT
+from candelabra.tests import CandelabraTestBase
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+OVF = """<?xml version="1.0"?>
+<Envelope ovf:version="1.0" xml:lang="en-US" xmlns="http://schemas.dmtf.org/ovf/envelope/1"
+          xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"
+          xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData"
+          xmlns:vbox="http://www.virtualbox.org/ovf/machine">
+  <References>
+    <File ovf:href="box-disk1.vmdk" ovf:id="file1" ovf:size="1024"/>
+  </References>
+  <DiskSection>
+    <Info>List of the virtual disks used in the package</Info>
+    <Disk ovf:capacity="40" ovf:capacityAllocationUnits="byte * 2^30" ovf:diskId="vmdisk1" ovf:fileRef="file1"
+          ovf:format="http://www.vmware.com/interfaces/specifications/vmdk.html#streamOptimized"/>
+  </DiskSection>
+  <VirtualSystem ovf:id="precise64">
+    <OperatingSystemSection ovf:id="93">
+      <Info>The kind of installed guest operating system</Info>
+      <Description>Ubuntu_64</Description>
+      <vbox:OSType ovf:required="false">Ubuntu_64</vbox:OSType>
+    </OperatingSystemSection>
+    <VirtualHardwareSection>
+      <Item>
+        <rasd:ResourceType>3</rasd:ResourceType>
+        <rasd:VirtualQuantity>2</rasd:VirtualQuantity>
+      </Item>
+      <Item>
+        <rasd:AllocationUnits>MegaBytes</rasd:AllocationUnits>
+        <rasd:ResourceType>4</rasd:ResourceType>
+        <rasd:VirtualQuantity>512</rasd:VirtualQuantity>
+      </Item>
+      <Item>
+        <rasd:ResourceType>10</rasd:ResourceType>
+      </Item>
+      <Item>
+        <rasd:ResourceType>10</rasd:ResourceType>
+      </Item>
+    </VirtualHardwareSection>
+  </VirtualSystem>
+</Envelope>
+"""
+
+
+class OVFTestSuite(CandelabraTestBase):
+    """ Test suite for the OVF parser
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.ovf = os.path.join(self.temp_dir, 'box.ovf')
+        with open(self.ovf, 'w') as ovf_file:
+            ovf_file.write(OVF)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_parse(self):
+        """ Testing that OVF descriptors are parsed, and disks are checked
+        """
+        self.assertRaises(UnsupportedBoxException, parse_ovf, self.ovf)
+
+        with open(os.path.join(self.temp_dir, 'box-disk1.vmdk'), 'w') as disk_file:
+            disk_file.write('\0' * 1024)
+
+        descriptor = parse_ovf(self.ovf)
+        self.assertEqual(descriptor['name'], 'precise64')
+        self.assertEqual(descriptor['os_type'], 'Ubuntu_64')
+        self.assertEqual(descriptor['cpus'], 2)
+        self.assertEqual(descriptor['memory'], 512)
+        self.assertEqual(descriptor['nics'], 2)
+        self.assertEqual(descriptor['disks'], [{'file': 'box-disk1.vmdk',
+                                                'format': STREAM_OPTIMIZED_FORMAT,
+                                                'capacity': 40 * 2 ** 30,
+                                                'size': 1024}])
+
+        with open(self.ovf, 'w') as ovf_file:
+            ovf_file.write('<Envelope')
+        self.assertRaises(UnsupportedBoxException, parse_ovf, self.ovf)
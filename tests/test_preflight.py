@@ -0,0 +1,78 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+import os
+import logging
+
+from candelabra.config import config
+from candelabra.errors import PreflightException
+from candelabra.preflight import Requirements, run_preflight, get_free_space
+from candelabra.tests import CandelabraTestBase
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+TERABYTE = 1024 ** 4
+
+
+class FakeMachine(object):
+    def __init__(self, path, space, memory):
+        self.path, self.space, self.memory = path, space, memory
+
+    def get_requirements_up(self, requirements):
+        requirements.add_space(self.path, self.space, key=('box', 'some-box'))
+        requirements.add_memory(self.memory)
+
+
+class FakeTopology(object):
+    def __init__(self, machines):
+        self.machines = machines
+
+
+class PreflightTestSuite(CandelabraTestBase):
+    """ Test suite for the preflight checks
+    """
+
+    CONFIG = """
+[candelabra]
+"""
+
+    def test_requirements(self):
+        """ Testing that requirements are checked against the resources available
+        """
+        path = os.path.dirname(__file__)
+        free = get_free_space(path)[1]
+
+        requirements = Requirements()
+        requirements.add_space(path, free / 4, key='box')
+        requirements.add_space(path, free / 4, key='box')
+        requirements.add_space(os.path.join(path, 'does', 'not', 'exist'), free / 4)
+        self.assertEqual(requirements.check(), [])
+
+        # requirements in the same filesystem are added
+        requirements.add_space(path, free / 2 + 1024 * 1024)
+        self.assertEqual(len(requirements.check()), 1)
+
+        requirements = Requirements()
+        requirements.add_memory(TERABYTE)
+        self.assertEqual(len(requirements.check()), 1)
+
+    def test_run_preflight(self):
+        """ Testing that commands fail before running when there are not enough resources
+        """
+        path = os.path.dirname(__file__)
+        topology = FakeTopology([FakeMachine(path, 1024, 1), FakeMachine(path, 1024, 1)])
+        run_preflight(topology, 'up')
+        run_preflight(topology, 'down')
+
+        topology.machines.append(FakeMachine(path, 1024, TERABYTE))
+        self.assertRaises(PreflightException, run_preflight, topology, 'up')
+
+        config.set('candelabra', 'preflight', 'warn')
+        try:
+            run_preflight(topology, 'up')
+        finally:
+            config.set('candelabra', 'preflight', 'fail')
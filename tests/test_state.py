@@ -4,20 +4,59 @@
 # Copyright Alvaro Saurin 2013 - All right Reserved
 #
 
+import os
+import shutil
+import tempfile
 import unittest
 import logging
 
+from candelabra.config import config
+from candelabra.plugins import PLUGINS_REGISTRIES, ProviderPlugin
+from candelabra.registry import registry_factory
 from candelabra.tests import CandelabraTestBase
-from candelabra.topology.machine import MachineNode
+from candelabra.topology.interface import InterfaceNode
+from candelabra.topology.machine import MachineNode, STATE_RUNNING
+from candelabra.topology.network import NetworkNode
+from candelabra.topology.shared import SharedNode
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+
+class PlainProviderPlugin(ProviderPlugin):
+    """ A provider that builds plain nodes, so we can load topologies without any hypervisor
+    """
+    MACHINE = MachineNode
+    NETWORK = NetworkNode
+    INTERFACE = InterfaceNode
+    SHARED = SharedNode
+
+
+TOPOLOGY = """
+candelabra:
+    default:
+        class:          plain
+    machines:
+        - machine:
+            name:       vm1
+            class:      plain
+            interfaces: []
+        - machine:
+            name:       vm2
+            class:      plain
+            interfaces: []
+"""
+
+
 class StateTestSuite(CandelabraTestBase):
     """ Test suite for states
     """
 
+    CONFIG = """
+[candelabra]
+"""
+
     def test_nodes(self):
         """ Testing tha we can manage nodes attributes
         """
@@ -29,4 +68,187 @@ class StateTestSuite(CandelabraTestBase):
         self.assertTrue('state' not in state, 'state=%s' % str(state))
         self.assertEqual(state['name'], 'vm1', 'state=%s' % str(state))
 
+    def test_facts(self):
+        """ Testing that the machine facts are cached and saved in the state
+        """
+
+        class CountingMachineNode(MachineNode):
+            num_queries = 0
+
+            def query_facts(self):
+                self.num_queries += 1
+                return {'state': STATE_RUNNING[0], 'ips': ['10.0.0.1']}
+
+        vm1 = CountingMachineNode(name='vm1', uuid='some-uuid')
+        self.assertTrue(vm1.is_running)
+        self.assertFalse(vm1.is_powered_down)
+        self.assertFalse(vm1.is_unknown)
+        self.assertEqual(vm1.num_queries, 1)
+
+        state = vm1.get_state_dict()
+        self.assertEqual(state['facts']['ips'], ['10.0.0.1'])
+
+        # facts loaded from a state are used while they are not older than the TTL
+        vm2 = CountingMachineNode(name='vm2', uuid='other-uuid')
+        vm2.set_facts(state['facts'], timestamp=state['facts']['timestamp'])
+        self.assertTrue(vm2.is_running)
+        self.assertEqual(vm2.num_queries, 0)
+
+        vm2.set_facts(state['facts'], timestamp=1)
+        self.assertTrue(vm2.is_running)
+        self.assertEqual(vm2.num_queries, 1)
+
+        vm2.get_facts(fresh=True)
+        self.assertEqual(vm2.num_queries, 2)
+
+    def test_journal(self):
+        """ Testing that changes recorded in the journal survive a crash
+        """
+        from candelabra.topology.root import TopologyRoot
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            config.set('candelabra', 'registry', os.path.join(temp_dir, 'topologies.json'))
+
+            topology = TopologyRoot()
+            topology._filename = os.path.join(temp_dir, 'topology.yaml')
+
+            vm1 = MachineNode(name='vm1', uuid='some-uuid')
+            vm2 = MachineNode(name='vm2', uuid='other-uuid')
+            topology.state.record(vm1, 'created')
+            topology.state.record(vm2, 'created')
+            topology.state.record(vm2, 'destroyed')
+            self.assertTrue(os.path.exists(topology.state.journal_filename))
+            self.assertFalse(os.path.exists(topology.state.filename))
+
+            # simulate a crash while writing an entry
+            with open(topology.state.journal_filename, 'a') as journal_file:
+                journal_file.write('{"event": "created", "na')
+
+            # a new process should see the first machine, but not the destroyed one
+            topology2 = TopologyRoot()
+            topology2._filename = topology._filename
+            self.assertTrue(topology2.state.persisted)
+            topology2.state.load()
+            self.assertEqual(topology2.state.get_machine_state('vm1')['uuid'], 'some-uuid')
+            self.assertEqual(topology2.state.get_machine_state('vm2'), {})
+
+            # saving the state compacts the journal into the state file
+            topology2._machines = [vm1]
+            topology2.state.save()
+            self.assertTrue(os.path.exists(topology2.state.filename))
+            self.assertFalse(os.path.exists(topology2.state.journal_filename))
+
+            topology3 = TopologyRoot()
+            topology3._filename = topology._filename
+            topology3.state.load()
+            self.assertEqual(topology3.state.get_machine_state('vm1')['uuid'], 'some-uuid')
+
+            # the topology must have been registered in the registry
+            registry = registry_factory()
+            self.assertIn(topology._filename, registry.topologies)
+            self.assertEqual(registry.topologies[topology._filename]['machines'][0]['uuid'], 'some-uuid')
+            self.assertEqual(registry.get_totals()['machines'], 1)
+
+            topology3.state.remove()
+            self.assertNotIn(topology._filename, registry_factory().topologies)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+    def test_compact_after_destroy(self):
+        """ Testing that machines destroyed do not come back after the journal is compacted
+        """
+        from candelabra.topology.root import TopologyRoot
+
+        temp_dir = tempfile.mkdtemp()
+        PLUGINS_REGISTRIES['candelabra.provider'].register('plain', PlainProviderPlugin())
+        try:
+            config.set('candelabra', 'registry', os.path.join(temp_dir, 'topologies.json'))
+            topology_filename = os.path.join(temp_dir, 'topology.yaml')
+            with open(topology_filename, 'w') as topology_file:
+                topology_file.write(TOPOLOGY)
+
+            def load_topology():
+                topology = TopologyRoot()
+                topology.load(topology_filename)
+                return topology
+
+            topology = load_topology()
+            for num, machine in enumerate(topology.machines):
+                machine.cfg_uuid = 'uuid-%d' % num
+                machine.record_state('created')
+            topology.state.save()
+            self.assertTrue(os.path.exists(topology.state.filename))
+
+            # destroy all the machines (they are still in the topology, but without a UUID), compacting the
+            # journal when recording the last destroy
+            topology = load_topology()
+            self.assertEqual([machine.cfg_uuid for machine in topology.machines], ['uuid-0', 'uuid-1'])
+            config.set('candelabra', 'state_compact_every', str(len(topology.machines)))
+            try:
+                for machine in topology.machines:
+                    machine.cfg_uuid = None
+                    machine.record_state('destroyed')
+            finally:
+                config.config.remove_option('candelabra', 'state_compact_every')
+            self.assertFalse(os.path.exists(topology.state.journal_filename))
+
+            topology = load_topology()
+            self.assertFalse(any(machine.cfg_uuid for machine in topology.machines))
+            self.assertFalse(os.path.exists(topology.state.journal_filename))
+            self.assertFalse(os.path.exists(topology.state.filename))
+        finally:
+            del PLUGINS_REGISTRIES['candelabra.provider'].plugins['plain']
+            shutil.rmtree(temp_dir)
+
+
+class SqliteStateTestSuite(CandelabraTestBase):
+    """ Test suite for states kept in a SQLite database
+    """
+
+    CONFIG = """
+[candelabra]
+state_backend = sqlite
+"""
+
+    def test_sqlite(self):
+        """ Testing that we can save and restore states from a database
+        """
+        from candelabra.topology.root import TopologyRoot
+        from candelabra.topology.state import SqliteState
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            config.set('candelabra', 'state_db', os.path.join(temp_dir, 'state.db'))
+            config.set('candelabra', 'registry', os.path.join(temp_dir, 'topologies.json'))
+
+            topology = TopologyRoot()
+            topology._filename = os.path.join(temp_dir, 'topology.yaml')
+            self.assertIsInstance(topology.state, SqliteState)
+            self.assertFalse(topology.state.persisted)
+
+            vm1 = MachineNode(name='vm1', uuid='some-uuid')
+            vm2 = MachineNode(name='vm2', uuid='other-uuid')
+            topology._machines = [vm1, vm2]
+            topology.state.save()
+            self.assertTrue(topology.state.persisted)
+
+            # another process updates only one of the machines
+            topology2 = TopologyRoot()
+            topology2._filename = topology._filename
+            topology2.state.load()
+            self.assertEqual(topology2.state.get_machine_state('vm2')['uuid'], 'other-uuid')
+            vm2.cfg_uuid = 'new-uuid'
+            topology2.state.record(vm2, 'created')
+
+            topology3 = TopologyRoot()
+            topology3._filename = topology._filename
+            topology3.state.load()
+            self.assertEqual(topology3.state.get_machine_state('vm1')['uuid'], 'some-uuid')
+            self.assertEqual(topology3.state.get_machine_state('vm2')['uuid'], 'new-uuid')
 
+            topology3.state.remove()
+            self.assertFalse(topology3.state.persisted)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,105 @@
+#
+# Candelabra
+#
+# Copyright Alvaro Saurin 2013 - All right Reserved
+#
+
+import time
+import logging
+
+from candelabra.tests import CandelabraTestBase
+from candelabra.waits import wait_until, wait_stats
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class WaitsTestSuite(CandelabraTestBase):
+    """ Test suite for the condition-based waits
+    """
+
+    def setUp(self):
+        super(WaitsTestSuite, self).setUp()
+        wait_stats().reset()
+
+    def test_wait_until(self):
+        start = time.time()
+        checks = []
+
+        def condition():
+            checks.append(time.time())
+            return len(checks) >= 3 and 'ready'
+
+        res = wait_until(condition, timeout=5.0, reason='testing')
+        self.assertEqual(res, 'ready')
+        self.assertEqual(len(checks), 3)
+        self.assertLess(time.time() - start, 1.0)
+
+        stats = wait_stats().reasons['testing']
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 0)
+
+    def test_wait_until_timeout(self):
+        start = time.time()
+        res = wait_until(lambda: False, timeout=0.3, reason='never')
+        elapsed = time.time() - start
+        self.assertFalse(res)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 1.0)
+
+        wait_until(lambda: True, timeout=0.3, reason='never')
+        stats = wait_stats().reasons['never']
+        self.assertEqual(stats['waits'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertAlmostEqual(wait_stats().get_total(), stats['time'])
+        wait_stats().report()
+
+    def test_event_waits(self):
+        """ Testing that waits for events are recorded too
+        """
+        import threading
+        from candelabra.provider.virtualbox.events import EventWaiter
+
+        waiter = EventWaiter(None, 'some-uuid', [1])
+        self.assertIsNone(waiter.wait(0.05, reason='power-up'))
+        threading.Timer(0.05, waiter.notify, args=['event']).start()
+        self.assertEqual(waiter.wait(5.0, reason='power-up'), 'event')
+
+        stats = wait_stats().reasons['power-up']
+        self.assertEqual(stats['waits'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+
+    def test_event_conditions(self):
+        """ Testing that conditions are checked when events arrive (and with some interval)
+        """
+        import threading
+        from candelabra.provider.virtualbox.events import EventsDispatcher
+
+        dispatcher = EventsDispatcher()
+        dispatcher.start = lambda: None
+        checks = []
+
+        def condition():
+            checks.append(time.time())
+            return len(checks) >= 3
+
+        def notify():
+            for waiter in list(dispatcher._waiters):
+                dispatcher.remove(waiter)
+                waiter.notify('event')
+
+        for delay in [0.05, 0.1]:
+            threading.Timer(delay, notify).start()
+        start = time.time()
+        self.assertTrue(dispatcher.wait_until(condition, 'some-uuid', [1], timeout=5.0, reason='additions'))
+        self.assertLess(time.time() - start, 1.0)
+
+        # without events, the condition is checked every interval
+        del checks[:]
+        self.assertTrue(dispatcher.wait_until(condition, 'some-uuid', [1], timeout=5.0, interval=0.05,
+                                              reason='additions'))
+        self.assertFalse(dispatcher.wait_until(lambda: False, 'some-uuid', [1], timeout=0.1, interval=0.05,
+                                               reason='additions'))
+        stats = wait_stats().reasons['additions']
+        self.assertEqual(stats['waits'], 3)
+        self.assertEqual(stats['timeouts'], 1)